@@ -1,4 +1,5 @@
 import datetime
+import json
 from datetime import date, timedelta
 
 import numpy as np
@@ -7,14 +8,15 @@ import plotly.graph_objects as go
 import streamlit as st
 
 # 自作モジュールのインポート: notion_db を supabase_db に変更
+import forecast_jobs
 import logic
 import supabase_db
+import transport
 
 # ==========================================
 # 1. 初期設定
 # ==========================================
 st.set_page_config(page_title="Body Composition Tracker", page_icon="⚡", layout="wide")
-FAT_CALORIES_PER_KG = 7200  # 脂肪1kgあたりのカロリー
 
 # ※ SecretsのID読み込みは不要になりました (supabase_db内で完結)
 
@@ -73,15 +75,103 @@ CATEGORY_LIST = [
 ]
 
 
+def neural_forecast(df, goal_date, athlete):
+    """
+    NeuralProphet による予測 (学習はバックグラウンド)
+    Returns: (目標日の予測値, 予測データ, 学習情報)
+    """
+    # 予測モデルはバックグラウンドで学習し、完了までは直近の学習済みモデルで予測する
+    # (Stale-While-Revalidate: 他セッションの画面描画もブロックしない)
+    # 学習はデータ版ごと。Goal Date の変更は予測期間だけが変わるので再学習しない
+    fore_key = logic.forecast_key(df, athlete)
+    fore_job = forecast_jobs.submit(
+        fore_key,
+        logic.forecast_job,
+        df[["ds", "y"]].copy(),
+        athlete,
+        group=athlete,
+        force=st.session_state.pop("forecast_retry", False),
+    )
+    last_job = forecast_jobs.last_good(athlete)
+    stale = None
+    if not fore_job.finished and last_job is None:
+        # このプロセスでの学習結果がまだ無い (起動直後) 場合は、ディスクに保存済みの学習結果で表示する
+        stale = logic.stale_neural_forecast(df, goal_date, athlete)
+        if stale is None:
+            # 保存済みの結果も無い (初回) 場合のみ、上限付きで完了を待つ
+            with st.spinner("Analyzing with NeuralProphet (AI)..."):
+                fore_job.wait(forecast_jobs.RUN_TIMEOUT)
+            last_job = forecast_jobs.last_good(athlete)
+
+    ready_job = fore_job if fore_job.status == "done" else last_job
+    if ready_job is not None:
+        p_val, p_fore = logic.run_neural_model(ready_job.args[0], goal_date, athlete)
+        fit_info = ready_job.result
+        showing = "前回の予測"
+    elif stale is not None:
+        p_val, p_fore = stale
+        fit_info = p_fore.attrs.get("fit_info")
+        showing = "保存済みの予測"
+    elif fore_job.status in ("queued", "running"):
+        # 待ちきれなかった場合は Holt-Winters の予測を暫定表示し、学習は続ける
+        p_val, p_fore = logic.run_fast_model(df, goal_date)
+        fit_info = {
+            **p_fore.attrs["fit_info"],
+            "source": f"{p_fore.attrs['fit_info']['source']} (AI pending)",
+        }
+        showing = "暫定予測 (Holt-Winters)"
+    else:
+        st.error(f"Forecast unavailable ({fore_job.status}): {fore_job.error or ''}")
+        if st.button("🔄 Retry Forecast"):
+            st.session_state.forecast_retry = True
+            st.rerun()
+        st.stop()
+    forecast_is_stale = fore_job.status != "done"
+
+    if forecast_is_stale:
+
+        @st.fragment(run_every=3)
+        def forecast_status():
+            job = forecast_jobs.get(fore_key)
+            if job is None or job.status == "done":
+                # 新しい予測が完成 → 画面全体を再描画して差し替え
+                st.rerun()
+
+            c_msg, c_btn = st.columns([4, 1])
+            if job.status in ("queued", "running"):
+                pos = forecast_jobs.queue_position(fore_key)
+                state = f"待ち行列 {pos} 番目" if pos else "再学習中"
+                c_msg.info(f"⏳ {showing}を表示中 (Stale) — バックグラウンドで{state}")
+                if c_btn.button("⏹ Cancel", key="forecast_cancel"):
+                    forecast_jobs.cancel(fore_key)
+            else:
+                c_msg.warning(
+                    f"⚠️ 再学習が {job.status} のため{showing}を表示中 {job.error or ''}"
+                )
+                if c_btn.button("🔄 Retry", key="forecast_retry_btn"):
+                    st.session_state.forecast_retry = True
+                    st.rerun()
+
+        forecast_status()
+
+    return p_val, p_fore, fit_info
+
+
 def main():
     # ==========================================
     # 3. グローバル設定のロード (Start-up Load)
     # ==========================================
-    # Notion版から Supabase版へ変更 (引数不要)
-    try:
-        settings_data = supabase_db.fetch_settings()
-    except Exception:
-        settings_data = {}
+    # 確率シミュレーションの乱数はデータの取得を待つ間に抽選しておく (プロセスで1度だけ)
+    logic.prefetch_mc_draws()
+    # 設定・マスタ・Daily Log・過去CSV を並列に取得 (最初の描画は一番遅い取得だけを待つ)
+    startup = supabase_db.load_startup()
+    settings_data = startup["settings"]
+    # 変更通知の購読を開始 (購読中は他の端末の保存が届き次第キャッシュへ反映、切断中は TTL ポーリング)
+    supabase_db.start_realtime()
+
+    # Supabase に接続できない場合はローカル複製で表示 (保存は接続の回復後に送信)
+    offline = supabase_db.is_offline()
+    n_pending, pending_error = supabase_db.pending_writes()
 
     # --- デフォルト値と設定値の展開 ---
     # A. Goal Date
@@ -103,21 +193,67 @@ def main():
     # D. Monthly Target
     cfg_monthly_target = float(settings_data.get("monthly_target", 68.0))
 
+    # E. Athlete (学習済みモデルの保存キー)
+    cfg_athlete = str(settings_data.get("athlete_id", "default"))
+
+    # F. Forecast Engine ("fast" / "neural")
+    cfg_engine = str(
+        settings_data.get("forecast_engine", logic.DEFAULT_FORECAST_ENGINE)
+    )
+    if cfg_engine not in logic.FORECAST_ENGINES:
+        cfg_engine = logic.DEFAULT_FORECAST_ENGINE
+
+    # G. Intake Schedule (リフィード・ダイエットブレイク・カーボサイクル。未設定なら None)
+    try:
+        cfg_schedule = logic.parse_intake_schedule(
+            settings_data.get("intake_schedule")
+        )
+    except ValueError as e:
+        st.warning(f"Intake schedule ignored: {e}")
+        cfg_schedule = None
+
     # ==========================================
     # 4. サイドバー (入力専用)
     # ==========================================
     with st.sidebar:
         st.header("📝 Daily Log")
         st.caption("食品を選んでカートに追加 → 保存")
+        if offline:
+            st.warning(
+                "📴 Offline: 前回同期したデータを表示中 (保存は接続の回復後に送信)"
+            )
+        if n_pending:
+            st.caption(
+                f"⏳ 同期待ちの保存: {n_pending} 件"
+                + (f" (再試行中: {pending_error})" if pending_error else "")
+            )
+        # サーバに拒否された保存 (権限・制約違反など。再送しても同じ結果になるため自動では送らない)
+        rejected = supabase_db.rejected_writes()
+        if rejected:
+            with st.expander(f"⛔ 拒否された保存: {len(rejected)} 件", expanded=True):
+                st.dataframe(
+                    pd.DataFrame(
+                        {
+                            "Table": [w["table"] for w in rejected],
+                            "Key": [w["key"] for w in rejected],
+                            "Error": [w["error"] for w in rejected],
+                        }
+                    ),
+                    hide_index=True,
+                    use_container_width=True,
+                )
+                ids = [w["id"] for w in rejected]
+                c_retry, c_discard = st.columns(2)
+                if c_retry.button("🔄 Retry", key="rejected_retry"):
+                    supabase_db.retry_rejected(ids)
+                    st.rerun()
+                if c_discard.button("🗑️ Discard", key="rejected_discard"):
+                    supabase_db.discard_rejected(ids)
+                    st.rerun()
 
-        # --- データ取得 (食品マスタ & セットメニュー) ---
-        try:
-            food_dict = supabase_db.fetch_food_list()
-            set_dict = supabase_db.fetch_menu_list()
-
-        except Exception:
-            food_dict = {}
-            set_dict = {}
+        # --- データ取得 (食品マスタ & セットメニュー: 起動時に取得済み) ---
+        food_dict = startup["food"]
+        set_dict = startup["menu"]
 
         # --- カートシステム (Session State管理) ---
         if "meal_cart" not in st.session_state:
@@ -262,7 +398,7 @@ def main():
             note = st.text_input("Memo", placeholder="Training content, mood, etc.")
 
             if st.form_submit_button("💾 Save Log", type="primary"):
-                # Supabaseに保存 (IDやToken引数は不要)
+                # ジャーナルに記録し、Supabaseへはバックグラウンドで送信
                 supabase_db.add_daily_log(
                     d_in,
                     w_in,
@@ -272,7 +408,7 @@ def main():
                     f=round(ff, 1),
                     c=round(fc, 1),
                 )
-                st.success("Saved successfully to Supabase!")
+                st.success("Saved! Syncing to Supabase in the background.")
                 st.session_state.meal_cart = []
                 st.rerun()
 
@@ -282,19 +418,61 @@ def main():
     st.title("⚡ Body Composition Tracker")
 
     # データ取得
-    raw_df = supabase_db.fetch_raw_data()
+    raw_df = startup["logs"]
     if raw_df.empty:
         st.warning("No data found in Database.")
         st.stop()
 
-    # 分析ロジック (変更なし)
-    df = logic.enrich_data(raw_df, cfg_goal_date)
-    # CSVはローカルファイルなのでそのまま
-    hist_df = supabase_db.fetch_history_csv()
+    # 過去CSV (ローカルファイル、起動時に取得済み)
+    hist_df = startup["history"]
+    # 体重1kgあたりのカロリー・代謝適応係数 (記録から選手ごとに推定。推定期間が進むまで保存値を使う)
+    calib = logic.get_calibration(supabase_db.fetch_logs_between, cfg_athlete, hist_df)
+    cfg_kcal_per_kg = calib["kcal_per_kg"]
+    cfg_adaptation = calib["adaptation"]
+
+    # 分析ロジック (前回結果を再利用し、追記・更新のあった末尾だけ再計算)
+    df = logic.enrich_data_incremental(
+        raw_df, cfg_goal_date, kcal_per_kg=cfg_kcal_per_kg
+    )
+
+    # 予測エンジン: 通常は軽量な Holt-Winters、設定で NeuralProphet を選択
+    if cfg_engine == "neural":
+        # 学習には全期間を使う (初回は古い期間をここで追加取得)
+        p_val, p_fore, fit_info = neural_forecast(
+            supabase_db.fetch_full_history(), cfg_goal_date, cfg_athlete
+        )
+    else:
+        p_val, p_fore = logic.run_fast_model(df, cfg_goal_date)
+        fit_info = p_fore.attrs.get("fit_info")
+    l_val = logic.run_linear_model(df, cfg_goal_date)
+
+    # モデルの取得経路 (cache / finetune / train / holt-winters) と所要時間
+    if fit_info:
+        secs = fit_info["seconds"]
+        took = f"{secs:.1f}s" if secs >= 1 else f"{secs * 1000:.0f}ms"
+        st.caption(f"🧠 Model: {fit_info['source']} ({took})")
+
+    # シミュレーションの初期値 (Action の逆算と Simulator タブで共用)
+    # 現在の体重（SMA7があればそれを、なければ生データ）
+    current_weight = (
+        df["SMA_7"].iloc[-1] if pd.notna(df["SMA_7"].iloc[-1]) else df["y"].iloc[-1]
+    )
+
+    # 現在のTDEE（計算値）
+    base_tdee = (
+        int(df["real_tdee_smooth"].iloc[-1])
+        if pd.notna(df.get("real_tdee_smooth", pd.Series([np.nan])).iloc[-1])
+        else 2400
+    )
 
-    with st.spinner("Analyzing with NeuralProphet (AI)..."):
-        p_val, p_fore = logic.run_neural_model(df, cfg_goal_date)
-        l_val = logic.run_linear_model(df, cfg_goal_date)
+    # 現在の摂取カロリー（直近平均 or デフォルト2000）
+    current_intake = (
+        int(df["c_ma"].iloc[-1])
+        if "c_ma" in df.columns
+        and pd.notna(df["c_ma"].iloc[-1])
+        and df["c_ma"].iloc[-1] > 0
+        else 2000
+    )
 
     # KPI 計算
     curr = df["y"].iloc[-1]
@@ -303,7 +481,7 @@ def main():
     gap = p_val - cfg_goal_weight
 
     # KPI 表示
-    c1, c2, c3, c4, c5 = st.columns(5)
+    c1, c2, c3, c4, c5, c6 = st.columns(6)
     c1.metric("Weight", f"{curr:.1f} kg", f"{(curr - cfg_goal_weight):+.1f}")
     c2.metric("Days Left", f"{days}")
 
@@ -321,7 +499,7 @@ def main():
     )
     c4.metric("Trend (Lin)", f"{l_val:.1f} kg")
 
-    adj = int((abs(gap) * FAT_CALORIES_PER_KG) / days)
+    adj = int((abs(gap) * cfg_kcal_per_kg) / days)
     action_label = "Keep"
     status_label = "On Track"
     alert_color = "off"
@@ -343,6 +521,27 @@ def main():
 
     c5.metric("Action", action_label, status_label, delta_color=alert_color)
 
+    # 代謝適応シミュレーションが目標日にちょうど目標体重へ着地する摂取カロリー
+    goal_intake = logic.run_goal_intake_solver(
+        df,
+        cfg_goal_date,
+        current_weight,
+        base_tdee,
+        cfg_goal_weight,
+        adaptation=cfg_adaptation,
+        kcal_per_kg=cfg_kcal_per_kg,
+    )
+    if goal_intake is None:
+        c6.metric("Goal Intake", "-")
+    else:
+        c6.metric(
+            "Goal Intake",
+            f"{goal_intake:.0f} kcal",
+            f"{goal_intake - current_intake:+.0f} vs now",
+            delta_color="off",
+            help="代謝適応（体重1kgあたりのTDEE低下）を含めて逆算した、目標日に目標体重へ着地する1日の摂取カロリー",
+        )
+
     # ==========================================
     # 6. タブ構成
     # ==========================================
@@ -362,31 +561,61 @@ def main():
     with tab1:
         st.markdown("### 📉 AI Forecast & Metabolic Simulation")
 
-        # 1. データの準備
-        # 現在の体重（SMA7があればそれを、なければ生データ）
-        current_weight = (
-            df["SMA_7"].iloc[-1] if pd.notna(df["SMA_7"].iloc[-1]) else df["y"].iloc[-1]
-        )
-
-        # 現在のTDEE（計算値）
-        base_tdee = (
-            int(df["real_tdee_smooth"].iloc[-1])
-            if pd.notna(df.get("real_tdee_smooth", pd.Series([np.nan])).iloc[-1])
-            else 2400
+        # 3. シミュレーションの実行 (代謝適応モデル)
+        sim_df = logic.run_metabolic_simulation(
+            df,
+            cfg_goal_date,
+            current_weight,
+            base_tdee,
+            current_intake,
+            adaptation=cfg_adaptation,
+            kcal_per_kg=cfg_kcal_per_kg,
         )
-
-        # 現在の摂取カロリー（直近平均 or デフォルト2000）
-        current_intake = (
-            int(df["c_ma"].iloc[-1])
-            if "c_ma" in df.columns
-            and pd.notna(df["c_ma"].iloc[-1])
-            and df["c_ma"].iloc[-1] > 0
-            else 2000
+        # 摂取カロリーを ±100/200/300 kcal 変えた計画 (1回の計算でまとめて求める)
+        fan_df = logic.run_metabolic_simulation_fan(
+            df,
+            cfg_goal_date,
+            current_weight,
+            base_tdee,
+            current_intake,
+            adaptation=cfg_adaptation,
+            kcal_per_kg=cfg_kcal_per_kg,
         )
+        # 摂取スケジュール (設定されていれば) どおりに食べた場合の推移
+        plan_intake = current_intake
+        schedule_df = pd.DataFrame()
+        if cfg_schedule:
+            plan_intake = {
+                **cfg_schedule,
+                "base": (
+                    current_intake
+                    if cfg_schedule["base"] is None
+                    else cfg_schedule["base"]
+                ),
+            }
+            schedule_df = logic.run_metabolic_simulation(
+                df,
+                cfg_goal_date,
+                current_weight,
+                base_tdee,
+                plan_intake,
+                adaptation=cfg_adaptation,
+                kcal_per_kg=cfg_kcal_per_kg,
+            )
 
-        # 3. シミュレーションの実行 (代謝適応モデル)
-        sim_df = logic.run_metabolic_simulation(
-            df, cfg_goal_date, current_weight, base_tdee, current_intake
+        # 摂取・TDEE 推定・水分のブレを抽選した確率シミュレーション (パーセンタイル帯と到達確率)
+        # スケジュールがあればスケジュールどおりの計画で求める
+        mc_df = logic.run_metabolic_simulation(
+            df,
+            cfg_goal_date,
+            current_weight,
+            base_tdee,
+            plan_intake,
+            paths=logic.MC_PATHS,
+            goal_weight=cfg_goal_weight,
+            is_cut=cfg_is_cut,
+            adaptation=cfg_adaptation,
+            kcal_per_kg=cfg_kcal_per_kg,
         )
 
         # --- KPI表示エリア ---
@@ -429,7 +658,7 @@ def main():
                 est_date_str = "∞"
                 sub_label = "(Stagnant/Increasing)"
 
-        col_tdee, col_est = st.columns([1, 1])
+        col_tdee, col_est, col_prob = st.columns([1, 1, 1])
 
         with col_tdee:
             st.metric(
@@ -457,6 +686,26 @@ def main():
                 unsafe_allow_html=True,
             )
 
+        with col_prob:
+            p_hit = mc_df.attrs.get("p_hit")
+            if p_hit is None:
+                st.metric("P(Make Weight)", "-")
+            else:
+                noise = mc_df.attrs["noise"]
+                st.metric(
+                    "P(Make Weight)",
+                    f"{p_hit:.0%}",
+                    f"On date: {mc_df.attrs['p_on_date']:.0%}",
+                    delta_color="off",
+                    help=(
+                        f"{mc_df.attrs['paths']:,} 通りの確率シミュレーションで、目標日までに目標体重へ届く割合"
+                        + ("（摂取スケジュールどおりの場合）" if cfg_schedule else "")
+                        + f"（On date: 目標日の計量で届く割合）。ブレ: 摂取 ±{noise['intake_sd']:.0f} kcal/日・"
+                        f"TDEE ±{noise['tdee_sd']:.0f} kcal・水分 ±{noise['water_sd']:.2f} kg "
+                        f"（計算 {mc_df.attrs['seconds'] * 1000:.0f} ms）"
+                    ),
+                )
+
         # --- グラフ描画 ---
         fig = go.Figure()
 
@@ -472,6 +721,47 @@ def main():
             )
         )
 
+        # B''. 確率シミュレーションのパーセンタイル帯 (5-95% / 25-75%)
+        for lo, hi, alpha in (("sim_p05", "sim_p95", 0.08), ("sim_p25", "sim_p75", 0.15)):
+            if lo not in mc_df:
+                continue
+            fig.add_trace(
+                go.Scatter(
+                    x=pd.concat([mc_df["ds"], mc_df["ds"][::-1]]),
+                    y=pd.concat([mc_df[hi], mc_df[lo][::-1]]),
+                    fill="toself",
+                    fillcolor=f"rgba(200, 200, 200, {alpha})",
+                    line=dict(width=0),
+                    name=f"Sim {lo[-2:]}-{hi[-2:]}%",
+                    hoverinfo="skip",
+                )
+            )
+
+        # B'. 摂取カロリー別のシミュレーション (Plan Fan) - Faint Lines
+        for i, (offset, plan) in enumerate(fan_df.groupby("offset", sort=True)):
+            fig.add_trace(
+                go.Scatter(
+                    x=plan["ds"],
+                    y=plan["yhat_sim"],
+                    mode="lines",
+                    name="Sim (±100/200/300 kcal)",
+                    legendgroup="sim_fan",
+                    showlegend=i == 0,
+                    line=dict(
+                        color=(
+                            "rgba(120, 200, 255, 0.35)"
+                            if offset < 0
+                            else "rgba(255, 150, 150, 0.35)"
+                        ),
+                        width=1,
+                    ),
+                    hovertemplate=(
+                        f"<b>{int(plan['intake'].iloc[0])} kcal ({offset:+.0f})</b>"
+                        "<br>%{x|%m/%d}: %{y:.1f}kg<extra></extra>"
+                    ),
+                )
+            )
+
         # B. Metabolic Simulation (Math) - White Dashed Line
         if not sim_df.empty:
             fig.add_trace(
@@ -485,6 +775,21 @@ def main():
                 )
             )
 
+        # B'''. 摂取スケジュールどおりの推移 - Green Line
+        if not schedule_df.empty:
+            fig.add_trace(
+                go.Scatter(
+                    x=schedule_df["ds"],
+                    y=schedule_df["yhat_sim"],
+                    customdata=schedule_df["intake"],
+                    mode="lines",
+                    name="Sim (Schedule)",
+                    line=dict(color="rgba(52, 211, 153, 0.9)", width=2),
+                    hovertemplate="<b>Schedule</b><br>%{x|%m/%d}: %{y:.1f}kg"
+                    "<br>Intake: %{customdata:.0f} kcal<extra></extra>",
+                )
+            )
+
         # C. SMA7 (Trend) - Cyan Line
         if pd.notna(df["SMA_7"].iloc[-1]):
             fig.add_trace(
@@ -643,7 +948,28 @@ def main():
                         )
                     )
 
-            cur = df[df["days_out"] > -dr]
+            # 表示範囲が取得済みの期間より前に及ぶ場合、古い期間は明示的に選んだ時だけ追加取得する
+            # (タブの中身は表示中でなくても毎回実行されるため)
+            season_df = df
+            loaded_since = supabase_db.loaded_since()
+            range_start = pd.Timestamp(cfg_goal_date) - pd.Timedelta(days=dr)
+            if loaded_since is not None and range_start < pd.Timestamp(loaded_since):
+                if st.toggle(
+                    "Load full current-season history",
+                    key="history_full_range",
+                    help=f"{loaded_since:%Y/%m/%d} より前の記録を追加で取得します",
+                ):
+                    season_df = logic.enrich_data(
+                        supabase_db.fetch_full_history(),
+                        cfg_goal_date,
+                        kcal_per_kg=cfg_kcal_per_kg,
+                    )
+                else:
+                    st.caption(
+                        f"Current: {loaded_since:%Y/%m/%d} 以降のみ表示中 "
+                        "(表示範囲の全体を表示するには上のトグルで追加取得)"
+                    )
+            cur = season_df[season_df["days_out"] > -dr]
             fig2.add_trace(
                 go.Scatter(
                     x=cur["days_out"],
@@ -802,7 +1128,20 @@ def main():
     with tab3:
         if hist_df is not None:
             st.markdown("### 🏆 Competition History")
-            curr_formatted = df[["ds", "y"]].rename(
+            # タブの中身は表示中でなくても毎回実行されるため、古い期間の追加取得は
+            # 明示的に選んだ時だけ行う (それまでは取得済みの期間を表示)
+            loaded_since = supabase_db.loaded_since()
+            season_df = raw_df
+            if loaded_since is not None:
+                if st.toggle(
+                    "Load full current-season history",
+                    key="comp_full_history",
+                    help=f"{loaded_since:%Y/%m/%d} より前の記録を追加で取得します",
+                ):
+                    season_df = supabase_db.fetch_full_history()
+                else:
+                    st.caption(f"Current Season: {loaded_since:%Y/%m/%d} 以降を表示中")
+            curr_formatted = season_df[["ds", "y"]].rename(
                 columns={"ds": "Date", "y": "Weight"}
             )
             curr_formatted["Label"] = "Current Season"
@@ -1091,7 +1430,23 @@ def main():
         st.subheader("🤖 AI Factor Analysis (XGBoost)")
         st.caption("「何が体重減少に最も寄与しているか」をAIが判定します")
 
-        imp_df = logic.run_xgboost_importance(df)
+        # XGBoost は重いため、必要な時だけ読み込む (初回実行時に import)
+        run_factor = st.toggle("Run Factor Analysis", key="run_factor_analysis")
+        imp_df = None
+        if run_factor:
+            try:
+                # 学習には全期間を使う (初回は古い期間をここで追加取得)
+                full_df = logic.enrich_data(
+                    supabase_db.fetch_full_history(),
+                    cfg_goal_date,
+                    kcal_per_kg=cfg_kcal_per_kg,
+                )
+                imp_df = logic.run_xgboost_importance(full_df)
+            except RuntimeError:
+                st.warning(
+                    "学習キューが混雑しています。しばらくしてから再実行してください。"
+                )
+                run_factor = False
 
         if imp_df is not None:
             # 棒グラフで重要度を表示
@@ -1119,7 +1474,7 @@ def main():
             st.info(
                 f"💡 AIの分析によると、現在の体重変動に最も影響を与えているのは **「{top_factor}」** です。"
             )
-        else:
+        elif run_factor:
             st.warning(
                 "データ不足のため、詳細分析にはまだ時間がかかります（最低14日分のデータが必要です）。"
             )
@@ -1132,6 +1487,20 @@ def main():
                 f"{df['real_tdee_smooth'].iloc[-1]:.0f} kcal",
                 f"Intake: {df['c_ma'].iloc[-1]:.0f}",
             )
+            if calib["source"] == "fit":
+                st.caption(
+                    f"Calibrated: {calib['kcal_per_kg']:.0f} kcal/kg, "
+                    f"adaptation {calib['adaptation']:.1f} kcal/kg "
+                    f"(RMSE {calib['rmse']:.2f} kg, {calib['days']} days / "
+                    f"{calib['segments']} periods)"
+                )
+            else:
+                st.caption(
+                    f"Default: {calib['kcal_per_kg']:.0f} kcal/kg, "
+                    f"adaptation {calib['adaptation']:.1f} kcal/kg "
+                    f"({calib.get('reason')}。摂取と体重の記録が十分にそろい、"
+                    "値が絞り込めた場合だけ推定値を使います)"
+                )
             fig4 = go.Figure()
             fig4.add_trace(
                 go.Scatter(
@@ -1478,12 +1847,23 @@ def main():
                     step=0.1,
                     format="%.1f",
                 )
+                st.divider()
+                engine_keys = list(logic.FORECAST_ENGINES)
+                new_engine = st.radio(
+                    "Forecast Engine",
+                    engine_keys,
+                    index=engine_keys.index(cfg_engine),
+                    format_func=logic.FORECAST_ENGINES.get,
+                    horizontal=True,
+                    help="通常は軽量な Holt-Winters。NeuralProphet は学習に時間がかかります",
+                )
 
                 if st.form_submit_button("💾 Update Settings", type="primary"):
                     supabase_db.update_setting("target_date", str(new_goal_date))
                     supabase_db.update_setting("current_phase", new_phase)
                     supabase_db.update_setting("target_weight", new_goal_weight)
                     supabase_db.update_setting("monthly_target", new_monthly_target)
+                    supabase_db.update_setting("forecast_engine", new_engine)
                     st.success("Settings Updated! Reloading...")
                     st.rerun()
 
@@ -1491,6 +1871,196 @@ def main():
             "※ ここで設定した「Goal Date」や「Target」は、シミュレーター(Tab 1)の予測線に反映されます。"
         )
 
+        # 2. 摂取スケジュール (シミュレーターで予測線と重ねて表示)
+        st.subheader("🍽 Intake Schedule")
+        st.caption(
+            "基本の摂取カロリーに曜日ごとの増減（リフィード・カーボサイクル）と期間ごとの上書き（ダイエットブレイク等）を重ねます。"
+        )
+        with st.container(border=True):
+            sched = cfg_schedule or {"base": None, "weekly": [0.0] * 7, "overrides": []}
+            with st.form("schedule_form"):
+                use_recent = st.checkbox(
+                    "Base = recent average intake",
+                    value=sched["base"] is None,
+                    help="オンの場合は基本の摂取カロリーに直近の平均摂取カロリーを使います",
+                )
+                new_base = st.number_input(
+                    "Base Intake (kcal)",
+                    0,
+                    6000,
+                    value=int(sched["base"] or 0),
+                    step=50,
+                    help="Base = recent average がオフの場合に使います",
+                )
+                weekdays = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+                new_weekly = [
+                    col.number_input(
+                        day,
+                        -3000,
+                        3000,
+                        value=int(sched["weekly"][i]),
+                        step=50,
+                        key=f"sched_week_{i}",
+                    )
+                    for i, (col, day) in enumerate(zip(st.columns(7), weekdays))
+                ]
+                new_overrides = st.data_editor(
+                    pd.DataFrame(
+                        sched["overrides"],
+                        columns=["start", "end", "intake", "delta"],
+                    ).astype({"start": "datetime64[ns]", "end": "datetime64[ns]"}),
+                    num_rows="dynamic",
+                    use_container_width=True,
+                    column_config={
+                        "start": st.column_config.DateColumn("Start"),
+                        "end": st.column_config.DateColumn("End"),
+                        "intake": st.column_config.NumberColumn(
+                            "Intake (kcal)", help="期間中の摂取を固定"
+                        ),
+                        "delta": st.column_config.NumberColumn(
+                            "Delta (kcal)", help="期間中、基本 + 曜日の値に加算"
+                        ),
+                    },
+                    key="sched_overrides",
+                )
+
+                c_save, c_clear = st.columns(2)
+                if c_save.form_submit_button("💾 Save Schedule", type="primary"):
+                    rows = new_overrides.dropna(subset=["start"]).to_dict("records")
+                    try:
+                        spec = logic.parse_intake_schedule(
+                            {
+                                "base": None if use_recent else new_base,
+                                "weekly": new_weekly,
+                                "overrides": [
+                                    {
+                                        k: (None if pd.isna(v) else str(v))
+                                        for k, v in row.items()
+                                    }
+                                    for row in rows
+                                ],
+                            }
+                        )
+                    except ValueError as e:
+                        st.error(f"Invalid schedule: {e}")
+                    else:
+                        supabase_db.update_setting("intake_schedule", json.dumps(spec))
+                        st.success("Schedule Updated! Reloading...")
+                        st.rerun()
+                if c_clear.form_submit_button("🗑️ Clear Schedule"):
+                    supabase_db.update_setting("intake_schedule", "")
+                    st.rerun()
+
+        # 起動時間レポート (エンジンごとの import コスト)
+        with st.expander("⏱ Startup Import Report"):
+            st.caption(
+                "予測・分析エンジンは初めて使う時に読み込まれます。Cold Import は新しいプロセスでの計測値です。"
+            )
+            measure = st.button("Measure Cold Import", key="measure_import")
+            st.dataframe(
+                logic.engine_import_report(measure=measure),
+                use_container_width=True,
+                column_config={
+                    "Import (s)": st.column_config.NumberColumn(format="%.2f s"),
+                    "Cold Import (s)": st.column_config.NumberColumn(format="%.2f s"),
+                },
+                hide_index=True,
+            )
+
+        # 学習キューの混雑状況 (全セッション共通)
+        with st.expander("🧵 Training Queue"):
+            q = forecast_jobs.stats()
+            k1, k2, k3, k4 = st.columns(4)
+            k1.metric("Running", f"{q['running']} / {q['max_workers']}")
+            k2.metric("Queued", f"{q['queued']} / {q['max_queue']}")
+            k3.metric("Avg Wait", f"{q['avg_wait_s']:.1f} s")
+            k4.metric("Max Wait", f"{q['max_wait_s']:.1f} s")
+            st.caption(
+                f"Threads/job: {q['threads_per_job']} ・ Submitted: {q['submitted']} ・ "
+                f"Shared: {q['deduplicated']} ・ Rejected: {q['rejected']}"
+            )
+
+        with st.expander("📡 Data Fetch"):
+            rt = supabase_db.realtime_status()
+            last_event = (
+                pd.to_datetime(rt["last_event_at"], unit="s").strftime("%H:%M:%S")
+                if rt["last_event_at"]
+                else "-"
+            )
+            st.caption(
+                f"Backend: {supabase_db.STORAGE_BACKEND} ・ "
+                f"Realtime: {rt['status'].upper()} ・ Events: {rt['events']} ・ "
+                f"Last event: {last_event}"
+                + (
+                    f" ・ Delivering: {', '.join(rt['delivering'])}"
+                    if rt["delivering"]
+                    else ""
+                )
+                + (f" ・ Error: {rt['error']}" if rt["error"] else "")
+            )
+
+            pages = supabase_db.page_report()
+            if pages.empty:
+                st.caption("まだページ取得の記録がありません")
+            else:
+                pages["at"] = pd.to_datetime(pages["at"], unit="s")
+                pages["ms"] = (pages.pop("seconds") * 1000).round(1)
+                st.caption(
+                    f"Page size: {supabase_db.PAGE_SIZE} rows ・ "
+                    f"Parallel: {supabase_db.FETCH_WORKERS} ・ "
+                    f"Format: {supabase_db.BULK_FORMAT.upper()}"
+                )
+                st.dataframe(pages, hide_index=True, use_container_width=True)
+
+            # 起動時の並列取得: 取得元ごとの所要時間 (total は全体の待ち時間)
+            st.caption("Startup load (parallel)")
+            st.dataframe(
+                supabase_db.startup_report(),
+                use_container_width=True,
+                column_config={
+                    "Seconds": st.column_config.NumberColumn(format="%.3f s")
+                },
+                hide_index=True,
+            )
+
+            # 通信層: クエリごとの所要時間 (ヒストグラムからの推定値)・エラー・再試行
+            breaker = transport.breaker_status()
+            st.caption(
+                f"Supabase calls ・ Circuit: {breaker['state'].upper()} ・ "
+                f"Consecutive failures: {breaker['failures']} ・ "
+                f"Short-circuited: {breaker['rejected']}"
+            )
+            st.dataframe(
+                transport.report(),
+                use_container_width=True,
+                column_config={
+                    col: st.column_config.NumberColumn(format="%.1f ms")
+                    for col in ("Mean ms", "P50 ms", "P95 ms", "Max ms")
+                },
+                hide_index=True,
+            )
+            st.download_button(
+                "Export latency histograms (CSV)",
+                transport.histogram().to_csv(index=False).encode("utf-8"),
+                file_name="supabase_latency_histograms.csv",
+                mime="text/csv",
+                key="export_latency",
+            )
+
+            # 応答形式の比較 (取得済み期間を JSON / CSV で取り直す)
+            if st.button("Benchmark JSON vs CSV", key="bench_bulk_read"):
+                with st.spinner("Fetching daily_logs in both formats..."):
+                    bench = supabase_db.benchmark_bulk_read()
+                st.dataframe(
+                    bench,
+                    use_container_width=True,
+                    column_config={
+                        "Seconds": st.column_config.NumberColumn(format="%.3f s"),
+                        "Peak MB": st.column_config.NumberColumn(format="%.1f MB"),
+                    },
+                    hide_index=True,
+                )
+
         st.divider()
         st.subheader("📤 Data Export")
         st.caption(
@@ -1513,11 +2083,16 @@ def main():
                 st.error("⚠️ 開始日は終了日より前の日付を指定してください。")
             else:
                 # データのフィルタリング (raw_dfを使用)
-                # raw_df["ds"] は datetime型なので、.dt.date で日付比較
-                mask = (raw_df["ds"].dt.date >= ex_start) & (
-                    raw_df["ds"].dt.date <= ex_end
+                # 取得済み期間より前を含む場合は、古い期間を追加取得する
+                loaded_since = supabase_db.loaded_since()
+                ex_df = raw_df
+                if loaded_since is not None and ex_start < loaded_since:
+                    ex_df = supabase_db.fetch_full_history()
+                # ex_df["ds"] は datetime型なので、.dt.date で日付比較
+                mask = (ex_df["ds"].dt.date >= ex_start) & (
+                    ex_df["ds"].dt.date <= ex_end
                 )
-                export_df = raw_df.loc[mask].copy()
+                export_df = ex_df.loc[mask].copy()
 
                 if not export_df.empty:
                     # 必要なカラムのみ抽出・リネーム
@@ -0,0 +1,135 @@
+import asyncio
+import queue
+
+# --- 変更通知フィード ---
+# テーブルの変更 (INSERT / UPDATE / DELETE) を受け取り、run(on_change, on_status) で通知する。
+#   on_change(change): change = {"table", "type", "record", "old_record"}
+#   on_status(status, error): "live" (購読中) / "dropped" (切断、error は原因)
+# 本番は Supabase Realtime、テストやローカル環境では LocalChangeFeed を使う。
+WATCH_TABLES = ("daily_logs", "settings", "food_master", "menu_master")
+
+
+def _normalize(payload):
+    data = payload["data"]
+    return {
+        "table": data["table"],
+        "type": str(getattr(data["type"], "value", data["type"])),
+        "record": data.get("record") or None,
+        "old_record": data.get("old_record") or None,
+    }
+
+
+class SupabaseRealtimeFeed:
+    """
+    Supabase Realtime (Postgres Changes) の購読
+    切断・購読エラー時は "dropped" を通知し、間隔を空けて (最大 retry_max 秒) 接続し直す
+    """
+
+    def __init__(
+        self,
+        url,
+        key,
+        tables=WATCH_TABLES,
+        retry_min=2,
+        retry_max=60,
+        health_interval=5,
+    ):
+        self.url = f"{url.rstrip('/')}/realtime/v1"
+        self.key = key
+        self.tables = tables
+        self.retry_min = retry_min
+        self.retry_max = retry_max
+        self.health_interval = health_interval
+
+    def run(self, on_change, on_status):
+        asyncio.run(self._run_forever(on_change, on_status))
+
+    async def _run_forever(self, on_change, on_status):
+        retry = self.retry_min
+        while True:
+            try:
+                await self._session(on_change, on_status)
+            except Exception as e:
+                on_status("dropped", e)
+            await asyncio.sleep(retry)
+            retry = min(retry * 2, self.retry_max)
+
+    async def _session(self, on_change, on_status):
+        # 1回分の接続。切断されるまで戻らない (切断時は例外)
+        from realtime import AsyncRealtimeClient
+
+        client = AsyncRealtimeClient(self.url, token=self.key, auto_reconnect=False)
+        dropped = asyncio.Event()
+        errors = []
+
+        def on_subscribe(state, error):
+            if state == "SUBSCRIBED":
+                on_status("live", None)
+            else:
+                errors.append(error or ConnectionError(f"realtime {state}"))
+                dropped.set()
+
+        try:
+            await client.connect()
+            channel = client.channel("bodymake-dashboard")
+            for table in self.tables:
+                channel.on_postgres_changes(
+                    "*",
+                    callback=lambda payload: on_change(_normalize(payload)),
+                    table=table,
+                    schema="public",
+                )
+            await channel.subscribe(on_subscribe)
+            # 接続が切れていないか定期的に確認する
+            while client.is_connected and not dropped.is_set():
+                try:
+                    await asyncio.wait_for(dropped.wait(), self.health_interval)
+                except asyncio.TimeoutError:
+                    pass
+            raise errors[0] if errors else ConnectionError("realtime connection closed")
+        finally:
+            try:
+                await client.close()
+            except Exception:
+                pass
+
+
+class LocalChangeFeed:
+    """
+    テスト・ローカル環境用の変更フィード (ネットワーク不要)
+    publish() した変更を購読側へそのまま届ける。drop() / restore() で切断・再接続を再現する
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+
+    def publish(self, table, type, record=None, old_record=None):
+        change = {
+            "table": table,
+            "type": type,
+            "record": record,
+            "old_record": old_record,
+        }
+        self._queue.put(("change", change))
+
+    def drop(self, error=None):
+        self._queue.put(("dropped", error or ConnectionError("local feed dropped")))
+
+    def restore(self):
+        self._queue.put(("live", None))
+
+    def wait(self):
+        """publish() 済みの変更がすべて反映されるまで待つ"""
+        self._queue.join()
+
+    def run(self, on_change, on_status):
+        on_status("live", None)
+        while True:
+            kind, payload = self._queue.get()
+            try:
+                if kind == "change":
+                    on_change(payload)
+                else:
+                    on_status(kind, payload)
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,308 @@
+import multiprocessing as mp
+import os
+import pickle
+import threading
+import time
+from collections import deque
+
+# --- バックグラウンド学習ジョブ (プロセス全体の学習スケジューラ) ---
+# 予測モデルの学習を別プロセスで実行し、画面描画をブロックしない。
+# ジョブはプロセス全体で共有され、同じキーの要求は1つのジョブにまとめられる。
+# 同時実行数・待ち行列の長さ・ジョブあたりのスレッド数を制限し、
+# 複数セッションが同時に学習してもCPUを奪い合わないようにする。
+
+# 同時に学習するジョブ数 (NeuralProphet / XGBoost 共通)
+MAX_WORKERS = int(os.environ.get("FORECAST_WORKERS", "1"))
+
+# 実行待ちにできるジョブ数 (超えた分は rejected)
+MAX_QUEUE = int(os.environ.get("FORECAST_QUEUE_SIZE", "8"))
+
+# ジョブあたりのスレッド数 (torch / xgboost / BLAS)
+THREADS_PER_JOB = int(
+    os.environ.get(
+        "FORECAST_THREADS", str(max(1, (os.cpu_count() or 1) // max(1, MAX_WORKERS)))
+    )
+)
+
+# run() が結果を待つ上限 (秒)。超えたら None を返し、学習はそのまま続ける
+# (待ち行列で NeuralProphet の学習の後ろに並んでも、画面の描画を止め続けないように)
+RUN_TIMEOUT = float(os.environ.get("FORECAST_RUN_TIMEOUT", "60"))
+
+# 完了監視の間隔 (秒)
+POLL_INTERVAL = 0.5
+
+_CTX = mp.get_context("spawn")
+_LOCK = threading.Lock()
+_JOBS = {}  # key -> Job
+_QUEUE = deque()  # 実行待ちの Job
+_LAST_GOOD = {}  # group -> 最後に成功した Job
+_WAITS = deque(maxlen=100)  # 直近ジョブの待ち時間 (秒)
+# submitted: 新しく作ったジョブ数、deduplicated: 待機中・実行中のジョブに相乗りした要求数
+# (完了済みジョブの結果を返しただけの要求は数えない)
+_STATS = {"submitted": 0, "deduplicated": 0, "rejected": 0}
+_MONITOR = None
+
+
+class Job:
+    """
+    1回分の学習ジョブ (status: queued / running / done / failed / cancelled / rejected)
+    mode="process" は別プロセス (キャンセル時は終了)、mode="thread" は同一プロセスのスレッドで実行
+    """
+
+    def __init__(self, key, fn, args, group, mode):
+        self.key = key
+        self.fn = fn
+        self.args = args
+        self.group = group
+        self.mode = mode
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._proc = None
+        self._conn = None
+        self._done = threading.Event()
+
+    @property
+    def finished(self):
+        return self.status in ("done", "failed", "cancelled", "rejected")
+
+    @property
+    def wait_seconds(self):
+        """投入から実行開始まで (未開始なら現在まで) の待ち時間"""
+        start = self.started_at or self.finished_at or time.time()
+        return start - self.submitted_at
+
+    def wait(self, timeout=None):
+        """完了まで待機し、完了していれば True を返す"""
+        return self._done.wait(timeout)
+
+
+def _apply_thread_budget(n_threads):
+    # torch / BLAS は import 時 (初期化時) に環境変数を読むため、学習コードの import 前に設定する
+    for var in (
+        "OMP_NUM_THREADS",
+        "MKL_NUM_THREADS",
+        "OPENBLAS_NUM_THREADS",
+        "NUMEXPR_NUM_THREADS",
+    ):
+        os.environ[var] = str(n_threads)
+
+
+def _worker(conn, payload, n_threads):
+    # fn・args は pickle 済みのバイト列で受け取る。spawn が引数を復元する時点で
+    # fn のモジュール (logic → numpy など) が import されると、スレッド数の設定が効かないため
+    _apply_thread_budget(n_threads)
+    try:
+        fn, args = pickle.loads(payload)
+        conn.send(("ok", fn(*args)))
+    except Exception as e:
+        conn.send(("error", f"{type(e).__name__}: {e}"))
+    finally:
+        conn.close()
+
+
+def _thread_worker(job):
+    try:
+        result, error = job.fn(*job.args), None
+    except Exception as e:
+        result, error = None, f"{type(e).__name__}: {e}"
+    with _LOCK:
+        if job.status == "running":
+            if error is None:
+                _finish(job, "done", result=result)
+            else:
+                _finish(job, "failed", error=error)
+    _reap()
+
+
+def _start(job):
+    job.status = "running"
+    job.started_at = time.time()
+    _WAITS.append(job.wait_seconds)
+    if job.mode == "thread":
+        threading.Thread(target=_thread_worker, args=(job,), daemon=True).start()
+        return
+    parent, child = _CTX.Pipe(duplex=False)
+    proc = _CTX.Process(
+        target=_worker,
+        args=(child, pickle.dumps((job.fn, job.args)), THREADS_PER_JOB),
+        daemon=True,
+    )
+    proc.start()
+    child.close()
+    job._proc, job._conn = proc, parent
+
+
+def _finish(job, status, result=None, error=None):
+    """
+    ジョブを完了させる。_LOCK 保持中に呼ぶ
+    Returns: 終了を待つべき学習プロセス (なければ None)。_LOCK を放してから _join() に渡す
+    (終了の遅いプロセスを待つ間、他のセッションの submit・stats・cancel を止めないため)
+    """
+    job.status = status
+    job.result = result
+    job.error = error
+    job.finished_at = time.time()
+    if job._conn is not None:
+        job._conn.close()
+    proc = job._proc
+    job._proc, job._conn = None, None
+    if status == "done":
+        _LAST_GOOD[job.group] = job
+    job._done.set()
+    return proc
+
+
+def _join(procs):
+    for proc in procs:
+        if proc is not None:
+            proc.join(timeout=1)
+
+
+def _reap():
+    """完了したジョブを回収し、空いた枠で待ち行列のジョブを開始する"""
+    finished = []
+    with _LOCK:
+        running = [
+            j for j in _JOBS.values() if j.status == "running" and j.mode == "process"
+        ]
+        for job in running:
+            if job._conn.poll():
+                try:
+                    kind, payload = job._conn.recv()
+                except (EOFError, OSError):
+                    kind, payload = "error", "worker exited without result"
+                if kind == "ok":
+                    finished.append(_finish(job, "done", result=payload))
+                else:
+                    finished.append(_finish(job, "failed", error=payload))
+            elif not job._proc.is_alive():
+                error = f"worker exited ({job._proc.exitcode})"
+                finished.append(_finish(job, "failed", error=error))
+
+        n_running = sum(1 for j in _JOBS.values() if j.status == "running")
+        while _QUEUE and n_running < MAX_WORKERS:
+            job = _QUEUE.popleft()
+            if job.status == "queued":
+                _start(job)
+                n_running += 1
+    _join(finished)
+
+
+def _monitor():
+    while True:
+        try:
+            _reap()
+        except Exception:
+            pass
+        time.sleep(POLL_INTERVAL)
+
+
+def _ensure_monitor():
+    global _MONITOR
+    if _MONITOR is None or not _MONITOR.is_alive():
+        _MONITOR = threading.Thread(target=_monitor, name="forecast-jobs", daemon=True)
+        _MONITOR.start()
+
+
+# --- 1. ジョブ投入 ---
+def submit(key, fn, *args, group="default", force=False, mode="process"):
+    """
+    key のジョブを投入する。同じ key のジョブがあればそれを返す (重複学習しない)
+    force=True の場合は失敗・キャンセル・拒否済みのジョブを作り直す
+    待ち行列が MAX_QUEUE に達している場合は status="rejected" のジョブを返す
+    """
+    _ensure_monitor()
+    with _LOCK:
+        job = _JOBS.get(key)
+        retryable = ("failed", "cancelled", "rejected")
+        if job is not None and not (force and job.status in retryable):
+            if not job.finished:
+                _STATS["deduplicated"] += 1
+            return job
+        _STATS["submitted"] += 1
+
+        # 同じグループの完了済みジョブは破棄 (結果は _LAST_GOOD に残る)
+        for other in list(_JOBS.values()):
+            if other.group == group and other.key != key and other.finished:
+                del _JOBS[other.key]
+
+        job = Job(key, fn, args, group, mode)
+        _JOBS[key] = job
+        if sum(1 for j in _QUEUE if j.status == "queued") >= MAX_QUEUE:
+            _STATS["rejected"] += 1
+            _finish(job, "rejected", error="training queue is full")
+            return job
+        _QUEUE.append(job)
+    _reap()
+    return job
+
+
+def run(key, fn, *args, group="default", timeout=RUN_TIMEOUT):
+    """
+    同一プロセスのスレッドで実行し、完了まで待って結果を返す (XGBoost 等の短い学習用)
+    同じ key のジョブがあればその結果を共有する。失敗・拒否・timeout 秒以内に終わらない時は None
+    (待ちきれなかったジョブは続行し、次回の同じ key の呼び出しで結果を受け取る)
+    """
+    job = submit(key, fn, *args, group=group, force=True, mode="thread")
+    job.wait(timeout)
+    return job.result if job.status == "done" else None
+
+
+def get(key):
+    with _LOCK:
+        return _JOBS.get(key)
+
+
+# --- 2. キャンセル ---
+def _cancel(job):
+    if job.status == "running" and job.mode == "process":
+        job._proc.terminate()
+    return _finish(job, "cancelled")
+
+
+def cancel(key):
+    """実行中・待機中のジョブを止める (実行中なら学習プロセスを終了する)"""
+    with _LOCK:
+        job = _JOBS.get(key)
+        if job is None or job.finished:
+            return False
+        proc = _cancel(job)
+    _join([proc])
+    return True
+
+
+# --- 3. 直近の成功結果 (Stale-While-Revalidate 用) ---
+def last_good(group="default"):
+    """group で最後に成功したジョブを返す (なければ None)"""
+    with _LOCK:
+        return _LAST_GOOD.get(group)
+
+
+# --- 4. 混雑状況 ---
+def queue_position(key):
+    """待ち行列内の順番 (1始まり)。待機中でなければ None"""
+    with _LOCK:
+        waiting = [j.key for j in _QUEUE if j.status == "queued"]
+    return waiting.index(key) + 1 if key in waiting else None
+
+
+def stats():
+    """待ち行列の深さ・実行数・待ち時間などの統計"""
+    with _LOCK:
+        queued = [j for j in _QUEUE if j.status == "queued"]
+        waits = list(_WAITS)
+        return {
+            "running": sum(1 for j in _JOBS.values() if j.status == "running"),
+            "queued": len(queued),
+            "max_workers": MAX_WORKERS,
+            "max_queue": MAX_QUEUE,
+            "threads_per_job": THREADS_PER_JOB,
+            "oldest_wait_s": max((j.wait_seconds for j in queued), default=0.0),
+            "avg_wait_s": sum(waits) / len(waits) if waits else 0.0,
+            "max_wait_s": max(waits, default=0.0),
+            **_STATS,
+        }
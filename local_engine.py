@@ -0,0 +1,253 @@
+import io
+import json
+import os
+import sqlite3
+import threading
+
+import pandas as pd
+
+# --- 組み込みストレージエンジン (SQLite) ---
+# Supabase と同じテーブル構造を1つの SQLite ファイルに持ち、supabase_db から Supabase の代わりに使う。
+# ネットワークを介さないため、負荷試験・ベンチマークや大量データのローカル運用に向く。
+#
+# ストレージバックエンドの interface は、supabase_db が使う supabase-py クライアントの範囲:
+#   client.table(name)
+#       .select(columns="*", count=None)    count="exact" で絞り込み後の総件数を response.count に返す
+#       .gte(column, value) / .lt(column, value)
+#       .order(column, desc=False)
+#       .range(start, end) / .limit(n)
+#       .csv()                              response.data を CSV 文字列で返す
+#       .upsert(records, on_conflict=key)   書き込んだ行を response.data に返す
+#       .execute()                          -> response (.data, .count)
+# これを満たすクライアントなら init_connection() の戻り値として差し替えられる。
+ENGINE_PATH = os.environ.get("LOCAL_ENGINE_PATH", ".local_engine.sqlite3")
+
+# Supabase (README の初期化クエリ) と同じ列・一意キー。id は UUID の代わりにランダムな16進文字列
+_ID = "id TEXT PRIMARY KEY DEFAULT (lower(hex(randomblob(16))))"
+SCHEMA = {
+    "daily_logs": (
+        f"{_ID}, log_date TEXT UNIQUE NOT NULL, weight REAL NOT NULL, "
+        "calories INTEGER DEFAULT 0, protein REAL DEFAULT 0, fat REAL DEFAULT 0, "
+        "carbs REAL DEFAULT 0, note TEXT, created_at TEXT, updated_at TEXT"
+    ),
+    "food_master": (
+        f"{_ID}, name TEXT UNIQUE NOT NULL, calories INTEGER DEFAULT 0, "
+        "protein REAL DEFAULT 0, fat REAL DEFAULT 0, carbs REAL DEFAULT 0, "
+        "category TEXT DEFAULT 'General'"
+    ),
+    "menu_master": f"{_ID}, name TEXT UNIQUE NOT NULL, recipe TEXT",
+    "settings": "key TEXT PRIMARY KEY, value_num REAL, value_str TEXT",
+}
+# JSONB 列 (JSON 文字列で保存し、読み出し時に戻す)
+JSON_COLUMNS = {"menu_master": ("recipe",)}
+# 時刻の列 (比較できるよう、常に UTC・マイクロ秒付きの ISO 8601 で保存する)
+TIMESTAMP_COLUMNS = ("created_at", "updated_at")
+
+
+def _timestamp(value=None):
+    ts = pd.Timestamp.now(tz="UTC") if value is None else pd.Timestamp(value)
+    ts = ts.tz_localize("UTC") if ts.tzinfo is None else ts.tz_convert("UTC")
+    return ts.strftime("%Y-%m-%dT%H:%M:%S.%f+00:00")
+
+
+class _Response:
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+
+class _Query:
+    """1回分のクエリ (supabase-py のクエリビルダと同じく、メソッドをつなげて execute() で実行)"""
+
+    def __init__(self, engine, table):
+        self.engine = engine
+        self.table = table
+        self.columns = engine.columns(table)
+        self._select = None
+        self._count = None
+        self._where = []
+        self._params = []
+        self._order = []
+        self._limit = None
+        self._offset = None
+        self._csv = False
+        self._upsert = None
+
+    def _column(self, name):
+        if name not in self.columns:
+            raise ValueError(f"{self.table}: unknown column {name!r}")
+        return name
+
+    def _value(self, column, value):
+        return _timestamp(value) if column in TIMESTAMP_COLUMNS else value
+
+    def select(self, columns="*", count=None):
+        names = [c.strip() for c in columns.split(",")]
+        self._select = list(self.columns) if names == ["*"] else names
+        for name in self._select:
+            self._column(name)
+        self._count = count
+        return self
+
+    def gte(self, column, value):
+        self._where.append(f"{self._column(column)} >= ?")
+        self._params.append(self._value(column, value))
+        return self
+
+    def lt(self, column, value):
+        self._where.append(f"{self._column(column)} < ?")
+        self._params.append(self._value(column, value))
+        return self
+
+    def order(self, column, desc=False):
+        self._order.append(f"{self._column(column)} {'DESC' if desc else 'ASC'}")
+        return self
+
+    def range(self, start, end):
+        self._offset, self._limit = start, end - start + 1
+        return self
+
+    def limit(self, n):
+        self._limit = n
+        return self
+
+    def csv(self):
+        self._csv = True
+        return self
+
+    def upsert(self, records, on_conflict=None):
+        self._upsert = (records, on_conflict)
+        return self
+
+    def execute(self):
+        if self._upsert is not None:
+            return _Response(self.engine.upsert(self.table, *self._upsert))
+        return self._read()
+
+    def _read(self):
+        where = f" WHERE {' AND '.join(self._where)}" if self._where else ""
+        sql = f"SELECT {', '.join(self._select)} FROM {self.table}{where}"
+        if self._order:
+            sql += f" ORDER BY {', '.join(self._order)}"
+        if self._limit is not None or self._offset is not None:
+            sql += f" LIMIT {int(-1 if self._limit is None else self._limit)}"
+            sql += f" OFFSET {int(self._offset or 0)}"
+
+        conn = self.engine.connection()
+        count = None
+        if self._count:
+            count_sql = f"SELECT COUNT(*) FROM {self.table}{where}"
+            count = conn.execute(count_sql, self._params).fetchone()[0]
+        cur = conn.execute(sql, self._params)
+        rows = cur.fetchall()
+
+        if self._csv:
+            # 空の結果でもヘッダ行は返す (列名付きの空の DataFrame として読めるように)
+            frame = pd.DataFrame(rows, columns=self._select)
+            buf = io.StringIO()
+            frame.to_csv(buf, index=False)
+            return _Response(buf.getvalue(), count)
+        records = [self.engine.decode(self.table, self._select, r) for r in rows]
+        return _Response(records, count)
+
+
+class LocalEngine:
+    """
+    Supabase の代わりに使う組み込みエンジン (1ファイルの SQLite)
+    接続はスレッドごとに持つ (ページの並列取得・バックグラウンドの書き込みから同時に使われるため)
+    """
+
+    def __init__(self, path=None):
+        self.path = path or ENGINE_PATH
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        with self.connection() as conn:
+            # 読み取りと書き込みが互いを待たないよう WAL にする
+            conn.execute("PRAGMA journal_mode=WAL")
+            for table, columns in SCHEMA.items():
+                conn.execute(f"CREATE TABLE IF NOT EXISTS {table} ({columns})")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS daily_logs_updated_at "
+                "ON daily_logs (updated_at)"
+            )
+        self._columns = {
+            table: [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+            for table in SCHEMA
+        }
+
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._local.conn = conn
+        return conn
+
+    def columns(self, table):
+        if table not in SCHEMA:
+            raise ValueError(f"unknown table {table!r}")
+        return self._columns[table]
+
+    def table(self, name):
+        return _Query(self, name)
+
+    def decode(self, table, columns, row):
+        record = dict(zip(columns, row))
+        for column in JSON_COLUMNS.get(table, ()):
+            if record.get(column) is not None:
+                record[column] = json.loads(record[column])
+        return record
+
+    def upsert(self, table, records, on_conflict=None):
+        """
+        records を一意キー (on_conflict) で Upsert し、書き込んだ行を返す
+        daily_logs は Supabase のトリガーと同じく、更新時にも updated_at を進める
+        """
+        if not records:
+            return []
+        columns = self.columns(table)
+        key = on_conflict or ("key" if table == "settings" else "name")
+        names = list(dict.fromkeys(k for record in records for k in record))
+        for name in names + [key]:
+            if name not in columns:
+                raise ValueError(f"{table}: unknown column {name!r}")
+        if "updated_at" in columns:
+            names = [n for n in names if n not in TIMESTAMP_COLUMNS]
+            names += ["created_at", "updated_at"]
+
+        now = _timestamp()
+        values = []
+        for record in records:
+            row = []
+            for name in names:
+                value = record.get(name)
+                if name in TIMESTAMP_COLUMNS:
+                    value = now
+                elif name in JSON_COLUMNS.get(table, ()) and value is not None:
+                    value = json.dumps(value, ensure_ascii=False)
+                row.append(value)
+            values.append(row)
+
+        # created_at は最初の登録時のまま残す
+        updates = [f"{n} = excluded.{n}" for n in names if n not in (key, "created_at")]
+        sql = (
+            f"INSERT INTO {table} ({', '.join(names)}) "
+            f"VALUES ({', '.join('?' * len(names))}) "
+            f"ON CONFLICT ({key}) DO "
+            + (f"UPDATE SET {', '.join(updates)}" if updates else "NOTHING")
+        )
+        keys = [record[key] for record in records]
+        conn = self.connection()
+        with self._write_lock, conn:
+            conn.executemany(sql, values)
+            cur = conn.execute(
+                f"SELECT {', '.join(columns)} FROM {table} "
+                f"WHERE {key} IN ({', '.join('?' * len(keys))})",
+                keys,
+            )
+            rows = cur.fetchall()
+        return [self.decode(table, columns, row) for row in rows]
+
+
+def connect(path=None):
+    """組み込みエンジンを開く (ファイルとテーブルがなければ作る)"""
+    return LocalEngine(path)
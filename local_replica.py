@@ -0,0 +1,222 @@
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+
+# --- Supabase テーブルのローカル複製 (SQLite) ---
+# 起動直後は前回同期したデータで即座に描画し、通信はバックグラウンドで行う。
+# Supabase に接続できない間も、ここに残ったデータで閲覧 (読み取り専用) を続けられる。
+REPLICA_PATH = os.environ.get("LOCAL_REPLICA_PATH", ".local_replica.sqlite3")
+
+# 複製するテーブルと一意キー
+TABLE_KEYS = {
+    "daily_logs": "log_date",
+    "food_master": "name",
+    "menu_master": "name",
+    "settings": "key",
+}
+
+_LOCK = threading.Lock()
+
+
+def _connect():
+    conn = sqlite3.connect(REPLICA_PATH, timeout=10)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS rows ("
+        "tbl TEXT NOT NULL, key TEXT NOT NULL, data TEXT NOT NULL, "
+        "PRIMARY KEY (tbl, key))"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS sync_meta ("
+        "tbl TEXT PRIMARY KEY, synced_at REAL NOT NULL, meta TEXT)"
+    )
+    # 未送信の書き込み (同じキーへの書き込みは最新の1件にまとめる)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS journal ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, tbl TEXT NOT NULL, key TEXT NOT NULL, "
+        "data TEXT NOT NULL, queued_at REAL NOT NULL, UNIQUE (tbl, key))"
+    )
+    # サーバに拒否された (送り直しても成功しない) 書き込み。ユーザーが再送か破棄を選ぶまで残す
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS quarantine ("
+        "id INTEGER PRIMARY KEY, tbl TEXT NOT NULL, key TEXT NOT NULL, "
+        "data TEXT NOT NULL, queued_at REAL NOT NULL, failed_at REAL NOT NULL, "
+        "error TEXT)"
+    )
+    return conn
+
+
+@contextlib.contextmanager
+def _session():
+    # 書き込みはトランザクションでまとめ、接続は毎回閉じる (スレッド間で共有しない)
+    with _LOCK:
+        conn = _connect()
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+
+def _encode(table, rows):
+    key = TABLE_KEYS[table]
+    if isinstance(rows, pd.DataFrame):
+        # 一括取得した DataFrame は列ごとにまとめて JSON 化する
+        if rows.empty:
+            return []
+        data = rows.to_json(orient="records", lines=True, force_ascii=False)
+        return list(zip([table] * len(rows), rows[key].astype(str), data.splitlines()))
+    return [(table, str(r[key]), json.dumps(r, default=str)) for r in rows]
+
+
+def _write_meta(conn, table, meta):
+    conn.execute(
+        "INSERT OR REPLACE INTO sync_meta (tbl, synced_at, meta) VALUES (?, ?, ?)",
+        (table, time.time(), json.dumps(meta or {})),
+    )
+
+
+# --- 1. 取得 (Read) ---
+def load_table(table):
+    """
+    複製済みの行 (Supabase の応答と同じ dict のリスト、キー順) を返す
+    Returns: (rows, meta) or (None, None) 未同期・読み込み失敗時
+    """
+    try:
+        with _session() as conn:
+            synced = conn.execute(
+                "SELECT meta FROM sync_meta WHERE tbl = ?", (table,)
+            ).fetchone()
+            if synced is None:
+                return None, None
+            cur = conn.execute(
+                "SELECT data FROM rows WHERE tbl = ? ORDER BY key", (table,)
+            )
+            rows = [json.loads(data) for (data,) in cur]
+        return rows, json.loads(synced[0] or "{}")
+    except (sqlite3.Error, ValueError):
+        return None, None
+
+
+def status():
+    """テーブルごとの行数と最終同期時刻 (UNIX 秒)"""
+    try:
+        with _session() as conn:
+            counts = dict(
+                conn.execute("SELECT tbl, COUNT(*) FROM rows GROUP BY tbl").fetchall()
+            )
+            synced = dict(conn.execute("SELECT tbl, synced_at FROM sync_meta"))
+    except sqlite3.Error:
+        return {}
+    return {
+        table: {"rows": counts.get(table, 0), "synced_at": synced.get(table)}
+        for table in TABLE_KEYS
+    }
+
+
+# --- 2. 保存 (Replace / Upsert) ---
+# 複製の書き込み失敗は致命的ではない (次回の同期で取り直す) ため、例外は握りつぶす
+def save_table(table, rows, meta=None):
+    """テーブル全体を rows で置き換える (全件取得時)"""
+    try:
+        with _session() as conn:
+            conn.execute("DELETE FROM rows WHERE tbl = ?", (table,))
+            conn.executemany(
+                "INSERT INTO rows (tbl, key, data) VALUES (?, ?, ?)",
+                _encode(table, rows),
+            )
+            _write_meta(conn, table, meta)
+    except sqlite3.Error:
+        pass
+
+
+def upsert_rows(table, rows, meta=None):
+    """変更のあった行だけを書き込む (差分同期時)"""
+    try:
+        with _session() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO rows (tbl, key, data) VALUES (?, ?, ?)",
+                _encode(table, rows),
+            )
+            _write_meta(conn, table, meta)
+    except sqlite3.Error:
+        pass
+
+
+def delete_rows(table, keys):
+    """削除された行を除く (変更通知で削除を受け取った時)"""
+    try:
+        with _session() as conn:
+            conn.executemany(
+                "DELETE FROM rows WHERE tbl = ? AND key = ?",
+                [(table, str(key)) for key in keys],
+            )
+    except sqlite3.Error:
+        pass
+
+
+# --- 3. 書き込みジャーナル (Write-Behind) ---
+# 書き込みは Supabase へ送る前にここへ記録し、送信に成功したら消す。
+# 複製と違い、失敗を握りつぶすとユーザーの入力が失われるため例外はそのまま投げる
+def journal_put(table, record):
+    """書き込みを記録し、エントリ ID を返す (同じキーの未送信分は置き換える)"""
+    key = str(record[TABLE_KEYS[table]])
+    with _session() as conn:
+        cur = conn.execute(
+            "INSERT OR REPLACE INTO journal (tbl, key, data, queued_at) "
+            "VALUES (?, ?, ?, ?)",
+            (table, key, json.dumps(record, default=str), time.time()),
+        )
+        return cur.lastrowid
+
+
+def journal_load():
+    """未送信の書き込み [(id, table, record), ...] (記録順)"""
+    with _session() as conn:
+        cur = conn.execute("SELECT id, tbl, data FROM journal ORDER BY id")
+        return [(entry_id, table, json.loads(data)) for entry_id, table, data in cur]
+
+
+def journal_delete(entry_ids):
+    """送信済みのエントリを消す (ID が一致するものだけ: 送信中に上書きされた分は残す)"""
+    with _session() as conn:
+        conn.executemany(
+            "DELETE FROM journal WHERE id = ?", [(entry_id,) for entry_id in entry_ids]
+        )
+
+
+def journal_quarantine(entry_id, error):
+    """エントリをジャーナルから隔離領域へ移す (サーバに拒否された書き込み)"""
+    with _session() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO quarantine "
+            "(id, tbl, key, data, queued_at, failed_at, error) "
+            "SELECT id, tbl, key, data, queued_at, ?, ? FROM journal WHERE id = ?",
+            (time.time(), error, entry_id),
+        )
+        conn.execute("DELETE FROM journal WHERE id = ?", (entry_id,))
+
+
+def quarantine_load():
+    """隔離中の書き込み [(id, table, record, error, failed_at), ...] (古い順)"""
+    with _session() as conn:
+        cur = conn.execute(
+            "SELECT id, tbl, data, error, failed_at FROM quarantine ORDER BY id"
+        )
+        return [
+            (entry_id, table, json.loads(data), error, failed_at)
+            for entry_id, table, data, error, failed_at in cur
+        ]
+
+
+def quarantine_delete(entry_ids):
+    """隔離中の書き込みを消す (破棄・再送時)"""
+    with _session() as conn:
+        conn.executemany(
+            "DELETE FROM quarantine WHERE id = ?",
+            [(entry_id,) for entry_id in entry_ids],
+        )
@@ -1,72 +1,331 @@
+import functools
+import importlib
+import json
+import subprocess
+import sys
+import threading
+import time
+
 import numpy as np
 import pandas as pd
 import streamlit as st
-import xgboost as xgb
-from neuralprophet import NeuralProphet
-from sklearn.linear_model import LinearRegression
+
+import forecast_jobs
+import model_store
+
+# --- 重い依存ライブラリの遅延読み込み (Model Registry) ---
+# neuralprophet (torch), xgboost は起動時に読み込まず、初めて使う時に import する
+ENGINE_MODULES = {
+    "neural": "neuralprophet",
+    "xgboost": "xgboost",
+}
+_ENGINES = {}  # name -> module
+_ENGINE_IMPORT_SECONDS = {}  # name -> このプロセスでの import 所要時間
+_ENGINE_LOCK = threading.Lock()
+
+
+def load_engine(name):
+    """エンジンのモジュールを返す (初回のみ import し、所要時間を記録する)"""
+    with _ENGINE_LOCK:
+        if name not in _ENGINES:
+            t0 = time.perf_counter()
+            _ENGINES[name] = importlib.import_module(ENGINE_MODULES[name])
+            _ENGINE_IMPORT_SECONDS[name] = time.perf_counter() - t0
+        return _ENGINES[name]
+
+
+def measure_engine_import(name, timeout=120):
+    """新しいプロセスでエンジンを import し、コールドスタート時の所要時間 (秒) を返す"""
+    code = (
+        "import time; t = time.perf_counter(); "
+        f"import {ENGINE_MODULES[name]}; print(time.perf_counter() - t)"
+    )
+    try:
+        out = subprocess.run(
+            [sys.executable, "-c", code],
+            capture_output=True,
+            text=True,
+            timeout=timeout,
+            check=True,
+        )
+        return float(out.stdout.strip().splitlines()[-1])
+    except Exception:
+        return None
+
+
+def engine_import_report(measure=False):
+    """
+    起動時間レポート: エンジンごとの import 状況と所要時間
+    measure=True の場合は別プロセスでのコールド import 時間も計測する
+    """
+    rows = []
+    for name, module in ENGINE_MODULES.items():
+        with _ENGINE_LOCK:
+            loaded = name in _ENGINES
+            seconds = _ENGINE_IMPORT_SECONDS.get(name)
+        row = {
+            "Engine": name,
+            "Module": module,
+            "Loaded": loaded,
+            "Import (s)": seconds,
+        }
+        if measure:
+            row["Cold Import (s)"] = measure_engine_import(name)
+        rows.append(row)
+    return pd.DataFrame(rows)
 
 
 # --- データ加工 (TDEE計算など) ---
-def enrich_data(df, target_date_obj):
-    if df.empty:
-        return df
+# 窓幅 (体重/カロリー移動平均, TDEE平滑化)
+MA_WINDOW = 10
+TDEE_SMOOTH_WINDOW = 7
+SMA_WINDOW = 7
 
-    # 日付重複排除
-    df = df.drop_duplicates(subset=["ds"], keep="last")
+# 体重 1kg あたりのエネルギー量 (7200kcal = 1kg脂肪)。TDEE の逆算とシミュレーションで共通
+# ※ バッファとして水分変動などは無視し、純粋なエネルギー保存則で計算
+# 選手ごとの値は calibrate_metabolism で記録から求める
+KCAL_PER_KG = 7200.0
 
-    # 日付ソートを保証
-    df = df.sort_values("ds")
+# 差分再計算時に遡る日数: 変更日の出力は (10日MA + diff 1日 + 7日平滑) の入力に依存する
+ENRICH_LOOKBACK = MA_WINDOW + TDEE_SMOOTH_WINDOW
 
-    # 1. TDEE Reverse Engineering
-    df_c = df.set_index("ds").asfreq("D").ffill().reset_index()
 
-    # 移動平均 (Weight & Calories)
-    df_c["w_ma"] = df_c["y"].rolling(window=10, min_periods=1).mean()
+def _rolling_mean(values, window):
+    """
+    rolling(window, min_periods=1).mean() と同値の移動平均。
+    窓ごとに独立して集計するため、末尾だけ再計算しても全件計算と同じ値になる
+    """
+    v = np.asarray(values, dtype="float64")
+    if len(v) == 0:
+        return v
+    padded = np.concatenate([np.full(window - 1, np.nan), v])
+    win = np.lib.stride_tricks.sliding_window_view(padded, window)
+    valid = ~np.isnan(win)
+    count = valid.sum(axis=1)
+    total = np.where(valid, win, 0.0).sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(count > 0, total / count, np.nan)
+
+
+def _calc_tdee_columns(df_c, start=0, kcal_per_kg=KCAL_PER_KG):
+    """
+    日次フレーム df_c の start 行目以降について TDEE 関連列を計算して返す。
+    start より前の ENRICH_LOOKBACK 行を入力として参照する
+    """
+    lo = max(start - ENRICH_LOOKBACK, 0)
+    y = df_c["y"].to_numpy(dtype="float64")[lo:]
     if "Calories" in df_c.columns:
-        df_c["c_ma"] = df_c["Calories"].rolling(window=10, min_periods=1).mean()
+        cal = df_c["Calories"].to_numpy(dtype="float64")[lo:]
     else:
-        df_c["c_ma"] = 0
+        cal = None
+
+    # 移動平均 (Weight & Calories)
+    w_ma = _rolling_mean(y, MA_WINDOW)
+    c_ma = (
+        _rolling_mean(cal, MA_WINDOW)
+        if cal is not None
+        else np.zeros(len(y), dtype=int)
+    )
+
+    # 体重変化量とTDEE計算 (体重 1kg あたり kcal_per_kg)
+    w_delta_smooth = np.concatenate([[np.nan], np.diff(w_ma)])
+    real_tdee = c_ma - (w_delta_smooth * kcal_per_kg)
+    real_tdee_smooth = _rolling_mean(real_tdee, TDEE_SMOOTH_WINDOW)
+
+    cut = start - lo
+    return {
+        "w_ma": w_ma[cut:],
+        "c_ma": c_ma[cut:],
+        "w_delta_smooth": w_delta_smooth[cut:],
+        "real_tdee": real_tdee[cut:],
+        "real_tdee_smooth": real_tdee_smooth[cut:],
+    }
+
+
+def _normalize_raw(df):
+    # 日付重複排除 & 日付ソートを保証
+    df = df.drop_duplicates(subset=["ds"], keep="last")
+    return df.sort_values("ds").reset_index(drop=True)
 
-    # 体重変化量とTDEE計算 (係数6800を採用)
-    df_c["w_delta_smooth"] = df_c["w_ma"].diff()
-    df_c["real_tdee"] = df_c["c_ma"] - (df_c["w_delta_smooth"] * 6800)
-    df_c["real_tdee_smooth"] = df_c["real_tdee"].rolling(window=7, min_periods=1).mean()
 
-    # マージ
-    df = pd.merge(df, df_c[["ds", "real_tdee_smooth", "c_ma"]], on="ds", how="left")
+def _build_enriched(df, df_c, target_date_obj):
+    # マージ (ds は日次フレーム上の位置に一意に対応する)
+    pos = (df["ds"] - df_c["ds"].iloc[0]).dt.days.to_numpy()
+    df = df.copy()
+    df["real_tdee_smooth"] = df_c["real_tdee_smooth"].to_numpy()[pos]
+    df["c_ma"] = df_c["c_ma"].to_numpy()[pos]
 
     # 2. Days Out
     target_dt = pd.to_datetime(target_date_obj)
     df["days_out"] = (df["ds"] - target_dt).dt.days
+    return df
+
+
+def _daily_frame(df, kcal_per_kg=KCAL_PER_KG):
+    # 日次に展開 (欠損日は前日値で補完) し、TDEE 関連列を付与
+    df_c = df.set_index("ds").asfreq("D").ffill().reset_index()
+    for col, values in _calc_tdee_columns(df_c, kcal_per_kg=kcal_per_kg).items():
+        df_c[col] = values
+    return df_c
+
+
+def enrich_data(df, target_date_obj, kcal_per_kg=KCAL_PER_KG):
+    if df.empty:
+        return df
+
+    df = _normalize_raw(df)
+
+    # 1. TDEE Reverse Engineering
+    df_c = _daily_frame(df, kcal_per_kg)
+    df = _build_enriched(df, df_c, target_date_obj)
 
     # 3. SMA (Simple Moving Average)
-    df["SMA_7"] = df["y"].rolling(7, 1).mean() if len(df) >= 7 else np.nan
+    df["SMA_7"] = _rolling_mean(df["y"], SMA_WINDOW) if len(df) >= 7 else np.nan
 
     return df
 
 
-# logic.py
+# --- データ加工 (差分更新版) ---
+# キー -> 前回実行時の状態 {"raw": 正規化済み生データ, "daily": 日次フレーム, "out": 出力,
+#                          "kcal_per_kg": TDEE 逆算の係数}
+_ENRICH_STATE = {}
+_ENRICH_LOCK = threading.Lock()
 
 
-# --- NeuralProphet予測 (New Main Model) ---
-@st.cache_resource
-def run_neural_model(df, target_date):
+def _first_changed_row(prev, curr):
     """
-    NeuralProphetを使用し、長期的なトレンド予測を行う
+    prev と curr を先頭から比較し、最初に異なる行の位置を返す (同一なら None)
+    列構成が異なる場合は 0 を返し、全件再計算させる
     """
-    # データ数が極端に少ない場合のガード
-    if len(df) < 5:
-        return df["y"].iloc[-1], pd.DataFrame(
-            {"ds": [pd.to_datetime(target_date)], "yhat": [df["y"].iloc[-1]]}
+    if list(prev.columns) != list(curr.columns) or any(
+        prev[c].dtype != curr[c].dtype for c in curr.columns
+    ):
+        return 0
+
+    n = min(len(prev), len(curr))
+    same = np.ones(n, dtype=bool)
+    for col in curr.columns:
+        a = prev[col].iloc[:n]
+        b = curr[col].iloc[:n]
+        same &= ((a == b) | (a.isna() & b.isna())).to_numpy()
+
+    diff = np.flatnonzero(~same)
+    if len(diff):
+        return int(diff[0])
+    if len(prev) != len(curr):
+        return n
+    return None
+
+
+def _update_daily_frame(prev_c, prev_raw, raw, changed, kcal_per_kg=KCAL_PER_KG):
+    """
+    raw の changed 行目以降が変わった場合に、日次フレームの影響範囲だけを作り直す
+    """
+    origin = prev_c["ds"].iloc[0]
+    # 再計算の起点 (日次フレーム上の位置)。削除・挿入・追記のいずれでも
+    # これより前の日は前回と同じ値になる
+    p = int((raw["ds"].iloc[changed] - origin).days)
+    if changed < len(prev_raw):
+        p = min(p, int((prev_raw["ds"].iloc[changed] - origin).days))
+    p = min(p, len(prev_c))
+    day_p = origin + pd.Timedelta(days=p)
+
+    cols = list(raw.columns)
+    days = pd.date_range(day_p, raw["ds"].iloc[-1], freq="D", name="ds")
+    tail = raw[raw["ds"] >= day_p].set_index("ds").reindex(days)
+    # 前日の値を種にして ffill (全件の ffill と同じ結果になる)
+    seed = prev_c.iloc[[p - 1]][cols].set_index("ds")
+    tail = pd.concat([seed, tail]).ffill().iloc[1:].reset_index()
+
+    df_c = pd.concat([prev_c.iloc[:p][cols], tail], ignore_index=True)
+    for col, values in _calc_tdee_columns(df_c, p, kcal_per_kg).items():
+        df_c[col] = np.concatenate([prev_c[col].to_numpy()[:p], values])
+    return df_c
+
+
+def enrich_data_incremental(
+    df, target_date_obj, key="default", kcal_per_kg=KCAL_PER_KG
+):
+    """
+    enrich_data の差分更新版。前回の計算結果を保持し、追記や1日分のUpsertがあった場合は
+    影響範囲 (変更日の ENRICH_LOOKBACK 日前以降) だけを再計算する。出力は enrich_data と同一
+    kcal_per_kg が前回と異なる場合 (再キャリブレーション後) は全件再計算する
+    """
+    if df.empty:
+        return df
+
+    raw = _normalize_raw(df)
+    target_dt = pd.to_datetime(target_date_obj)
+
+    with _ENRICH_LOCK:
+        state = _ENRICH_STATE.get(key)
+    if state is not None and state["kcal_per_kg"] != kcal_per_kg:
+        state = None
+
+    changed = None
+    if state is not None:
+        changed = _first_changed_row(state["raw"], raw)
+        # 先頭行の変更と、SMA_7 の有効/無効が切り替わる件数は全件再計算
+        if changed is not None and (
+            changed == 0 or len(raw) < 7 or len(state["raw"]) < 7
+        ):
+            state = None
+
+    if state is not None and changed is None:
+        # 変更なし (Days Out のみ目標日に合わせる)
+        out = state["out"].copy()
+        out["days_out"] = (out["ds"] - target_dt).dt.days
+        return out
+
+    if state is None:
+        df_c = _daily_frame(raw, kcal_per_kg)
+        out = _build_enriched(raw, df_c, target_dt)
+        out["SMA_7"] = _rolling_mean(out["y"], SMA_WINDOW) if len(out) >= 7 else np.nan
+    elif changed >= len(raw):
+        # 末尾の行が削除されただけなら前回の結果を切り詰める (各列はその日までの値だけで決まる)
+        prev_c = state["daily"]
+        df_c = prev_c[prev_c["ds"] <= raw["ds"].iloc[-1]].reset_index(drop=True)
+        out = state["out"].iloc[:changed].copy()
+        out["days_out"] = (out["ds"] - target_dt).dt.days
+    else:
+        df_c = _update_daily_frame(
+            state["daily"], state["raw"], raw, changed, kcal_per_kg
         )
 
-    # NeuralProphet用データ準備
-    data = df[["ds", "y"]].copy()
+        # 変更行以降の出力のみ作り直す
+        head = state["out"].iloc[:changed]
+        tail = _build_enriched(raw.iloc[changed:], df_c, target_dt)
+        lo = max(changed - (SMA_WINDOW - 1), 0)
+        sma = _rolling_mean(raw["y"].iloc[lo:], SMA_WINDOW)
+        tail["SMA_7"] = sma[changed - lo :]
+        out = pd.concat([head, tail], ignore_index=True)
+        out["days_out"] = (out["ds"] - target_dt).dt.days
+
+    with _ENRICH_LOCK:
+        _ENRICH_STATE[key] = {
+            "raw": raw,
+            "daily": df_c,
+            "out": out,
+            "kcal_per_kg": kcal_per_kg,
+        }
+    return out.copy()
+
+
+# logic.py
+
+
+# --- NeuralProphet予測 (New Main Model) ---
+# 数日分の追記であれば、保存済みモデルを数エポックだけ追加学習する
+FINETUNE_MAX_DAYS = 14
+FINETUNE_EPOCHS = 30
+
+
+def _build_neural_model():
+    NeuralProphet = load_engine("neural").NeuralProphet
 
-    # モデル構築
     # n_lags=0 に変更: 長期予測（5月まで）を行うため、直近依存(AR)をオフにする
     # これにより、過去のデータがない未来の日付でもトレンド予測が可能になる
-    m = NeuralProphet(
+    return NeuralProphet(
         n_lags=0,  # ← 【重要】長期予測のために0にする
         n_forecasts=1,
         changepoints_range=0.90,
@@ -78,15 +337,163 @@ def run_neural_model(df, target_date):
         learning_rate=0.005,  # 慎重に学習
     )
 
+
+def fit_neural_model(data, athlete="default"):
+    """
+    学習済みモデルをディスクから取得し、なければ追加学習または新規学習する
+    Returns: (model, info)  info = {"source": "cache" | "finetune" | "train", "seconds": float}
+    """
     # ログ出力を抑制
     import logging
 
     logging.getLogger("NP").setLevel(logging.ERROR)
 
-    # 学習
-    m.fit(data, freq="D", progress="bar")
+    t0 = time.perf_counter()
+    load_engine("neural")
+    fingerprint = model_store.data_fingerprint(data)
+
+    # 1. 同一データで学習済み → そのまま再利用
+    m = model_store.load_model(athlete, fingerprint)
+    if m is not None:
+        if model_store.load_params(athlete, fingerprint) is None:
+            _save_exported_model(athlete, fingerprint, m, data)
+        return m, {"source": "cache", "seconds": time.perf_counter() - t0}
+
+    # 2. 直近数日の追記のみ → 保存済みの重みから追加学習
+    source = "train"
+    m, _ = model_store.find_finetune_base(athlete, data, FINETUNE_MAX_DAYS)
+    if m is not None:
+        try:
+            m.fit(
+                data,
+                freq="D",
+                epochs=FINETUNE_EPOCHS,
+                progress=None,
+                continue_training=True,
+            )
+            source = "finetune"
+        except Exception:
+            m = None
+
+    # 3. 新規学習
+    if m is None:
+        m = _build_neural_model()
+        # checkpointing: 次回以降の追加学習 (continue_training) に必要
+        m.fit(data, freq="D", progress="bar", checkpointing=True)
+
+    model_store.save_model(athlete, fingerprint, data, m)
+    _save_exported_model(athlete, fingerprint, m, data)
+    return m, {"source": source, "seconds": time.perf_counter() - t0}
+
+
+# --- torch 不要の推論 (学習済みモデルの予測値を標本化した NumPy 近似) ---
+# n_lags=0・週周期のみの構成では、予測値 = 区分線形トレンド + 週周期 (加法) になる。
+# 変化点・フーリエ係数そのものは書き出さず、m.predict の成分を標本化する:
+#   - トレンド: 学習日ごとの値を線形補間 (変化点が学習日の間にあると、その1日の区間だけ近似になる)
+#   - 学習期間より先: 予測期間のトレンドに当てはめた直線
+#   - 週周期: 日次データでは曜日ごとの7値で決まる
+# 近似なので、元モデルとの誤差が EXPORT_TOLERANCE 以内と確認できた場合だけ保存する
+EXPORT_PROBE_DAYS = 60
+EXPORT_TOLERANCE = 1e-4  # kg
+
+
+def _day_number(ds):
+    # 1970-01-01 からの日数 (週周期の位相に使う)
+    return (pd.to_datetime(ds) - pd.Timestamp("1970-01-01")).dt.days.to_numpy()
+
+
+def export_neural_model(m, data):
+    """
+    学習済み NeuralProphet の予測成分を標本化し、推論用の近似パラメータ (NumPy 配列の dict) を返す
+    (変化点・フーリエ係数そのものではない。精度は validate_exported で確認する)
+    """
+    past = m.predict(data).drop_duplicates(subset=["ds"]).sort_values("ds")
+    future = m.predict(m.make_future_dataframe(data, periods=EXPORT_PROBE_DAYS))
+
+    t_past = _day_number(past["ds"])
+    t_future = _day_number(future["ds"])
+
+    # 学習期間より先は最終区間の直線 (float32 の丸め誤差を抑えるため最小二乗で推定)
+    slope, intercept = np.polyfit(
+        t_future - t_future[0], future["trend"].to_numpy(dtype="float64"), 1
+    )
+
+    weekly = np.full(7, np.nan)
+    weekly[t_past % 7] = past["season_weekly"].to_numpy(dtype="float64")
+    weekly[t_future % 7] = future["season_weekly"].to_numpy(dtype="float64")
+    return {
+        "knots_t": t_past.astype("float64"),
+        "knots_trend": past["trend"].to_numpy(dtype="float64"),
+        "end_t0": np.array(float(t_future[0])),
+        "end_intercept": np.array(intercept),
+        "end_slope": np.array(slope),
+        "weekly": weekly,
+    }
+
+
+def predict_exported(params, ds):
+    """export_neural_model のパラメータで予測値を計算する (torch 不要)"""
+    t = _day_number(pd.Series(ds)).astype("float64")
+    trend = np.interp(t, params["knots_t"], params["knots_trend"])
+    beyond = t > params["knots_t"][-1]
+    trend[beyond] = params["end_intercept"] + params["end_slope"] * (
+        t[beyond] - params["end_t0"]
+    )
+    return trend + params["weekly"][t.astype("int64") % 7]
+
+
+def validate_exported(params, m, data, horizon=60):
+    """元モデルの m.predict との最大絶対誤差 (学習期間 + horizon 日) を返す"""
+    future_df = m.make_future_dataframe(data, periods=horizon)
+    pred = pd.concat([m.predict(data), m.predict(future_df)], ignore_index=True)
+    err = np.abs(predict_exported(params, pred["ds"]) - pred["yhat1"].to_numpy())
+    return float(np.nanmax(err))
+
+
+def _save_exported_model(athlete, fingerprint, m, data):
+    try:
+        params = export_neural_model(m, data)
+        if np.isnan(params["weekly"]).any():
+            return
+        if validate_exported(params, m, data) > EXPORT_TOLERANCE:
+            return
+        model_store.save_params(athlete, fingerprint, params)
+    except Exception:
+        pass
+
+
+def _rename_yhat(forecast):
+    # カラム名統一 ('yhat1' -> 'yhat')
+    if "yhat1" in forecast.columns:
+        forecast = forecast.rename(columns={"yhat1": "yhat"})
+    return forecast
+
+
+@st.cache_resource(max_entries=4)
+def get_fitted_neural_model(fingerprint, athlete="default", _data=None):
+    """
+    データ版 (fingerprint) ごとに1つだけ学習済みモデルを保持する
+    目標日 (予測期間) はキーに含めないため、Goal Date を変えても再学習しない
+    """
+    m, fit_info = fit_neural_model(_data, athlete)
+    return {
+        "model": m,
+        "data": _data,
+        "info": fit_info,
+        # 過去データ(data)に対する適合値 (1回だけ計算して再利用)
+        "fitted": _rename_yhat(m.predict(_data)),
+        # 予測済みの未来期間 (より短い期間は切り出して返す)
+        "future": None,
+        "lock": threading.Lock(),
+    }
 
-    # --- 予測データの作成（過去 + 未来）---
+
+def predict_neural_model(fit, target_date):
+    """
+    学習済みモデルで目標日までを予測する (未来部分の predict のみ)
+    Returns: (目標日の予測値, 過去 + 未来の予測データ)
+    """
+    data = fit["data"]
 
     # 1. 未来の期間を計算
     target_dt = pd.to_datetime(target_date)
@@ -95,27 +502,265 @@ def run_neural_model(df, target_date):
     if future_days < 1:
         future_days = 1
 
-    # 2. 未来用の空箱を作成
-    future_df = m.make_future_dataframe(data, periods=future_days)
+    # 2. 未来データに対する予測値 (既に長い期間を予測済みなら切り出す)
+    with fit["lock"]:
+        cached = fit["future"]
+        if cached is None or len(cached) < future_days:
+            future_df = fit["model"].make_future_dataframe(data, periods=future_days)
+            cached = _rename_yhat(fit["model"].predict(future_df))
+            fit["future"] = cached
+    forecast_future = cached.iloc[:future_days]
 
-    # 3. 予測実行
-    # 過去データ(data)に対する適合値
-    forecast_train = m.predict(data)
-    # 未来データ(future_df)に対する予測値
-    forecast_future = m.predict(future_df)
+    # 3. 結合して一本のデータにする
+    forecast = pd.concat([fit["fitted"], forecast_future], ignore_index=True)
+    forecast.attrs["fit_info"] = fit["info"]
 
-    # 4. 結合して一本のデータにする
-    forecast = pd.concat([forecast_train, forecast_future], ignore_index=True)
+    # 最終的な予測値（目標日の値）と、全期間の予測データを返す
+    return forecast["yhat"].iloc[-1], forecast
 
-    # カラム名統一 ('yhat1' -> 'yhat')
-    if "yhat1" in forecast.columns:
-        forecast = forecast.rename(columns={"yhat1": "yhat"})
 
-    # 最終的な予測値（目標日の値）と、全期間の予測データを返す
+def predict_neural_params(params, data, target_date):
+    """
+    書き出し済みパラメータで予測する (torch を読み込まない)
+    Returns: (目標日の予測値, 過去 + 未来の予測データ)
+    """
+    last_date = data["ds"].max()
+    future_days = (pd.to_datetime(target_date) - last_date).days
+    if future_days < 1:
+        future_days = 1
+
+    ds = pd.concat(
+        [
+            data["ds"],
+            pd.Series(
+                pd.date_range(last_date + pd.Timedelta(days=1), periods=future_days)
+            ),
+        ],
+        ignore_index=True,
+    )
+    forecast = pd.DataFrame({"ds": ds, "yhat": predict_exported(params, ds)})
+    forecast.attrs["fit_info"] = {"source": "exported", "seconds": 0.0}
+    return forecast["yhat"].iloc[-1], forecast
+
+
+def run_neural_model(df, target_date, athlete="default"):
+    """
+    NeuralProphetを使用し、長期的なトレンド予測を行う
+    書き出し済みパラメータがあれば torch を使わずに予測する
+    学習経路と所要時間は forecast.attrs["fit_info"] に格納する
+    """
+    # データ数が極端に少ない場合のガード
+    if len(df) < 5:
+        return df["y"].iloc[-1], pd.DataFrame(
+            {"ds": [pd.to_datetime(target_date)], "yhat": [df["y"].iloc[-1]]}
+        )
+
+    # NeuralProphet用データ準備
+    data = df[["ds", "y"]].copy()
+
+    fingerprint = model_store.data_fingerprint(data)
+
+    # 推論用パラメータが保存済みなら NumPy だけで予測
+    params = model_store.load_params(athlete, fingerprint)
+    if params is not None:
+        return predict_neural_params(params, data, target_date)
+
+    # 学習 (データ版ごとにキャッシュ / ディスク上の学習済みモデルを優先)
+    fit = get_fitted_neural_model(fingerprint, athlete, data)
+    return predict_neural_model(fit, target_date)
+
+
+def stale_neural_forecast(df, target_date, athlete="default"):
+    """
+    ディスクに保存済みの学習結果で予測する (プロセス再起動直後、新しいデータでの学習が終わるまでの表示用)
+    書き出し済みパラメータを優先し、なければ data の先頭部分で学習済みのモデルを読み込む
+    Returns: (目標日の予測値, 予測データ) or None (保存済みの学習結果がない)
+    """
+    data = df[["ds", "y"]]
+    if len(data) < 5:
+        return None
+    params = model_store.latest_params(athlete)
+    if params is not None:
+        p_val, forecast = predict_neural_params(params, data, target_date)
+        forecast.attrs["fit_info"] = {"source": "exported (stale)", "seconds": 0.0}
+        return p_val, forecast
+    n = model_store.find_saved_prefix(athlete, data)
+    if n < 5:
+        return None
+    return run_neural_model(data.iloc[:n].copy(), target_date, athlete)
+
+
+# --- バックグラウンド学習用 (forecast_jobs から別プロセスで実行) ---
+def forecast_key(df, athlete="default"):
+    """学習ジョブのキー (データと選手が同じなら同じモデルになる)"""
+    fingerprint = model_store.data_fingerprint(df[["ds", "y"]])
+    return f"{athlete}:{fingerprint}"
+
+
+def forecast_job(data, athlete="default"):
+    """
+    学習してディスクに保存する (予測は呼び出し側プロセスで run_neural_model を使う)
+    Returns: fit_info
+    """
+    if len(data) < 5:
+        return {"source": "skip", "seconds": 0.0}
+    _, fit_info = fit_neural_model(data, athlete)
+    return fit_info
+
+
+# --- 高速予測エンジン (Damped Holt-Winters, NumPy) ---
+# トレンド + 週周期のみを扱う軽量モデル。torch 不要で数ミリ秒で学習できる
+FORECAST_ENGINES = {
+    "fast": "Fast (Holt-Winters)",
+    "neural": "NeuralProphet (AI)",
+}
+DEFAULT_FORECAST_ENGINE = "fast"
+
+HW_SEASON = 7
+
+# 平滑化パラメータの候補 (全組み合わせを同時に評価する)
+HW_ALPHAS = [0.05, 0.1, 0.2, 0.3, 0.5]
+HW_BETAS = [0.01, 0.05, 0.1, 0.2]
+HW_GAMMAS = [0.05, 0.1, 0.3]
+HW_PHIS = [0.8, 0.9, 0.95, 0.98]
+
+
+def _holt_winters_fit(y, season=HW_SEASON):
+    """
+    加法型・減衰トレンドの Holt-Winters を全パラメータ候補で同時に計算し、
+    1期先予測の二乗誤差が最小のものを返す
+    """
+    grid = np.meshgrid(HW_ALPHAS, HW_BETAS, HW_GAMMAS, HW_PHIS, indexing="ij")
+    alpha, beta, gamma, phi = (g.ravel() for g in grid)
+    n_grid = len(alpha)
+
+    # 初期値: 1週目の平均を水準、1週目と2週目の差をトレンド、1週目の偏差を季節成分
+    level0 = y[:season].mean()
+    if len(y) >= 2 * season:
+        trend0 = (y[season : 2 * season].mean() - level0) / season
+    else:
+        trend0 = 0.0
+    level = np.full(n_grid, level0)
+    trend = np.full(n_grid, trend0)
+    seasonal = np.tile(y[:season] - level0, (n_grid, 1))
+
+    fitted = np.empty((len(y), n_grid))
+    for t, y_t in enumerate(y):
+        i = t % season
+        s = seasonal[:, i]
+        fitted[t] = level + phi * trend + s
+        new_level = alpha * (y_t - s) + (1 - alpha) * (level + phi * trend)
+        trend = beta * (new_level - level) + (1 - beta) * phi * trend
+        seasonal[:, i] = gamma * (y_t - new_level) + (1 - gamma) * s
+        level = new_level
+
+    # 初期化に使った1週目は評価から除く
+    sse = ((fitted[season:] - y[season:, None]) ** 2).sum(axis=0)
+    best = int(np.argmin(sse))
+    return {
+        "fitted": fitted[:, best],
+        "level": level[best],
+        "trend": trend[best],
+        "seasonal": seasonal[best],
+        "phi": phi[best],
+        "n": len(y),
+        "params": {
+            "alpha": alpha[best],
+            "beta": beta[best],
+            "gamma": gamma[best],
+            "phi": phi[best],
+        },
+    }
+
+
+def _holt_winters_forecast(state, horizon, season=HW_SEASON):
+    h = np.arange(1, horizon + 1)
+    damped = np.cumsum(state["phi"] ** h)
+    s = state["seasonal"][(state["n"] + h - 1) % season]
+    return state["level"] + state["trend"] * damped + s
+
+
+def _short_history_forecast(y, horizon):
+    """記録が2週間に満たない間の予測 (最小二乗の直線、1日分だけなら横ばい)"""
+    t = np.arange(len(y), dtype="float64")
+    if len(y) < 2:
+        return y.copy(), np.full(horizon, y[-1])
+    slope, intercept = np.polyfit(t, y, 1)
+    future_t = np.arange(len(y), len(y) + horizon, dtype="float64")
+    return intercept + slope * t, intercept + slope * future_t
+
+
+def run_fast_model(df, target_date):
+    """
+    NumPy 実装の Damped Holt-Winters (7日周期) による予測
+    Returns: (目標日の予測値, 過去 + 未来の予測データ) ※ run_neural_model と同じ形式
+    """
+    t0 = time.perf_counter()
+
+    # 日次に展開し、欠損日は線形補間
+    daily = (
+        df[["ds", "y"]]
+        .dropna()
+        .drop_duplicates(subset=["ds"], keep="last")
+        .set_index("ds")
+        .sort_index()
+        .asfreq("D")
+    )
+    # 体重の記録がない場合のガード
+    if daily.empty:
+        last = df["y"].iloc[-1] if not df.empty else np.nan
+        return last, pd.DataFrame({"ds": [pd.to_datetime(target_date)], "yhat": [last]})
+    y = daily["y"].interpolate().to_numpy(dtype="float64")
+
+    # 未来の期間を計算
+    last_date = daily.index.max()
+    future_days = (pd.to_datetime(target_date) - last_date).days
+    if future_days < 1:
+        future_days = 1
+
+    # 季節成分の初期化には2週間分が必要。それより短い間は直線で外挿する
+    if len(y) < 2 * HW_SEASON:
+        fitted, future = _short_history_forecast(y, future_days)
+        state = None
+    else:
+        state = _holt_winters_fit(y)
+        fitted = state["fitted"]
+        future = _holt_winters_forecast(state, future_days)
+
+    forecast = pd.DataFrame(
+        {
+            "ds": np.concatenate(
+                [
+                    daily.index.to_numpy(),
+                    pd.date_range(
+                        last_date + pd.Timedelta(days=1), periods=future_days
+                    ).to_numpy(),
+                ]
+            ),
+            "yhat": np.concatenate([fitted, future]),
+        }
+    )
+    forecast.attrs["fit_info"] = {
+        "source": "holt-winters" if state is not None else "linear (short history)",
+        "seconds": time.perf_counter() - t0,
+        "params": state["params"] if state is not None else {},
+    }
     return forecast["yhat"].iloc[-1], forecast
 
 
 # --- XGBoost 重要度分析 (For Analytics Tab) ---
+def _fit_xgboost(X, y):
+    xgb = load_engine("xgboost")
+    model = xgb.XGBRegressor(
+        n_estimators=100,
+        max_depth=3,
+        learning_rate=0.1,
+        n_jobs=forecast_jobs.THREADS_PER_JOB,
+    )
+    model.fit(X, y)
+    return model.feature_importances_
+
+
 @st.cache_data
 def run_xgboost_importance(df):
     """
@@ -159,13 +804,16 @@ def run_xgboost_importance(df):
     X = d[features]
     y = d["target_diff"]
 
-    # モデル学習
-    model = xgb.XGBRegressor(n_estimators=100, max_depth=3, learning_rate=0.1)
-    model.fit(X, y)
+    # モデル学習 (学習スケジューラ経由: 同時実行数とスレッド数を制限し、同じデータの学習は共有)
+    key = "xgb:" + model_store.data_fingerprint(d, features + ["target_diff"])
+    importances = forecast_jobs.run(key, _fit_xgboost, X, y, group="xgboost")
+    if importances is None:
+        # 例外にしてキャッシュさせない (混雑が解消すれば次回再実行される)
+        raise RuntimeError("XGBoost training was rejected or failed")
 
     # 重要度抽出
     importance_df = pd.DataFrame(
-        {"Feature": features, "Importance": model.feature_importances_}
+        {"Feature": features, "Importance": importances}
     ).sort_values("Importance", ascending=False)
 
     # 表示用の名前変換
@@ -186,29 +834,417 @@ def run_xgboost_importance(df):
 
 # --- 線形回帰 (トレンド補助) ---
 def run_linear_model(df, target_date):
+    """
+    経過日数に対する体重の直線 (最小二乗) を目標日へ外挿した値
+    毎回の描画で呼ばれるため、sklearn は使わず NumPy で解く
+    """
     if len(df) < 2:
         return df["y"].iloc[-1] if not df.empty else 0
 
     start = df["ds"].min()
-    df["d"] = (df["ds"] - start).dt.total_seconds() / 86400
-
-    model = LinearRegression()
-    valid_df = df.dropna(subset=["y", "d"])
+    valid_df = df.dropna(subset=["ds", "y"])
     if valid_df.empty:
         return 0
 
-    model.fit(valid_df[["d"]], valid_df["y"])
+    d = (valid_df["ds"] - start).dt.total_seconds().to_numpy() / 86400
+    y = valid_df["y"].to_numpy(dtype="float64")
+    tgt_d = (pd.to_datetime(target_date) - start).total_seconds() / 86400
+    if len(valid_df) < 2 or np.ptp(d) == 0:
+        # 1点 (同じ日) だけなら傾きは決まらないため平均値 (LinearRegression と同じ)
+        return float(y.mean())
 
-    tgt_dt = pd.to_datetime(target_date)
-    tgt_d = (tgt_dt - start).total_seconds() / 86400
-
-    pred = model.predict(pd.DataFrame({"d": [tgt_d]}))[0]
-    return pred
+    slope, intercept = np.polyfit(d, y, 1)
+    return float(intercept + slope * tgt_d)
 
 
 # --- 代謝適応シミュレーション ---
+# 代謝適応係数 (Adaptive Thermogenesis)
+# 体重が1kg減ると、基礎代謝 + 活動代謝が約 30kcal 落ちると仮定
+# (一般的には 15-30kcal/kg と言われるが、減量末期は高めに見積もるのが安全)
+ADAPTATION_FACTOR = 30.0
+# Simulator タブで現在の摂取カロリーと並べて描く計画 (kcal の増減)
+SIM_FAN_OFFSETS = (-300, -200, -100, 100, 200, 300)
+
+
+def simulate_metabolic_plans(
+    current_weight,
+    current_tdee,
+    plan_intakes,
+    days,
+    adaptation=ADAPTATION_FACTOR,
+    kcal_per_kg=KCAL_PER_KG,
+):
+    """
+    複数の摂取計画の体重推移を一度に計算する (日次ループなし)
+
+    漸化式 w[k] = w[k-1] + (I - TDEE[k-1]) / E,  TDEE[k] = TDEE0 - (w0 - w[k]) * a
+    は体重について線形なので、d[k] = w[k] - w0 は閉じた式で解ける:
+        d[k] = (I - TDEE0) / a * (1 - (1 - a/E)^k)    (a = 0 なら k * (I - TDEE0) / E)
+
+    日ごとに摂取が変わる計画 (2次元) は d[k] = r d[k-1] + (I[k] - TDEE0) / E  (r = 1 - a/E) を
+        d[k] = r^k * cumsum(r^-j (I[j] - TDEE0)) / E
+    として日次ループなしで解く
+
+    Parameters:
+    - plan_intakes: 摂取カロリー (kcal)。1次元なら計画ごとに一定、
+      2次元 (計画数, days) なら計画ごと・日ごとの値 ([:, k-1] が k 日目の摂取)
+    - days: 計算する日数
+    - adaptation: 代謝適応係数 (kcal/kg)。スカラーまたは計画ごとの配列
+
+    Returns: ndarray (計画数, days)。[:, k-1] が k 日後の体重
+    """
+    plan_intakes = np.asarray(plan_intakes, dtype=float)
+    k = np.arange(1, days + 1, dtype=float)
+    if plan_intakes.ndim == 2:
+        a = np.asarray(adaptation, dtype=float).reshape(-1, 1)
+        r = 1.0 - a / kcal_per_kg
+        u = (plan_intakes[:, :days] - current_tdee) / kcal_per_kg
+        return current_weight + np.power(r, k) * np.cumsum(np.power(r, -k) * u, axis=1)
+
+    intakes, adaptation = np.broadcast_arrays(
+        np.atleast_1d(plan_intakes),
+        np.atleast_1d(np.asarray(adaptation, dtype=float)),
+    )
+    surplus = (intakes - current_tdee)[..., None]
+    a = adaptation[..., None]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        adapted = surplus / a * (1.0 - np.power(1.0 - a / kcal_per_kg, k))
+    linear = surplus * k / kcal_per_kg
+    return current_weight + np.where(a == 0, linear, adapted)
+
+
+# --- 摂取スケジュール (リフィード・ダイエットブレイク・カーボサイクル) ---
+# settings の intake_schedule に JSON で保存する:
+#   {"base": 1800,                            基本の摂取 (kcal)。null なら直近の平均摂取
+#    "weekly": [0, 0, 0, 0, 0, 0, 600],       曜日ごとの増減 (月〜日, kcal)
+#    "overrides": [                           期間ごとの上書き (start〜end を含む。後の指定が優先)
+#        {"start": "2026-03-01", "end": "2026-03-14", "intake": 2400},   摂取を固定 (ダイエットブレイク)
+#        {"start": "2026-04-01", "end": "2026-04-03", "delta": 300}]}     基本 + 曜日の値に加算
+def parse_intake_schedule(value):
+    """
+    settings の値 (JSON 文字列 or dict) を検証して返す。未設定・空なら None
+    不正な値は ValueError
+    """
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return None
+    spec = json.loads(value) if isinstance(value, str) else dict(value)
+    if not isinstance(spec, dict):
+        raise ValueError("intake schedule must be a JSON object")
+
+    base = spec.get("base")
+    weekly = [float(v) for v in spec.get("weekly") or [0.0] * 7]
+    if len(weekly) != 7:
+        raise ValueError("weekly pattern needs 7 values (Mon..Sun)")
+    overrides = []
+    for item in spec.get("overrides") or []:
+        if not isinstance(item, dict) or not item.get("start"):
+            raise ValueError(f"override needs a start date: {item}")
+        start = pd.Timestamp(item["start"]).normalize()
+        end = pd.Timestamp(item.get("end") or item["start"]).normalize()
+        if end < start:
+            raise ValueError(f"override ends before it starts: {item}")
+        if (item.get("intake") is None) == (item.get("delta") is None):
+            raise ValueError(f"override needs either intake or delta: {item}")
+        overrides.append(
+            {
+                "start": start.date().isoformat(),
+                "end": end.date().isoformat(),
+                "intake": None if item.get("intake") is None else float(item["intake"]),
+                "delta": None if item.get("delta") is None else float(item["delta"]),
+            }
+        )
+    return {
+        "base": None if base is None else float(base),
+        "weekly": weekly,
+        "overrides": overrides,
+    }
+
+
+def schedule_intakes(schedule, dates, base=None):
+    """
+    スケジュールを日ごとの摂取カロリー (dates と同じ長さの ndarray) に展開する
+    曜日の表引きと、上書きごとの期間マスクで求める (日ごとのループなし)
+    base は schedule の base が null の場合に使う値
+    """
+    dates = pd.DatetimeIndex(dates).normalize()
+    base = schedule["base"] if schedule["base"] is not None else base
+    if base is None:
+        raise ValueError("intake schedule has no base intake")
+
+    intakes = base + np.asarray(schedule["weekly"], dtype=float)[dates.dayofweek]
+    for item in schedule["overrides"]:
+        mask = (dates >= item["start"]) & (dates <= item["end"])
+        if item["intake"] is not None:
+            intakes = np.where(mask, item["intake"], intakes)
+        else:
+            intakes = intakes + np.where(mask, item["delta"], 0.0)
+    return intakes
+
+
+def _plan_intakes(plan_intake, dates):
+    # スカラー (一定) / 日ごとの配列 / スケジュール (dict) を、スカラーか dates と同じ長さの配列にする
+    if isinstance(plan_intake, dict):
+        return schedule_intakes(plan_intake, dates)
+    plan = np.asarray(plan_intake, dtype=float)
+    if plan.ndim == 0:
+        return float(plan)
+    if len(plan) < len(dates):
+        raise ValueError(f"intake plan covers {len(plan)} of {len(dates)} days")
+    return plan[: len(dates)]
+
+
+# --- 確率シミュレーション (Monte Carlo) ---
+# 摂取カロリーの日々のブレ・TDEE 推定の誤差・水分による体重の日々の変動を経路ごとに抽選し、
+# 目標体重に届く確率と体重の分布 (パーセンタイル帯) を求める
+MC_PATHS = 10000
+MC_PERCENTILES = (5, 25, 50, 75, 95)
+# パーセンタイル帯はこの本数の経路から求める (到達確率は全経路で求める)
+MC_BAND_PATHS = 2000
+# 乱数はこの日数分をまとめて抽選し、日数の短いシミュレーションは先頭を使う
+MC_HORIZON_DAYS = 366
+# ブレの大きさを推定する直近の日数
+MC_NOISE_WINDOW = 28
+# 推定に使える記録が7日分に満たない場合の既定値 (kcal, kcal, kg)
+MC_DEFAULT_NOISE = {"intake_sd": 200.0, "tdee_sd": 100.0, "water_sd": 0.4}
+
+
+def estimate_simulation_noise(df, window=MC_NOISE_WINDOW):
+    """
+    直近 window 日の記録からブレの標準偏差を推定する
+    - intake_sd: 記録された摂取カロリー (Calories) のばらつき
+    - tdee_sd: 推定 TDEE (real_tdee_smooth) のばらつき
+    - water_sd: 体重と7日平均 (SMA_7) の差のばらつき (水分・内容物による日々の変動)
+    """
+    recent = df.tail(window)
+
+    def sd(values, name):
+        values = pd.to_numeric(values, errors="coerce").dropna()
+        if len(values) < 7:
+            return MC_DEFAULT_NOISE[name]
+        return float(values.std())
+
+    empty = pd.Series(dtype=float)
+    calories = recent.get("Calories", empty)
+    return {
+        "intake_sd": sd(calories[calories > 0], "intake_sd"),
+        "tdee_sd": sd(recent.get("real_tdee_smooth", empty), "tdee_sd"),
+        "water_sd": sd(recent["y"] - recent.get("SMA_7", np.nan), "water_sd"),
+    }
+
+
+def _mc_normals(days, paths, seed):
+    """
+    確率シミュレーションの乱数 N(0,1)
+    Returns: {"walk": (days, paths), "tdee": (paths,), "water_band": (days, MC_BAND_PATHS),
+    "water_final": (paths,)} いずれも float32
+    配列ごとに独立な乱数列から抽選するため、days を伸ばしても先頭の日の値は変わらない
+    """
+    rngs = [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(4)]
+    return {
+        "walk": rngs[0].standard_normal((days, paths), dtype=np.float32),
+        "tdee": rngs[1].standard_normal(paths, dtype=np.float32),
+        "water_band": rngs[2].standard_normal(
+            (days, min(paths, MC_BAND_PATHS)), dtype=np.float32
+        ),
+        "water_final": rngs[3].standard_normal(paths, dtype=np.float32),
+    }
+
+
+# seed を指定した抽選はプロセスで1度だけ行い (MC_HORIZON_DAYS 日分)、以後は使い回す
+# ((paths, seed), 乱数)。より長い日数を求められたら抽選し直す
+_MC_BASE = None
+_MC_BASE_LOCK = threading.Lock()
+
+
+def _mc_base(days, paths, seed):
+    global _MC_BASE
+    with _MC_BASE_LOCK:
+        if (
+            _MC_BASE is None
+            or _MC_BASE[0] != (paths, seed)
+            or _MC_BASE[1]["walk"].shape[0] < days
+        ):
+            normals = _mc_normals(max(days, MC_HORIZON_DAYS), paths, seed)
+            for values in normals.values():
+                values.flags.writeable = False
+            _MC_BASE = ((paths, seed), normals)
+        return _MC_BASE[1]
+
+
+def prefetch_mc_draws(paths=MC_PATHS, seed=0):
+    """
+    確率シミュレーションの乱数の抽選をバックグラウンドで始める (起動時に呼ぶ)
+    最初の Simulator の描画が抽選 (10k 経路 x 366日で数十 ms) を待たないようにする
+    """
+    if _MC_BASE is None or _MC_BASE[0] != (paths, seed):
+        threading.Thread(
+            target=_mc_base, args=(MC_HORIZON_DAYS, paths, seed), daemon=True
+        ).start()
+
+
+def _mc_draws(days, paths, r, seed):
+    """
+    確率シミュレーションの乱数と、日々のブレを積み上げた単位ノイズ
+    U[k] = r^k * cumsum(r^-j z[j])  (d[k] = r d[k-1] + z[k] の解)
+    Returns: {"walk": (days, paths), "tdee": (paths,), "water_band": (days, MC_BAND_PATHS),
+    "water_final": (paths,)} いずれも float32
+    """
+    if seed is None:
+        normals = _mc_normals(days, paths, None)
+    else:
+        normals = _mc_base(days, paths, seed)
+    k = np.arange(1, days + 1, dtype=float)
+    walk = normals["walk"][:days] * np.power(r, -k).astype(np.float32)[:, None]
+    np.cumsum(walk, axis=0, out=walk)
+    walk *= np.power(r, k).astype(np.float32)[:, None]
+    draws = {
+        "walk": walk,
+        "tdee": normals["tdee"],
+        "water_band": normals["water_band"][:days],
+        "water_final": normals["water_final"],
+    }
+    for values in draws.values():
+        values.flags.writeable = False
+    return draws
+
+
+# 同じ seed・日数・適応係数なら単位ノイズも使い回す (再描画のたびに積み上げ直さない)
+_cached_mc_draws = functools.lru_cache(maxsize=2)(_mc_draws)
+
+
+def mc_draws(
+    days,
+    paths=MC_PATHS,
+    adaptation=ADAPTATION_FACTOR,
+    kcal_per_kg=KCAL_PER_KG,
+    seed=0,
+):
+    """
+    seed が None なら毎回抽選し直し (10k 経路 x 200日で 70-80 ms)、それ以外は同じ乱数を返す (読み取り専用)
+    adaptation・kcal_per_kg は simulate_metabolic_paths に渡す値と揃える
+    乱数の抽選はプロセスで1度だけ。適応係数や日数が変わった時は単位ノイズだけを求め直す
+    """
+    r = 1.0 - adaptation / kcal_per_kg
+    if seed is None:
+        return _mc_draws(days, paths, r, None)
+    return _cached_mc_draws(days, paths, r, seed)
+
+
+def simulate_metabolic_paths(
+    current_weight,
+    current_tdee,
+    plan_intake,
+    draws,
+    intake_sd=MC_DEFAULT_NOISE["intake_sd"],
+    tdee_sd=MC_DEFAULT_NOISE["tdee_sd"],
+    adaptation=ADAPTATION_FACTOR,
+    kcal_per_kg=KCAL_PER_KG,
+):
+    """
+    代謝適応シミュレーションの経路をまとめて求める (水分変動は含まない)
+    plan_intake はスカラー (一定) か日ごとの配列 (days 日分)
+    - TDEE の推定誤差: 経路ごとに一定のずれ N(0, tdee_sd)
+    - 摂取カロリーのブレ: 日ごとに独立な N(0, intake_sd)
+
+    日々のブレ e[j] は d[k] = r d[k-1] + e[j] / E  (r = 1 - a/E) で積み上がるため、
+    draws (mc_draws の戻り値) の単位ノイズを intake_sd / E 倍して足す (日次ループなし)
+    Returns: ndarray (days, paths) float32。[k-1, p] が経路 p の k 日後の体重
+    """
+    days = draws["walk"].shape[0]
+    k = np.arange(1, days + 1, dtype=float)
+    r = 1.0 - adaptation / kcal_per_kg
+
+    # 計画どおりの推移 (plan_intake はスカラーか日ごとの配列) と、
+    # TDEE のずれによる推移 (一定の収支のずれ: simulate_metabolic_plans と同じ閉じた式)
+    plan = np.asarray(plan_intake, dtype=float)
+    planned = simulate_metabolic_plans(
+        current_weight,
+        current_tdee,
+        plan[None, :] if plan.ndim == 1 else [plan],
+        days,
+        adaptation,
+        kcal_per_kg,
+    )[0]
+    if adaptation == 0:
+        gain = k / kcal_per_kg
+    else:
+        gain = (1.0 - np.power(r, k)) / adaptation
+    w = np.multiply.outer(gain.astype(np.float32), np.float32(-tdee_sd) * draws["tdee"])
+    w += planned.astype(np.float32)[:, None]
+    w += np.float32(intake_sd / kcal_per_kg) * draws["walk"]
+    return w
+
+
+def solve_goal_intake(
+    current_weight,
+    current_tdee,
+    target_weight,
+    days,
+    adaptation=ADAPTATION_FACTOR,
+    kcal_per_kg=KCAL_PER_KG,
+):
+    """
+    simulate_metabolic_plans が days 日後にちょうど target_weight に着地する摂取カロリー (kcal/日)
+    着地点 d[n] = (I - TDEE0) / a * (1 - (1 - a/E)^n) を I について解く (閉じた式、反復なし)
+    引数は配列でもよい (ブロードキャストして計画ごとに解く)
+    """
+    days = np.maximum(np.asarray(days, dtype=float), 1.0)
+    a = np.asarray(adaptation, dtype=float)
+    change = np.asarray(target_weight, dtype=float) - current_weight
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        adapted = change * a / (1.0 - np.power(1.0 - a / kcal_per_kg, days))
+    linear = change * kcal_per_kg / days
+    intake = current_tdee + np.where(a == 0, linear, adapted)
+    return float(intake) if intake.ndim == 0 else intake
+
+
+def run_goal_intake_solver(
+    df,
+    target_date,
+    current_weight,
+    current_tdee,
+    target_weight,
+    adaptation=ADAPTATION_FACTOR,
+    kcal_per_kg=KCAL_PER_KG,
+):
+    """
+    最終記録日から目標日までの代謝適応シミュレーションで、目標体重に着地する摂取カロリー
+    Returns: kcal/日 (目標日が最終記録日以前なら None)
+    """
+    days = _simulation_days(df, target_date)
+    if days < 1:
+        return None
+    return solve_goal_intake(
+        current_weight, current_tdee, target_weight, days, adaptation, kcal_per_kg
+    )
+
+
+def _simulation_days(df, target_date):
+    # 最終記録日の翌日から目標日までの日数
+    return (pd.Timestamp(target_date) - df["ds"].max()).days
+
+
+def _simulation_dates(df, target_date):
+    # 最終記録日の翌日から目標日までの日付
+    days = _simulation_days(df, target_date)
+    return pd.date_range(df["ds"].max() + pd.Timedelta(days=1), periods=max(days, 0))
+
+
 def run_metabolic_simulation(
-    df, target_date, current_weight, current_tdee, plan_intake
+    df,
+    target_date,
+    current_weight,
+    current_tdee,
+    plan_intake,
+    paths=0,
+    goal_weight=None,
+    is_cut=True,
+    noise=None,
+    seed=0,
+    adaptation=ADAPTATION_FACTOR,
+    kcal_per_kg=KCAL_PER_KG,
 ):
     """
     【代謝適応シミュレーター】
@@ -218,50 +1254,339 @@ def run_metabolic_simulation(
     - current_weight: 直近の体重 (kg)
     - current_tdee: 直近の計算上のTDEE (kcal)
     - plan_intake: 予定摂取カロリー (kcal) ※デフォルトは直近平均など
+      日ごとの配列 (翌日から目標日まで) やスケジュール (parse_intake_schedule の dict) も可
+    - paths: 0 なら1本の決定的な推移。1以上なら確率シミュレーション (_run_stochastic_simulation)
+    - adaptation / kcal_per_kg: 代謝適応係数と体重 1kg あたりの kcal (calibrate_metabolism の値)
     """
+    dates = _simulation_dates(df, target_date)
+    if len(dates) < 1:
+        return pd.DataFrame()
+    plan_intake = _plan_intakes(plan_intake, dates)
 
-    # 設定値: 代謝適応係数 (Adaptive Thermogenesis)
-    # 体重が1kg減ると、基礎代謝 + 活動代謝が約 30kcal 落ちると仮定
-    # (一般的には 15-30kcal/kg と言われるが、減量末期は高めに見積もるのが安全)
-    ADAPTATION_FACTOR = 30.0
+    if paths:
+        return _run_stochastic_simulation(
+            df,
+            dates,
+            current_weight,
+            current_tdee,
+            plan_intake,
+            paths,
+            goal_weight,
+            is_cut,
+            noise or estimate_simulation_noise(df),
+            seed,
+            adaptation,
+            kcal_per_kg,
+        )
 
-    future_dates = []
-    sim_weights = []
+    plan = np.asarray(plan_intake)
+    weights = simulate_metabolic_plans(
+        current_weight,
+        current_tdee,
+        plan[None, ...],
+        len(dates),
+        adaptation,
+        kcal_per_kg,
+    )
+    return pd.DataFrame(
+        {
+            "ds": dates,
+            "yhat_sim": weights[0],
+            "intake": np.broadcast_to(plan, len(dates)),
+        }
+    )
 
-    # 初期値設定
-    sim_w = current_weight
-    sim_tdee = current_tdee
 
-    # 日付計算
-    start_date = df["ds"].max()
-    target_dt = pd.to_datetime(target_date)
-    days_to_predict = (target_dt - start_date).days
+def run_metabolic_simulation_fan(
+    df,
+    target_date,
+    current_weight,
+    current_tdee,
+    plan_intake,
+    offsets=SIM_FAN_OFFSETS,
+    adaptation=ADAPTATION_FACTOR,
+    kcal_per_kg=KCAL_PER_KG,
+):
+    """
+    plan_intake から offsets (kcal) だけ増減した計画をまとめて計算する (Simulator のファン表示用)
+    plan_intake は run_metabolic_simulation と同じく、一定値・日ごとの配列・スケジュールのいずれか
+    Returns: DataFrame [offset, intake (計画の平均摂取), ds, yhat_sim] (計画ごとに目標日までの行)
+    """
+    dates = _simulation_dates(df, target_date)
+    if len(dates) < 1 or not len(offsets):
+        return pd.DataFrame(columns=["offset", "intake", "ds", "yhat_sim"])
 
-    if days_to_predict < 1:
-        return pd.DataFrame()
+    offsets = np.asarray(offsets, dtype=float)
+    intakes = np.add.outer(offsets, _plan_intakes(plan_intake, dates))
+    weights = simulate_metabolic_plans(
+        current_weight, current_tdee, intakes, len(dates), adaptation, kcal_per_kg
+    )
+    mean_intakes = intakes.mean(axis=1) if intakes.ndim == 2 else intakes
+    return pd.DataFrame(
+        {
+            "offset": np.repeat(offsets, len(dates)),
+            "intake": np.repeat(mean_intakes, len(dates)),
+            "ds": np.tile(dates, len(offsets)),
+            "yhat_sim": weights.ravel(),
+        }
+    )
+
+
+def _run_stochastic_simulation(
+    df,
+    dates,
+    current_weight,
+    current_tdee,
+    plan_intake,
+    paths,
+    goal_weight,
+    is_cut,
+    noise,
+    seed,
+    adaptation=ADAPTATION_FACTOR,
+    kcal_per_kg=KCAL_PER_KG,
+):
+    """
+    確率シミュレーション
+    Returns: DataFrame [ds, yhat_sim (中央値), sim_p05, sim_p25, sim_p75, sim_p95]
+    (測定される体重 = 経路の体重 + 水分変動 の分布)
+    attrs:
+    - p_hit: 目標日までに (水分変動を除く) 体重が goal_weight に届く確率
+    - p_on_date: 目標日の測定体重が goal_weight を満たす確率
+    - paths / noise / seconds (乱数を使い回せた場合は抽選の時間を含まない)
+    """
+    t0 = time.perf_counter()
+    draws = mc_draws(len(dates), paths, adaptation, kcal_per_kg, seed)
+    w = simulate_metabolic_paths(
+        current_weight,
+        current_tdee,
+        plan_intake,
+        draws,
+        intake_sd=noise["intake_sd"],
+        tdee_sd=noise["tdee_sd"],
+        adaptation=adaptation,
+        kcal_per_kg=kcal_per_kg,
+    )
+
+    # 水分変動は日ごとに独立なので、帯を求める経路と目標日の測定値にだけ加える
+    water = np.float32(noise["water_sd"])
+    band = w[:, : draws["water_band"].shape[1]] + water * draws["water_band"]
+    q = np.percentile(band, MC_PERCENTILES, axis=1)
+    out = pd.DataFrame({"ds": dates, "yhat_sim": q[MC_PERCENTILES.index(50)]})
+    for p, values in zip(MC_PERCENTILES, q):
+        if p != 50:
+            out[f"sim_p{p:02d}"] = values
+
+    p_hit = p_on_date = None
+    if goal_weight is not None:
+        final = w[-1] + water * draws["water_final"]
+        if is_cut:
+            p_hit = float((w.min(axis=0) <= goal_weight).mean())
+            p_on_date = float((final <= goal_weight).mean())
+        else:
+            p_hit = float((w.max(axis=0) >= goal_weight).mean())
+            p_on_date = float((final >= goal_weight).mean())
 
-    # 日次ループ計算
-    for i in range(1, days_to_predict + 1):
-        # 1. カロリー収支 = 摂取 - 消費
-        balance = plan_intake - sim_tdee
+    out.attrs.update(
+        p_hit=p_hit,
+        p_on_date=p_on_date,
+        paths=paths,
+        noise=noise,
+        seconds=time.perf_counter() - t0,
+    )
+    return out
+
+
+# --- 代謝パラメータのキャリブレーション (選手ごと) ---
+# 体重 1kg あたりの kcal (E) と代謝適応係数 (a) を、摂取カロリーと体重の記録から求める。
+# 各 (E, a) の組で記録期間をシミュレーションし、初期体重・初期 TDEE だけは線形最小二乗で
+# 合わせる (全組を一度に計算する)。E と a は互いに打ち消し合い、日々の体重のブレ (水分) が
+# 大きいとデータだけでは決まらないため、既定値 (KCAL_PER_KG, ADAPTATION_FACTOR) を事前分布に
+# 置いた事後最大の組を選び、それでも絞り込めない・格子の端に張り付く場合は既定値を使う
+CALIBRATION_KCAL_GRID = np.arange(5000.0, 9001.0, 100.0)
+CALIBRATION_ADAPTATION_GRID = np.arange(0.0, 60.1, 2.5)
+# 事前分布の標準偏差 (既定値からのずれに対する罰則の強さ)
+CALIBRATION_PRIOR_SD = (500.0, 10.0)
+# 推定の幅 (事後の 1σ 相当の半幅) がこれより広ければ、決まらなかったとみなす
+CALIBRATION_MAX_SPREAD = (300.0, 7.5)
+# 体重のブレの下限 (kg)。誤差がほぼない記録で事前分布が効かなくなりすぎないように
+CALIBRATION_NOISE_FLOOR = 0.05
+# daily_logs のうち直近この日数を使う
+CALIBRATION_WINDOW_DAYS = 180
+# この日数ごとに区切った期間で推定し直す (記録を保存するたびには推定し直さない)
+CALIBRATION_REFIT_DAYS = 7
+# 摂取と体重の両方が記録された日がこれより少ない期間は使わない
+CALIBRATION_MIN_DAYS = 28
+# 初期 TDEE がこの範囲を外れる組は採用しない (kcal)
+CALIBRATION_TDEE_RANGE = (1000.0, 5000.0)
 
-        # 2. 体重変動 (7200kcal = 1kg脂肪)
-        # ※ バッファとして水分変動などは無視し、純粋なエネルギー保存則で計算
-        weight_diff = balance / 7200.0
 
-        # 3. 次の日の体重更新
-        sim_w += weight_diff
+def _calibration_segment(frame):
+    """
+    ds・y・Calories の記録を日次に並べ、(前日の摂取, 体重) の配列にする (体重の欠測は NaN)
+    摂取 0 (未記録) の日は前後の記録で補う。記録が足りなければ None
+    """
+    frame = frame.dropna(subset=["ds"]).drop_duplicates("ds", keep="last")
+    daily = frame.set_index("ds")[["y", "Calories"]].sort_index().asfreq("D")
+    intake = pd.to_numeric(daily["Calories"], errors="coerce").where(lambda c: c > 0)
+    weight = pd.to_numeric(daily["y"], errors="coerce")
+    if (intake.notna() & weight.notna()).sum() < CALIBRATION_MIN_DAYS:
+        return None
+    intake = intake.ffill().bfill().to_numpy()
+    # k 日目の体重は k-1 日目の摂取で決まる
+    return intake[:-1], weight.to_numpy()
+
+
+def _calibration_sse(intake_prev, weight, kcal, adaptation):
+    """
+    全 (E, a) の組について、初期体重・初期 TDEE を最小二乗で合わせた二乗誤差を求める
+    kcal・adaptation は同じ形の配列 (組の数)。Returns: (sse, 初期 TDEE)
+    """
+    n = len(weight)
+    E = kcal[:, None]
+    a = adaptation[:, None]
+    r = 1.0 - a / E
+    k = np.arange(1, n, dtype=float)
+
+    # w[k] = w0 + A[k] - TDEE0 * B[k]  (A: 摂取の寄与、B: TDEE 1kcal あたりの寄与)
+    A = np.power(r, k) * np.cumsum(np.power(r, -k) * intake_prev / E, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        B = np.where(a == 0, k / E, (1.0 - np.power(r, k)) / a)
+    A = np.concatenate([np.zeros((len(kcal), 1)), A], axis=1)
+    B = np.concatenate([np.zeros((len(kcal), 1)), B], axis=1)
 
-        # 4. 【重要】TDEEの減衰 (Metabolic Adaptation)
-        # 体重が減った分だけ、翌日の消費カロリーを減らす
-        # (sim_w - current_weight) はマイナス値なので、TDEEは減少する
-        weight_loss_amount = current_weight - sim_w
-        sim_tdee = current_tdee - (weight_loss_amount * ADAPTATION_FACTOR)
+    mask = ~np.isnan(weight)
+    z = np.where(mask, weight - A, 0.0)
+    B = np.where(mask, B, 0.0)
+    # z = w0 - TDEE0 * B の正規方程式 (組ごとの 2x2)
+    s1 = mask.sum()
+    sb, sbb = B.sum(axis=1), (B * B).sum(axis=1)
+    sz, sbz = z.sum(axis=1), (B * z).sum(axis=1)
+    det = s1 * sbb - sb * sb
+    w0 = (sbb * sz - sb * sbz) / det
+    tdee = (sb * sz - s1 * sbz) / det
+    resid = np.where(mask, z - w0[:, None] + tdee[:, None] * B, 0.0)
+    return (resid * resid).sum(axis=1), tdee
 
-        # 記録
-        next_date = start_date + pd.Timedelta(days=i)
-        future_dates.append(next_date)
-        sim_weights.append(sim_w)
 
-    # DataFrame化
-    return pd.DataFrame({"ds": future_dates, "yhat_sim": sim_weights})
+def _default_calibration(reason, **extra):
+    return {
+        "kcal_per_kg": KCAL_PER_KG,
+        "adaptation": ADAPTATION_FACTOR,
+        "rmse": None,
+        "days": 0,
+        "segments": 0,
+        "source": "default",
+        "reason": reason,
+        **extra,
+    }
+
+
+def calibrate_metabolism(df, history=None, window=CALIBRATION_WINDOW_DAYS, end=None):
+    """
+    daily_logs (ds, y, Calories) の end までの window 日 (end 当日は含まない。None なら最終日まで) と、
+    摂取 (Calories 列) が記録された過去シーズン (history.csv の Label ごと) から、
+    体重 1kg あたりの kcal と代謝適応係数を求める
+    期間ごとに初期体重・初期 TDEE は別々に合わせ、二乗誤差の合計に既定値からのずれの罰則を加えて選ぶ
+    Returns: {"kcal_per_kg", "adaptation", "rmse", "days", "segments", "source", "reason"}
+    (記録が足りない・絞り込めない場合は既定値で source="default"、reason に理由)
+    """
+    segments = []
+    if not df.empty and "Calories" in df.columns:
+        end = df["ds"].max() + pd.Timedelta(days=1) if end is None else end
+        start = pd.Timestamp(end) - pd.Timedelta(days=window)
+        recent = df[(df["ds"] >= start) & (df["ds"] < pd.Timestamp(end))]
+        if not recent.empty:
+            segments.append(_calibration_segment(recent))
+    if history is not None and "Calories" in history.columns:
+        seasons = history.rename(columns={"Date": "ds", "Weight": "y"})
+        seasons["ds"] = pd.to_datetime(seasons["ds"]).dt.normalize()
+        for _, season in seasons.groupby("Label"):
+            segments.append(_calibration_segment(season))
+    segments = [seg for seg in segments if seg is not None]
+    if not segments:
+        return _default_calibration("insufficient data")
+
+    kcal, adaptation = np.meshgrid(
+        CALIBRATION_KCAL_GRID, CALIBRATION_ADAPTATION_GRID, indexing="ij"
+    )
+    kcal, adaptation = kcal.ravel(), adaptation.ravel()
+    total = np.zeros(len(kcal))
+    days = 0
+    lo, hi = CALIBRATION_TDEE_RANGE
+    for intake_prev, weight in segments:
+        sse, tdee = _calibration_sse(intake_prev, weight, kcal, adaptation)
+        total += np.where((tdee >= lo) & (tdee <= hi), sse, np.inf)
+        days += int((~np.isnan(weight)).sum())
+    fit = dict(days=days, segments=len(segments))
+    if not np.isfinite(total.min()):
+        return _default_calibration("implausible TDEE", **fit)
+
+    # 体重のブレ (分散) を最良の組の残差から見積もり、事前分布の罰則と同じ尺度にそろえる
+    dof = max(days - 2 * len(segments) - 2, 1)
+    noise = max(total.min() / dof, CALIBRATION_NOISE_FLOOR**2)
+    sd_kcal, sd_adaptation = CALIBRATION_PRIOR_SD
+    objective = (
+        total / noise
+        + ((kcal - KCAL_PER_KG) / sd_kcal) ** 2
+        + ((adaptation - ADAPTATION_FACTOR) / sd_adaptation) ** 2
+    )
+    best = int(np.argmin(objective))
+    fit.update(rmse=float(np.sqrt(total[best] / days)))
+
+    on_edge = (
+        kcal[best] in CALIBRATION_KCAL_GRID[[0, -1]]
+        or adaptation[best] in CALIBRATION_ADAPTATION_GRID[[0, -1]]
+    )
+    if on_edge:
+        return _default_calibration("grid boundary", **fit)
+    # 目的関数が最小値 +1 以内の組の広がり (各パラメータの 1σ 相当)
+    near = objective <= objective[best] + 1.0
+    spread = (np.ptp(kcal[near]) / 2, np.ptp(adaptation[near]) / 2)
+    if any(w > limit for w, limit in zip(spread, CALIBRATION_MAX_SPREAD)):
+        return _default_calibration("poorly determined", **fit)
+
+    return {
+        "kcal_per_kg": float(kcal[best]),
+        "adaptation": float(adaptation[best]),
+        **fit,
+        "source": "fit",
+        "reason": None,
+    }
+
+
+def calibration_window_end(today=None):
+    """推定に使う期間の終わり (この日は含まない)。CALIBRATION_REFIT_DAYS ごとにだけ進む"""
+    today = pd.Timestamp(today if today is not None else pd.Timestamp.now()).normalize()
+    ordinal = today.toordinal() // CALIBRATION_REFIT_DAYS * CALIBRATION_REFIT_DAYS
+    return pd.Timestamp.fromordinal(ordinal)
+
+
+def get_calibration(load_logs, athlete="default", history=None, today=None):
+    """
+    選手ごとのキャリブレーション結果
+    推定に使う期間は CALIBRATION_REFIT_DAYS ごとに区切って固定し、期間が進むまでは保存済みの値を返す
+    (記録を保存するたびに推定し直して、TDEE の逆算などの前回結果を無効にしないため)
+    load_logs(since, before) は log_date が [since, before) の daily_logs を返す関数 (推定し直す時だけ呼ぶ)
+    取得に失敗したら前回の値 (なければ既定値) を返す
+    """
+    end = calibration_window_end(today)
+    key = end.strftime("%Y-%m-%d")
+    if history is not None and "Calories" in history.columns:
+        key += "-" + model_store.data_fingerprint(
+            history, ["Date", "Weight", "Calories"]
+        )
+    cached = model_store.load_calibration(athlete, key)
+    if cached is not None:
+        return cached
+
+    start = end - pd.Timedelta(days=CALIBRATION_WINDOW_DAYS)
+    try:
+        df = load_logs(start.date(), end.date())
+    except Exception:
+        stale = model_store.load_calibration(athlete)
+        return stale if stale is not None else _default_calibration("fetch failed")
+    result = calibrate_metabolism(df, history, end=end)
+    result["window"] = [start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")]
+    model_store.save_calibration(athlete, key, result)
+    return result
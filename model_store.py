@@ -0,0 +1,232 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+# --- 学習済みモデルの保存先 (ローカルディスク) ---
+# Streamlit Cloud の再起動・再デプロイ後も再学習せずに済むよう、プロセス外に永続化する
+STORE_DIR = os.environ.get("MODEL_STORE_DIR", ".model_store")
+
+# モデル構成を変えたら上げる (古い成果物を無効化するため)
+MODEL_VERSION = "np-v1"
+
+# 選手ごとに残す成果物の数
+KEEP_MODELS = 3
+
+_LOCK = threading.Lock()
+
+
+# --- 1. データ指紋 ---
+def _row_hashes(data, columns=("ds", "y")):
+    return pd.util.hash_pandas_object(data[list(columns)], index=False).to_numpy()
+
+
+def _digest(row_hashes):
+    h = hashlib.sha1(MODEL_VERSION.encode())
+    h.update(row_hashes.tobytes())
+    return h.hexdigest()[:16]
+
+
+def data_fingerprint(data, columns=("ds", "y")):
+    """学習データ (既定は ds, y) の内容から決まるキー"""
+    return _digest(_row_hashes(data, columns))
+
+
+# --- 2. インデックス管理 ---
+def _athlete_dir(athlete):
+    safe = re.sub(r"[^A-Za-z0-9_-]", "_", str(athlete)) or "default"
+    return os.path.join(STORE_DIR, safe)
+
+
+def _index_path(athlete):
+    return os.path.join(_athlete_dir(athlete), "index.json")
+
+
+def _load_index(athlete):
+    path = _index_path(athlete)
+    if not os.path.exists(path):
+        return []
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return []
+
+
+def _save_index(athlete, entries):
+    path = _index_path(athlete)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(entries, f, indent=2)
+    os.replace(tmp, path)
+
+
+def _model_path(athlete, fingerprint):
+    return os.path.join(_athlete_dir(athlete), f"{fingerprint}.np")
+
+
+def _params_path(athlete, fingerprint):
+    return os.path.join(_athlete_dir(athlete), f"{fingerprint}.npz")
+
+
+def _calibration_path(athlete):
+    return os.path.join(_athlete_dir(athlete), "calibration.json")
+
+
+# --- 3. 取得 (Read) ---
+def load_model(athlete, fingerprint):
+    """完全一致する学習済みモデルを返す (なければ None)"""
+    from neuralprophet import load
+
+    path = _model_path(athlete, fingerprint)
+    if not os.path.exists(path):
+        return None
+    try:
+        return load(path)
+    except Exception:
+        return None
+
+
+def load_params(athlete, fingerprint):
+    """torch 不要の推論用パラメータ (NumPy 配列の dict) を返す (なければ None)"""
+    path = _params_path(athlete, fingerprint)
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as z:
+            return {k: z[k] for k in z.files}
+    except Exception:
+        return None
+
+
+def load_calibration(athlete, fingerprint=None):
+    """
+    同じ記録 (fingerprint) で求めた代謝パラメータ (dict) を返す (なければ None)
+    fingerprint が None なら、保存済みの最新の値をそのまま返す
+    """
+    path = _calibration_path(athlete)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, encoding="utf-8") as f:
+            saved = json.load(f)
+    except Exception:
+        return None
+    if fingerprint is not None and saved.get("fingerprint") != fingerprint:
+        return None
+    return saved["params"]
+
+
+def find_finetune_base(athlete, data, max_new_days):
+    """
+    data の先頭部分で学習済みのモデルのうち、追加行数が max_new_days 以内で最も新しいものを返す
+    Returns: (model, n_rows) or (None, 0)
+    """
+    from neuralprophet import load
+
+    hashes = _row_hashes(data)
+    entries = sorted(_load_index(athlete), key=lambda e: e["n_rows"], reverse=True)
+    for entry in entries:
+        n = entry["n_rows"]
+        if n >= len(data) or len(data) - n > max_new_days:
+            continue
+        if _digest(hashes[:n]) != entry["fingerprint"]:
+            continue
+        path = _model_path(athlete, entry["fingerprint"])
+        try:
+            return load(path), n
+        except Exception:
+            continue
+    return None, 0
+
+
+def latest_params(athlete):
+    """
+    最も新しく保存された推論用パラメータ (どのデータ版かは問わない。なければ None)
+    プロセス再起動直後、新しいデータでの学習が終わるまでの暫定表示用
+    """
+    entries = sorted(_load_index(athlete), key=lambda e: e["saved_at"], reverse=True)
+    for entry in entries:
+        params = load_params(athlete, entry["fingerprint"])
+        if params is not None:
+            return params
+    return None
+
+
+def find_saved_prefix(athlete, data):
+    """
+    data の先頭 n 行で学習済みのモデルが保存されていれば、最長の n を返す (なければ 0)
+    (モデルは読み込まない)
+    """
+    hashes = _row_hashes(data)
+    entries = sorted(_load_index(athlete), key=lambda e: e["n_rows"], reverse=True)
+    for entry in entries:
+        n = entry["n_rows"]
+        if n > len(data) or _digest(hashes[:n]) != entry["fingerprint"]:
+            continue
+        if os.path.exists(_model_path(athlete, entry["fingerprint"])):
+            return n
+    return 0
+
+
+# --- 4. 保存 (Upsert) ---
+def save_model(athlete, fingerprint, data, model):
+    from neuralprophet import save
+
+    with _LOCK:
+        os.makedirs(_athlete_dir(athlete), exist_ok=True)
+        path = _model_path(athlete, fingerprint)
+        tmp = path + ".tmp"
+        save(model, tmp)
+        os.replace(tmp, path)
+
+        entries = [e for e in _load_index(athlete) if e["fingerprint"] != fingerprint]
+        entries.append(
+            {
+                "fingerprint": fingerprint,
+                "n_rows": len(data),
+                "last_ds": str(data["ds"].max().date()),
+                "saved_at": time.time(),
+            }
+        )
+        # 古い成果物を削除
+        entries.sort(key=lambda e: e["saved_at"], reverse=True)
+        for old in entries[KEEP_MODELS:]:
+            for old_path in (
+                _model_path(athlete, old["fingerprint"]),
+                _params_path(athlete, old["fingerprint"]),
+            ):
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+        _save_index(athlete, entries[:KEEP_MODELS])
+
+
+def save_params(athlete, fingerprint, params):
+    with _LOCK:
+        os.makedirs(_athlete_dir(athlete), exist_ok=True)
+        path = _params_path(athlete, fingerprint)
+        tmp = path + ".tmp.npz"
+        np.savez(tmp, **params)
+        os.replace(tmp, path)
+
+
+def save_calibration(athlete, fingerprint, params):
+    """代謝パラメータを保存する (選手ごとに最新の1件)"""
+    with _LOCK:
+        os.makedirs(_athlete_dir(athlete), exist_ok=True)
+        path = _calibration_path(athlete)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(
+                {"fingerprint": fingerprint, "saved_at": time.time(), "params": params},
+                f,
+                indent=2,
+            )
+        os.replace(tmp, path)
@@ -1,85 +1,955 @@
+import copy
+import datetime
+import functools
+import io
+import os
+import threading
+import time
+import tracemalloc
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
 import streamlit as st
-from supabase import Client, create_client
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from supabase import Client, ClientOptions, create_client
+
+import change_feed
+import local_engine
+import local_replica
+import transport
+
+# --- ストレージバックエンド ---
+# "supabase": Supabase (secrets の接続情報) / "local": 組み込みエンジン (local_engine, 通信なし)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "supabase")
+
+# --- Single-Flight キャッシュ設定 ---
+# TTL のこの割合を過ぎたら、期限切れ前にバックグラウンドで再取得する
+REFRESH_AHEAD = 0.8
+# 最後の参照からこの秒数が過ぎたキャッシュは先読みしない (アイドル時の無駄な通信を避ける)
+REFRESH_IDLE_STOP = 600
+# 先読みスレッドの確認間隔 (秒)
+REFRESH_TICK = 5
+# 接続できない間 (ローカル複製で表示中) に再接続を試みる間隔 (秒)
+OFFLINE_RETRY = 30
+# Realtime の購読中 (通知が届いたテーブル) は TTL ごとの再取得を止め、取りこぼし対策としてこの間隔 (秒) でだけ取り直す
+REALTIME_TTL = 3600
+
+# --- ページ分割取得の設定 ---
+# PostgREST の max-rows (既定 1000) を超えないよう、この行数ずつ range 指定で取得する
+PAGE_SIZE = 1000
+# 同時に取得するページ数 (接続はクライアント内でプール・再利用される)
+FETCH_WORKERS = 4
+# 一括取得の応答形式: "csv" (Accept: text/csv を列ごとに型付きで読み込む) / "json" (行ごとの dict)
+BULK_FORMAT = os.environ.get("SUPABASE_BULK_FORMAT", "csv")
+
+_MISSING = object()
+_SINGLE_FLIGHTS = []
+_REFRESHER = None
+_REFRESHER_LOCK = threading.Lock()
+_PAGE_LOG = deque(maxlen=200)  # 直近のページ取得 (件数・所要時間)
+_PAGE_LOG_LOCK = threading.Lock()
 
 
 # --- 0. 接続クライアント初期化 ---
+def _client_options():
+    # PostgREST の通信に接続プール付きのクライアントを使う (httpx_client を受け付けない版ではタイムアウトのみ)
+    try:
+        return ClientOptions(
+            httpx_client=transport.http_client(),
+            postgrest_client_timeout=transport.CALL_TIMEOUT,
+        )
+    except TypeError:
+        return ClientOptions(postgrest_client_timeout=transport.CALL_TIMEOUT)
+
+
 @st.cache_resource
 def init_connection() -> Client:
+    """
+    STORAGE_BACKEND のクライアントを返す。以降の取得・保存はすべてこのクライアント経由で行う
+    (組み込みエンジンは supabase-py と同じクエリの書き方に対応している: local_engine を参照)
+    """
+    if STORAGE_BACKEND == "local":
+        return local_engine.connect()
     try:
         url = st.secrets["connections"]["supabase"]["SUPABASE_URL"]
         key = st.secrets["connections"]["supabase"]["SUPABASE_KEY"]
-        return create_client(url, key)
+        return create_client(url, key, options=_client_options())
     except Exception as e:
         st.error(f"Supabase connection failed: {e}")
         st.stop()
 
 
+# --- 0.5 Single-Flight キャッシュ ---
+class _SingleFlight:
+    """
+    プロセス全体で共有するキャッシュ。同じクエリの同時要求は1回の通信にまとめ (他は完了を待つ)、
+    TTL 切れの前にバックグラウンドで再取得するため、利用中のユーザーは通信を待たない。
+    取得に失敗した場合は前回値 (期限切れでも) を返し、前回値がなければ seed() (ローカル複製)、
+    それもなければ fallback(例外) の戻り値を返す。
+    起動直後は seed() の値を即座に返し、最新化はバックグラウンドで行う。
+    overlay があれば、返す値に未送信の書き込みを重ねる (書いた内容がすぐ見えるように)。
+    書き込み後は patch() で値を直接更新し、版数 (version) を進める。取得中に patch() された場合、
+    取得結果は書き込み前の可能性があるため捨てて次回取り直す。
+    table の変更通知 (Realtime) を購読中で、実際に通知が届いている間は TTL を REALTIME_TTL まで延ばす。
+    """
+
+    def __init__(self, loader, ttl, fallback, seed=None, overlay=None, table=None):
+        functools.update_wrapper(self, loader)
+        self.loader = loader
+        self.ttl = ttl
+        self.fallback = fallback
+        self.seed = seed
+        self.overlay = overlay
+        self.table = table
+        self._lock = threading.Lock()
+        self._value = _MISSING
+        self._fetched_at = 0.0
+        self._last_read = 0.0
+        self._inflight = None  # (threading.Event, 開始時の版数) 取得中のみ
+        self._version = 0  # 取得・patch() のたびに進む
+        self._error = None
+        self._seeded = False  # 値がローカル複製由来 (未同期)
+        self._seed_tried = False
+        self._attempted_at = 0.0
+
+    def _refresh(self, event):
+        value, error = _MISSING, RuntimeError("fetch interrupted")
+        try:
+            value, error = self.loader(), None
+        except Exception as e:
+            error = e
+        finally:
+            # st.stop() などで中断された場合も待機中の要求を必ず解放する
+            with self._lock:
+                ours = self._inflight is not None and self._inflight[0] is event
+                started = self._inflight[1] if ours else None
+                if value is not _MISSING and started == self._version:
+                    self._value, self._fetched_at = value, time.time()
+                    self._seeded = False
+                    self._version += 1
+                elif value is not _MISSING:
+                    # 取得中に patch() された (版数の競合): patch 済みの値を残して次回取り直す
+                    self._fetched_at = 0.0
+                    self._attempted_at = 0.0
+                self._error = error
+                if ours:
+                    self._inflight = None
+            event.set()
+
+    def _start_locked(self, background):
+        """
+        取得を開始する。既に取得中ならその Event を返す。_lock 保持中に呼ぶ
+        Returns: (Event, 自分が先頭か)
+        """
+        if self._inflight is not None:
+            return self._inflight[0], False
+        event = threading.Event()
+        self._inflight = (event, self._version)
+        self._attempted_at = time.time()
+        if background:
+            threading.Thread(target=self._refresh, args=(event,), daemon=True).start()
+        return event, True
+
+    def refresh_if_due(self, now):
+        # 先読みスレッドから呼ばれる: 期限が近く、最近参照されたものだけ再取得
+        with self._lock:
+            if self._value is _MISSING or now - self._last_read > REFRESH_IDLE_STOP:
+                return
+            if self._error is not None and now - self._attempted_at < OFFLINE_RETRY:
+                return
+            if now - self._fetched_at >= self._ttl() * REFRESH_AHEAD:
+                self._start_locked(background=True)
+
+    def _ttl(self):
+        return max(self.ttl, REALTIME_TTL) if _realtime_live(self.table) else self.ttl
+
+    def _present(self, value):
+        value = copy.deepcopy(value)
+        return self.overlay(value) if self.overlay else value
+
+    def _load_seed_locked(self):
+        if self.seed is None or self._seed_tried:
+            return
+        self._seed_tried = True
+        value = self.seed()
+        if value is not None:
+            self._value, self._seeded = value, True
+
+    def __call__(self):
+        _ensure_refresher()
+        now = time.time()
+        with self._lock:
+            self._last_read = now
+            if self._value is _MISSING:
+                self._load_seed_locked()
+            if self._seeded:
+                # ローカル複製を即座に返す (接続できない間は間隔を空けて再試行)
+                if now - self._attempted_at >= OFFLINE_RETRY:
+                    self._start_locked(background=True)
+                return self._present(self._value)
+            age, ttl = now - self._fetched_at, self._ttl()
+            if self._value is not _MISSING and age < ttl:
+                if age >= ttl * REFRESH_AHEAD:
+                    self._start_locked(background=True)
+                return self._present(self._value)
+            event, leader = self._start_locked(background=False)
+
+        # 先頭の要求だけが通信し、他の要求は完了を待つ
+        if leader:
+            self._refresh(event)
+        else:
+            event.wait()
+
+        with self._lock:
+            # 取得に失敗しても前回値 (なければローカル複製) があればそれを返す
+            if self._value is _MISSING:
+                self._seed_tried = False
+                self._load_seed_locked()
+            if self._value is not _MISSING:
+                return self._present(self._value)
+            error = self._error
+        return self._present(self.fallback(error))
+
+    def patch(self, fn):
+        """
+        書き込み結果を取得済みの値に直接反映する (Write-Through)。fn(値) は新しい値を返す
+        未取得なら何もしない (次回の取得で反映される)
+        """
+        with self._lock:
+            if self._value is _MISSING:
+                return False
+            self._value = fn(self._value)
+            self._version += 1
+            return True
+
+    def expire(self):
+        """取得済みの値を期限切れにし、バックグラウンドで取り直す (値はそれまで返し続ける)"""
+        with self._lock:
+            if self._value is _MISSING:
+                return
+            self._fetched_at = 0.0
+            self._start_locked(background=True)
+
+    @property
+    def version(self):
+        with self._lock:
+            return self._version
+
+    @property
+    def offline(self):
+        """直近の取得に失敗している (ローカル複製・前回値で表示中) か"""
+        with self._lock:
+            return self._error is not None
+
+
+def _refresh_loop():
+    while True:
+        time.sleep(REFRESH_TICK)
+        now = time.time()
+        for cache in _SINGLE_FLIGHTS:
+            try:
+                cache.refresh_if_due(now)
+            except Exception:
+                pass
+
+
+def _ensure_refresher():
+    global _REFRESHER
+    with _REFRESHER_LOCK:
+        if _REFRESHER is None or not _REFRESHER.is_alive():
+            _REFRESHER = threading.Thread(
+                target=_refresh_loop, name="supabase-refresh", daemon=True
+            )
+            _REFRESHER.start()
+
+
+def single_flight(ttl, fallback=lambda e: None, seed=None, overlay=None, table=None):
+    """st.cache_data(ttl=...) の代わりに使うデコレータ (引数なしの取得関数用)"""
+
+    def decorator(loader):
+        cache = _SingleFlight(loader, ttl, fallback, seed, overlay, table)
+        _SINGLE_FLIGHTS.append(cache)
+        return cache
+
+    return decorator
+
+
+def _replica_seed(table, build):
+    """ローカル複製の行から取得関数と同じ形の値を作る seed 関数"""
+
+    def seed():
+        rows, _ = local_replica.load_table(table)
+        return None if rows is None else build(rows)
+
+    return seed
+
+
+def is_offline():
+    """Supabase に接続できず、ローカル複製 (読み取り専用) で表示しているか"""
+    return any(cache.offline for cache in _SINGLE_FLIGHTS)
+
+
+# --- 0.6 ページ分割・並列取得 ---
+def _parse_page(data):
+    # CSV 応答は文字列、JSON 応答 (または空の応答) は dict のリストで返る
+    if isinstance(data, str):
+        return pd.read_csv(io.StringIO(data))
+    return pd.DataFrame(data)
+
+
+def _fetch_page(make_query, table, page, start, size, count=None, fmt="json"):
+    t0 = time.perf_counter()
+    query = make_query(count).range(start, start + size - 1)
+    if fmt == "csv":
+        query = query.csv()
+    response = transport.execute(query, f"{table}.page")
+    frame = _parse_page(response.data)
+    seconds = time.perf_counter() - t0
+    with _PAGE_LOG_LOCK:
+        _PAGE_LOG.append(
+            {
+                "table": table,
+                "page": page,
+                "offset": start,
+                "rows": len(frame),
+                "seconds": seconds,
+                "at": time.time(),
+            }
+        )
+    return frame, response.count
+
+
+def _fetch_all_pages(make_query, table, key, fmt=None):
+    """
+    make_query(count) が返す (一意キーで順序付けした) クエリを PAGE_SIZE 行ずつ取得し、
+    DB の列名のままの DataFrame で返す。
+    1ページ目で総件数を得て、残りのページは並列に取得する。
+    取得中の追記で行がずれた場合に備えて key で重複を除き、件数が合わなければ例外。
+    """
+    fmt = fmt or BULK_FORMAT
+    first, total = _fetch_page(make_query, table, 0, 0, PAGE_SIZE, "exact", fmt)
+    total = len(first) if total is None else total
+    # サーバ側の上限が PAGE_SIZE より小さい場合はそれに合わせる
+    size = len(first) if 0 < len(first) < min(PAGE_SIZE, total) else PAGE_SIZE
+    starts = range(size, total, size)
+
+    pages = [first]
+    if starts:
+        with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as pool:
+            futures = [
+                pool.submit(_fetch_page, make_query, table, i, start, size, None, fmt)
+                for i, start in enumerate(starts, start=1)
+            ]
+            pages += [f.result()[0] for f in futures]
+
+    frame = pd.concat(pages, ignore_index=True) if len(pages) > 1 else first
+    if not frame.empty:
+        frame = frame.drop_duplicates(subset=key, ignore_index=True)
+    if len(frame) < total:
+        raise RuntimeError(f"{table}: fetched {len(frame)} of {total} rows")
+    return frame
+
+
+def page_report(last=50):
+    """直近のページ取得の記録 (新しい順)"""
+    with _PAGE_LOG_LOCK:
+        entries = list(_PAGE_LOG)[-last:]
+    return pd.DataFrame(
+        reversed(entries),
+        columns=["table", "page", "offset", "rows", "seconds", "at"],
+    )
+
+
+# --- 0.7 書き込みジャーナル (Write-Behind) ---
+# 保存操作はローカルのジャーナルに記録した時点で完了とし、Supabase へはバックグラウンドで送る。
+# 同じキーへの連続した書き込みは最新の1件にまとめ、テーブルごとに1回の Upsert で送信する。
+# Upsert はキー (log_date / name / key) で冪等なので、送信に失敗しても再送すればよい。
+# テーブルごとに独立して送り、あるテーブルの失敗で他のテーブルの送信を止めない。
+# サーバに拒否された (権限・制約違反など、再送しても成功しない) 書き込みは1件ずつ送り直して
+# 該当する行だけを隔離し、残りを送る (隔離した行は rejected_writes() で画面に出し、再送か破棄を選ぶ)
+# 書き込み後に連続して保存される分をまとめるため、送信前に少し待つ (秒)
+JOURNAL_FLUSH_DELAY = 0.5
+# 送信失敗時の再試行間隔 (秒): 失敗のたびに倍にし、上限で止める
+JOURNAL_RETRY_MIN = 2
+JOURNAL_RETRY_MAX = 60
+
+_JOURNAL = None  # {(table, key): (エントリ ID, record)} 未送信分 (ディスクと同じ内容)
+_JOURNAL_LOCK = threading.Lock()
+_JOURNAL_WAKE = threading.Event()
+_JOURNAL_STATUS = {"error": None, "flushed_at": None}
+_FLUSHER = None
+
+
+def _journal():
+    # 初回参照時に前回のプロセスで送れなかった分を読み込む。_JOURNAL_LOCK 保持中に呼ぶ
+    global _JOURNAL
+    if _JOURNAL is None:
+        _JOURNAL = {}
+        for entry_id, table, record in local_replica.journal_load():
+            key = str(record[local_replica.TABLE_KEYS[table]])
+            _JOURNAL[(table, key)] = (entry_id, record)
+        if _JOURNAL:
+            _JOURNAL_WAKE.set()
+    return _JOURNAL
+
+
+def _enqueue(table, record):
+    key = str(record[local_replica.TABLE_KEYS[table]])
+    with _JOURNAL_LOCK:
+        entry_id = local_replica.journal_put(table, record)
+        _journal()[(table, key)] = (entry_id, record)
+    _ensure_flusher()
+    _JOURNAL_WAKE.set()
+
+
+def _pending(table):
+    with _JOURNAL_LOCK:
+        return [rec for (t, _), (_, rec) in _journal().items() if t == table]
+
+
+def _send_entries(supabase, table, entries):
+    records = [record for _, _, record in entries]
+    on_conflict = local_replica.TABLE_KEYS[table]
+    response = transport.execute(
+        supabase.table(table).upsert(records, on_conflict=on_conflict),
+        f"{table}.upsert",
+    )
+    # 書き込まれた行 (サーバが返した値。無ければ送った値) をキャッシュへ直接反映してから
+    # ジャーナルから消す (反映前に消すと一瞬だけ古い値が見える)
+    _apply_written(table, response.data or records)
+
+    with _JOURNAL_LOCK:
+        journal = _journal()
+        # 送信中に同じキーへ書き込まれた分は次回送る
+        sent = [
+            (key, entry_id)
+            for key, entry_id, _ in entries
+            if journal.get((table, key), (None,))[0] == entry_id
+        ]
+        local_replica.journal_delete([entry_id for _, entry_id in sent])
+        for key, _ in sent:
+            del journal[(table, key)]
+
+
+def _quarantine(table, entry, error):
+    key, entry_id, _ = entry
+    with _JOURNAL_LOCK:
+        journal = _journal()
+        # 送信中に同じキーへ新しく書き込まれていれば、拒否された古い値は捨てて新しい値を送る
+        if journal.get((table, key), (None,))[0] != entry_id:
+            return
+        local_replica.journal_quarantine(entry_id, f"{type(error).__name__}: {error}")
+        del journal[(table, key)]
+
+
+def _flush_table(supabase, table, entries):
+    try:
+        _send_entries(supabase, table, entries)
+    except Exception as e:
+        if not transport.is_permanent(e):
+            raise
+        if len(entries) == 1:
+            _quarantine(table, entries[0], e)
+            return
+        # どの行が拒否されたか分からないため、1件ずつ送り直す
+        for entry in entries:
+            _flush_table(supabase, table, [entry])
+
+
+def _flush_journal():
+    """
+    未送信の書き込みをテーブルごとに送る
+    Returns: 送れなかったテーブルの誤り (文字列) のリスト (すべて送れたら空)
+    """
+    with _JOURNAL_LOCK:
+        snapshot = list(_journal().items())
+    if not snapshot:
+        return []
+    by_table = {}
+    for (table, key), (entry_id, record) in snapshot:
+        by_table.setdefault(table, []).append((key, entry_id, record))
+
+    supabase = init_connection()
+    errors = []
+    for table, entries in by_table.items():
+        try:
+            _flush_table(supabase, table, entries)
+        except Exception as e:
+            errors.append(f"{table}: {type(e).__name__}: {e}")
+    if not errors:
+        _JOURNAL_STATUS.update(error=None, flushed_at=time.time())
+    return errors
+
+
+def _dict_cache(table):
+    return {
+        "food_master": (fetch_food_list, _food_dict),
+        "menu_master": (fetch_menu_list, _menu_dict),
+        "settings": (fetch_settings, _settings_dict),
+    }[table]
+
+
+def _apply_written(table, rows):
+    """
+    書き込んだ行をキャッシュ・同期状態・ローカル複製に反映する (テーブル全体は取り直さない)
+    他の端末の変更は変更通知 (Realtime) か、TTL ごとの (差分) 同期で取り込む
+    """
+    if table == "daily_logs":
+        # High-Water Mark は進めない (この行より前に他の端末が書いた行を取りこぼさないため)
+        with _LOG_SYNC_LOCK:
+            if _LOG_SYNC["df"] is not None:
+                _LOG_SYNC["df"] = _merge_logs(_LOG_SYNC["df"], rows)
+                local_replica.upsert_rows(table, rows, _sync_meta())
+        fetch_raw_data.patch(lambda df: _merge_logs(df, rows))
+        return
+
+    cache, build = _dict_cache(table)
+    if cache.patch(lambda value: {**value, **build(rows)}):
+        local_replica.upsert_rows(table, rows)
+
+
+def _apply_deleted(table, record):
+    """削除された行をキャッシュ・同期状態・ローカル複製から除く"""
+    key = local_replica.TABLE_KEYS[table]
+    if table == "daily_logs":
+        if key not in record:
+            # 主キー (id) しか届かない場合 (REPLICA IDENTITY が既定) は全件を取り直す
+            with _LOG_SYNC_LOCK:
+                _LOG_SYNC["full_at"] = 0.0
+            fetch_raw_data.expire()
+            return
+        day = pd.Timestamp(record[key])
+        with _LOG_SYNC_LOCK:
+            if _LOG_SYNC["df"] is not None:
+                _LOG_SYNC["df"] = _LOG_SYNC["df"][_LOG_SYNC["df"]["ds"] != day]
+                _LOG_SYNC["df"] = _LOG_SYNC["df"].reset_index(drop=True)
+        fetch_raw_data.patch(lambda df: df[df["ds"] != day].reset_index(drop=True))
+        local_replica.delete_rows(table, [record[key]])
+        return
+
+    cache, _ = _dict_cache(table)
+    if key not in record:
+        cache.expire()
+        return
+    name = record[key]
+    if cache.patch(lambda value: {k: v for k, v in value.items() if k != name}):
+        local_replica.delete_rows(table, [name])
+
+
+def _flush_loop():
+    retry = JOURNAL_RETRY_MIN
+    while True:
+        with _JOURNAL_LOCK:
+            has_pending = bool(_journal())
+        _JOURNAL_WAKE.wait(timeout=retry if has_pending else None)
+        _JOURNAL_WAKE.clear()
+        time.sleep(JOURNAL_FLUSH_DELAY)
+        try:
+            errors = _flush_journal()
+        except Exception as e:
+            errors = [f"{type(e).__name__}: {e}"]
+        if errors:
+            _JOURNAL_STATUS.update(error="; ".join(errors))
+            retry = min(retry * 2, JOURNAL_RETRY_MAX)
+        else:
+            retry = JOURNAL_RETRY_MIN
+
+
+def _ensure_flusher():
+    global _FLUSHER
+    with _JOURNAL_LOCK:
+        if _FLUSHER is None or not _FLUSHER.is_alive():
+            _FLUSHER = threading.Thread(
+                target=_flush_loop, name="supabase-journal", daemon=True
+            )
+            _FLUSHER.start()
+
+
+def pending_writes():
+    """
+    まだ Supabase に送れていない書き込みの件数と直近の送信エラー
+    Returns: (件数, エラー文字列 or None)
+    """
+    with _JOURNAL_LOCK:
+        n = len(_journal())
+    if n:
+        # 前回のプロセスで送れなかった分があれば送信を始める
+        _ensure_flusher()
+    return n, _JOURNAL_STATUS["error"] if n else None
+
+
+def rejected_writes():
+    """
+    サーバに拒否されて隔離した書き込み (送信も表示への反映もしていない)
+    Returns: [{"id", "table", "key", "record", "error", "failed_at"}, ...]
+    """
+    return [
+        {
+            "id": entry_id,
+            "table": table,
+            "key": record.get(local_replica.TABLE_KEYS[table]),
+            "record": record,
+            "error": error,
+            "failed_at": failed_at,
+        }
+        for entry_id, table, record, error, failed_at in local_replica.quarantine_load()
+    ]
+
+
+def retry_rejected(entry_ids):
+    """隔離した書き込みを送信待ちに戻す (権限・データを直した後の再送)"""
+    rejected = {w["id"]: w for w in rejected_writes()}
+    for entry_id in entry_ids:
+        if entry_id in rejected:
+            _enqueue(rejected[entry_id]["table"], rejected[entry_id]["record"])
+    local_replica.quarantine_delete(entry_ids)
+
+
+def discard_rejected(entry_ids):
+    """隔離した書き込みを破棄する"""
+    local_replica.quarantine_delete(entry_ids)
+
+
+def _dict_overlay(table, build):
+    """未送信の書き込みを取得結果 (名前・キーごとの dict) に重ねる overlay 関数"""
+
+    def overlay(value):
+        records = _pending(table)
+        return {**value, **build(records)} if records else value
+
+    return overlay
+
+
+def _raw_data_fallback(e):
+    st.error(f"Data fetch error: {e}")
+    return _to_app_frame([])
+
+
 # --- 1. Daily Log 取得 (Read) ---
-@st.cache_data(ttl=60)
+# 差分同期: 手元のコピーと最終更新時刻 (High-Water Mark) を保持し、それ以降に変更された行だけ取得する
+# updated_at 列 (更新トリガー付き) があれば Upsert による更新も拾える。
+# なければ差分同期は使わず、TTL ごとに取得済み期間を全件取り直す (created_at では更新を拾えない)
+SYNC_COLUMNS = ("updated_at", "created_at")
+# 境界付近で同時にコミットされた行を取りこぼさないよう、少し遡って取得する (秒)
+SYNC_OVERLAP = 5
+# 削除行の反映などのため、この間隔 (秒) で全件を取り直す
+FULL_RESYNC_INTERVAL = 3600
+
+# アプリが使う列だけ取得する (note, id などは取得しない)
+LOG_COLUMNS = ("log_date", "weight", "calories", "protein", "fat", "carbs")
+# 初回表示では直近この日数だけ取得し、それより古い期間は必要な画面で追加取得する
+# (KPI・Simulator 45日・Stats 60日・Nutrition 14日 + 移動平均の助走分)
+HISTORY_WINDOW_DAYS = int(os.environ.get("LOG_WINDOW_DAYS", "120"))
+
+_LOG_SYNC = {
+    "df": None,
+    "column": None,
+    "mark": None,
+    "full_at": 0.0,
+    "since": None,  # 取得済み期間の開始日 (None は全期間取得済み)
+}
+_LOG_SYNC_LOCK = threading.Lock()
+
+
+def _to_app_frame(rows):
+    df = pd.DataFrame(rows)
+
+    if df.empty:
+        return pd.DataFrame(columns=["ds", "y", "Calories", "Protein", "Fat", "Carbs"])
+
+    # カラム名のマッピング (DB列名 -> アプリでの使用名)
+    # アプリ側(logic.py等)は "ds", "y" を期待しているためここで変換
+    rename_map = {
+        "log_date": "ds",
+        "weight": "y",
+        "calories": "Calories",
+        "protein": "Protein",
+        "fat": "Fat",
+        "carbs": "Carbs",
+        "created_at": "ts",  # ソート順序保証用
+    }
+    df = df.rename(columns=rename_map)
+
+    # 型変換
+    df["ds"] = pd.to_datetime(df["ds"])
+    df["y"] = pd.to_numeric(df["y"], errors="coerce")
+
+    return df
+
+
+def _high_water_mark(frame, column, mark=None):
+    values = [] if mark is None else [mark]
+    if column in frame and frame[column].notna().any():
+        stamps = pd.to_datetime(frame[column], utc=True, format="ISO8601")
+        values.append(frame[column].loc[stamps.idxmax()])
+    return max(values, key=pd.Timestamp) if values else None
+
+
+def _detect_sync_column(supabase):
+    # 1行だけ全列で取得し、差分同期に使える列を調べる
+    response = transport.execute(
+        supabase.table("daily_logs").select("*").limit(1), "daily_logs.detect"
+    )
+    rows = response.data
+    return next((c for c in SYNC_COLUMNS if rows and c in rows[0]), None)
+
+
+def _select_columns(column):
+    return ",".join(LOG_COLUMNS + ((column,) if column else ()))
+
+
+def _window_start():
+    start = datetime.date.today() - datetime.timedelta(days=HISTORY_WINDOW_DAYS)
+    return start.isoformat()
+
+
+def _fetch_logs(
+    supabase, column, since=None, before=None, fmt=None, table="daily_logs"
+):
+    # log_date の昇順で、必要な列・期間だけページ分割して取得
+    def make_query(count):
+        query = supabase.table("daily_logs").select(
+            _select_columns(column), count=count
+        )
+        if since is not None:
+            query = query.gte("log_date", since)
+        if before is not None:
+            query = query.lt("log_date", before)
+        return query.order("log_date", desc=False)
+
+    return _fetch_all_pages(make_query, table, "log_date", fmt)
+
+
+def _full_sync(supabase):
+    # 初回は直近の期間だけ。以降は取得済みの期間 (追加取得後は全期間) を取り直す
+    since = _LOG_SYNC["since"] if _LOG_SYNC["df"] is not None else _window_start()
+    column = _LOG_SYNC["column"] or _detect_sync_column(supabase)
+    frame = _fetch_logs(supabase, column, since=since)
+    _LOG_SYNC.update(
+        df=_to_app_frame(frame),
+        column=column,
+        mark=_high_water_mark(frame, column) if column else None,
+        full_at=time.time(),
+        since=since,
+    )
+    local_replica.save_table("daily_logs", frame, _sync_meta())
+
+
+def _backfill(supabase):
+    # 取得済み期間より古い行を追加取得して結合する
+    column, since = _LOG_SYNC["column"], _LOG_SYNC["since"]
+    frame = _fetch_logs(supabase, column, before=since)
+    if not frame.empty:
+        old = _to_app_frame(frame)
+        df = _LOG_SYNC["df"]
+        df = pd.concat([old, df[~df["ds"].isin(old["ds"])]], ignore_index=True)
+        df = df.sort_values("ds").reset_index(drop=True)
+        _LOG_SYNC.update(df=df)
+    _LOG_SYNC.update(since=None)
+    local_replica.upsert_rows("daily_logs", frame, _sync_meta())
+
+
+def _delta_sync(supabase):
+    column, mark = _LOG_SYNC["column"], _LOG_SYNC["mark"]
+    since = (pd.Timestamp(mark) - pd.Timedelta(seconds=SYNC_OVERLAP)).isoformat()
+    # 長期間オフラインだった後は差分も大きくなり得るため、同じくページ分割で取得
+    # (更新でずれない log_date 順に並べる)
+    frame = _fetch_all_pages(
+        lambda count: supabase.table("daily_logs")
+        .select(_select_columns(column), count=count)
+        .gte(column, since)
+        .order("log_date", desc=False),
+        "daily_logs",
+        "log_date",
+    )
+
+    df = _LOG_SYNC["df"]
+    if not frame.empty:
+        # 変更行で置き換え
+        df = _merge_logs(df, frame)
+
+    # 取得済み期間の件数が合わない (削除があった等) 場合は全件を取り直す
+    window = _LOG_SYNC["since"]
+    total = _count_daily_logs(supabase, window)
+    loaded = len(df) if window is None else int((df["ds"] >= window).sum())
+    if total is not None and total != loaded:
+        _full_sync(supabase)
+        return
+    _LOG_SYNC.update(df=df, mark=_high_water_mark(frame, column, mark))
+    local_replica.upsert_rows("daily_logs", frame, _sync_meta())
+
+
+def _sync_meta():
+    return {k: _LOG_SYNC[k] for k in ("column", "mark", "full_at", "since")}
+
+
+def _seed_raw_data():
+    # 前回の同期状態ごと復元し、最初の通信を差分同期で済ませる
+    rows, meta = local_replica.load_table("daily_logs")
+    with _LOG_SYNC_LOCK:
+        if _LOG_SYNC["df"] is None:
+            if rows is None:
+                return None
+            _LOG_SYNC.update(
+                df=_to_app_frame(rows),
+                column=meta.get("column"),
+                mark=meta.get("mark"),
+                full_at=meta.get("full_at") or 0.0,
+                since=meta.get("since"),
+            )
+        return _LOG_SYNC["df"].copy()
+
+
+def _count_daily_logs(supabase, since=None):
+    query = supabase.table("daily_logs").select("log_date", count="exact")
+    if since is not None:
+        query = query.gte("log_date", since)
+    return transport.execute(query.limit(1), "daily_logs.count").count
+
+
+def _merge_logs(df, rows):
+    # 同じ日付の行を置き換え、日付順に並べる (log_date が一意キー)
+    new = _to_app_frame(rows).reindex(columns=df.columns)
+    df = pd.concat([df[~df["ds"].isin(new["ds"])], new], ignore_index=True)
+    return df.sort_values("ds").reset_index(drop=True)
+
+
+def _overlay_logs(df):
+    # 未送信の Daily Log を同じ日付の行と置き換えて表示する
+    records = _pending("daily_logs")
+    return _merge_logs(df, records) if records else df
+
+
+@single_flight(
+    ttl=60,
+    fallback=_raw_data_fallback,
+    seed=_seed_raw_data,
+    overlay=_overlay_logs,
+    table="daily_logs",
+)
 def fetch_raw_data() -> pd.DataFrame:
     supabase = init_connection()
-    try:
-        # log_date の昇順で取得
-        response = (
-            supabase.table("daily_logs")
-            .select("*")
-            .order("log_date", desc=False)
-            .execute()
+    with _LOG_SYNC_LOCK:
+        # created_at しかない (updated_at の移行前の) スキーマでは、他の端末による既存日の
+        # Upsert を差分同期で拾えないため、毎回 (TTL ごとに) 取得済み期間を取り直す
+        needs_full = (
+            _LOG_SYNC["df"] is None
+            or _LOG_SYNC["mark"] is None
+            or _LOG_SYNC["column"] != "updated_at"
+            or time.time() - _LOG_SYNC["full_at"] > FULL_RESYNC_INTERVAL
         )
-        df = pd.DataFrame(response.data)
+        if needs_full:
+            _full_sync(supabase)
+        else:
+            _delta_sync(supabase)
+        return _LOG_SYNC["df"].copy()
 
-        if df.empty:
-            return pd.DataFrame(
-                columns=["ds", "y", "Calories", "Protein", "Fat", "Carbs"]
+
+def fetch_full_history() -> pd.DataFrame:
+    """
+    全期間の Daily Log (Career Timeline・モデル学習・エクスポート用)
+    初回表示で取得していない古い期間があれば、ここで初めて追加取得する
+    """
+    df = fetch_raw_data()
+    with _LOG_SYNC_LOCK:
+        if _LOG_SYNC["since"] is None or _LOG_SYNC["df"] is None:
+            return df
+        try:
+            _backfill(init_connection())
+        except Exception as e:
+            st.warning(f"Older history could not be loaded: {e}")
+            return df
+        full = _LOG_SYNC["df"].copy()
+    # 次回の取得から全期間を返す (取り直さずにキャッシュを差し替える)
+    fetch_raw_data.patch(lambda _: full.copy())
+    return _overlay_logs(full)
+
+
+def fetch_logs_between(since, before):
+    """
+    log_date が [since, before) の Daily Log (キャッシュしない)
+    初回表示の取得期間や追加取得の有無に左右されない固定の期間が必要な、まれな処理 (代謝パラメータの推定) 用
+    """
+    frame = _fetch_logs(init_connection(), None, since=str(since), before=str(before))
+    return _overlay_logs(_to_app_frame(frame))
+
+
+def benchmark_bulk_read(rounds=3):
+    """
+    取得済み期間の Daily Log を JSON / CSV の両形式で取得し、アプリ用 DataFrame にするまでの
+    所要時間 (最速値) とピークメモリを比較する
+    """
+    supabase = init_connection()
+    with _LOG_SYNC_LOCK:
+        column, since = _LOG_SYNC["column"], _LOG_SYNC["since"]
+
+    results = []
+    for fmt in ("json", "csv"):
+        table = f"daily_logs ({fmt} bench)"
+        seconds = []
+        for _ in range(rounds):
+            t0 = time.perf_counter()
+            df = _to_app_frame(
+                _fetch_logs(supabase, column, since, fmt=fmt, table=table)
             )
+            seconds.append(time.perf_counter() - t0)
 
-        # カラム名のマッピング (DB列名 -> アプリでの使用名)
-        # アプリ側(logic.py等)は "ds", "y" を期待しているためここで変換
-        rename_map = {
-            "log_date": "ds",
-            "weight": "y",
-            "calories": "Calories",
-            "protein": "Protein",
-            "fat": "Fat",
-            "carbs": "Carbs",
-            "created_at": "ts",  # ソート順序保証用
-        }
-        df = df.rename(columns=rename_map)
+        tracemalloc.start()
+        try:
+            _to_app_frame(_fetch_logs(supabase, column, since, fmt=fmt, table=table))
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        results.append(
+            {
+                "Format": fmt.upper(),
+                "Rows": len(df),
+                "Seconds": min(seconds),
+                "Peak MB": peak / 1e6,
+            }
+        )
+    return pd.DataFrame(results)
 
-        # 型変換
-        df["ds"] = pd.to_datetime(df["ds"])
-        df["y"] = pd.to_numeric(df["y"], errors="coerce")
 
-        return df
-    except Exception as e:
-        st.error(f"Data fetch error: {e}")
-        return pd.DataFrame()
+def loaded_since():
+    """取得済み期間の開始日 (全期間取得済みなら None)"""
+    with _LOG_SYNC_LOCK:
+        since = _LOG_SYNC["since"]
+    return None if since is None else datetime.date.fromisoformat(since)
 
 
 # --- 2. 食品マスタ取得 (Read) ---
-@st.cache_data(ttl=600)
+def _food_dict(data):
+    food_dict = {}
+    for item in data:
+        food_dict[item["name"]] = {
+            "p": float(item.get("protein") or 0),
+            "f": float(item.get("fat") or 0),
+            "c": float(item.get("carbs") or 0),
+            "cal": int(item.get("calories") or 0),
+            "category": item.get("category") or "General",
+        }
+    return food_dict
+
+
+@single_flight(
+    ttl=600,
+    fallback=lambda e: {},
+    seed=_replica_seed("food_master", _food_dict),
+    overlay=_dict_overlay("food_master", _food_dict),
+    table="food_master",
+)
 def fetch_food_list():
     """
     Returns: {"白米": {"p": 2.5, "f": 0.3, "c": 37.1, "cal": 168}, ...}
     """
     supabase = init_connection()
-    try:
-        response = supabase.table("food_master").select("*").order("name").execute()
-        data = response.data
-
-        food_dict = {}
-        for item in data:
-            food_dict[item["name"]] = {
-                "p": float(item.get("protein") or 0),
-                "f": float(item.get("fat") or 0),
-                "c": float(item.get("carbs") or 0),
-                "cal": int(item.get("calories") or 0),
-                "category": item.get("category") or "General",
-            }
-        return food_dict
-    except Exception:
-        return {}
+    response = transport.execute(
+        supabase.table("food_master").select("*").order("name"), "food_master.select"
+    )
+    local_replica.save_table("food_master", response.data)
+    return _food_dict(response.data)
 
 
 # --- 3. 過去CSV取得 (Read) ---
@@ -102,8 +972,6 @@ def fetch_history_csv():
 
 # --- 4. Daily Log 保存 (Upsert) ---
 def add_daily_log(date_obj, weight, note, kcal=0, p=0, f=0, c=0):
-    supabase = init_connection()
-
     # 登録データ
     record = {
         "log_date": str(date_obj),
@@ -115,16 +983,12 @@ def add_daily_log(date_obj, weight, note, kcal=0, p=0, f=0, c=0):
         "carbs": float(c),
     }
 
-    # log_dateをキーにしてUpsert (重複時は更新)
-    supabase.table("daily_logs").upsert(record, on_conflict="log_date").execute()
-
-    # キャッシュクリア
-    fetch_raw_data.clear()
+    # ジャーナルに記録し、log_dateをキーにしてバックグラウンドでUpsert (重複時は更新)
+    _enqueue("daily_logs", record)
 
 
 # --- 5. 食品マスタ登録 (Create) ---
 def add_food_item(name, p, f, c, cal, category="General"):
-    supabase = init_connection()
     record = {
         "name": name,
         "calories": int(cal),
@@ -133,33 +997,40 @@ def add_food_item(name, p, f, c, cal, category="General"):
         "carbs": float(c),
         "category": category,
     }
-    supabase.table("food_master").upsert(record, on_conflict="name").execute()
-    fetch_food_list.clear()
+    _enqueue("food_master", record)
 
 
 # --- 6. 設定値の取得 (Read) ---
-@st.cache_data(ttl=60)
+def _settings_dict(data):
+    settings = {}
+    for item in data:
+        key = item["key"]
+        # 数値があれば数値を、なければ文字列を使用
+        if item["value_num"] is not None:
+            settings[key] = float(item["value_num"])
+        else:
+            settings[key] = item["value_str"]
+    return settings
+
+
+@single_flight(
+    ttl=60,
+    fallback=lambda e: {},
+    seed=_replica_seed("settings", _settings_dict),
+    overlay=_dict_overlay("settings", _settings_dict),
+    table="settings",
+)
 def fetch_settings():
     supabase = init_connection()
-    try:
-        response = supabase.table("settings").select("*").execute()
-        settings = {}
-        for item in response.data:
-            key = item["key"]
-            # 数値があれば数値を、なければ文字列を使用
-            if item["value_num"] is not None:
-                settings[key] = float(item["value_num"])
-            else:
-                settings[key] = item["value_str"]
-        return settings
-    except Exception:
-        return {}
+    response = transport.execute(
+        supabase.table("settings").select("*"), "settings.select"
+    )
+    local_replica.save_table("settings", response.data)
+    return _settings_dict(response.data)
 
 
 # --- 7. 設定値の更新 (Upsert) ---
 def update_setting(key, new_value):
-    supabase = init_connection()
-
     record = {"key": key}
     if isinstance(new_value, (int, float)):
         record["value_num"] = float(new_value)
@@ -168,32 +1039,192 @@ def update_setting(key, new_value):
         record["value_num"] = None
         record["value_str"] = str(new_value)
 
-    supabase.table("settings").upsert(record, on_conflict="key").execute()
-    fetch_settings.clear()
+    # 連続した更新 (設定フォーム) はまとめて1回の Upsert で送られる
+    _enqueue("settings", record)
 
 
 # --- 8. セットメニュー保存 (Upsert) ---
 def save_menu_item(set_name, items_list):
-    supabase = init_connection()
     # JSON型として保存
     record = {
         "name": set_name,
         "recipe": items_list,  # Supabase(Python lib)が自動でJSONシリアライズしてくれます
     }
-    supabase.table("menu_master").upsert(record, on_conflict="name").execute()
-    fetch_menu_list.clear()
+    _enqueue("menu_master", record)
 
 
 # --- 9. セットメニュー取得 (Read) ---
-@st.cache_data(ttl=600)
+def _menu_dict(data):
+    menu_dict = {}
+    for item in data:
+        # item["recipe"] は既にPythonのリスト/辞書になっている
+        menu_dict[item["name"]] = item["recipe"]
+    return menu_dict
+
+
+@single_flight(
+    ttl=600,
+    fallback=lambda e: {},
+    seed=_replica_seed("menu_master", _menu_dict),
+    overlay=_dict_overlay("menu_master", _menu_dict),
+    table="menu_master",
+)
 def fetch_menu_list():
     supabase = init_connection()
+    response = transport.execute(
+        supabase.table("menu_master").select("*"), "menu_master.select"
+    )
+    local_replica.save_table("menu_master", response.data)
+    return _menu_dict(response.data)
+
+
+# --- 10. 起動時の一括取得 (Read) ---
+# 互いに独立した取得を同時に始め、最初の描画が一番遅い取得だけを待つようにする
+# 取得元 -> (取得関数, 失敗時の値を作る関数)。失敗時も呼び出し側が期待する型の空の値を返す
+_STARTUP_SOURCES = {
+    "settings": (fetch_settings, dict),
+    "food": (fetch_food_list, dict),
+    "menu": (fetch_menu_list, dict),
+    "logs": (fetch_raw_data, lambda: _to_app_frame([])),
+    "history": (fetch_history_csv, lambda: None),
+}
+_STARTUP_TIMINGS = []
+_STARTUP_TIMINGS_LOCK = threading.Lock()
+
+
+def _timed_load(name, ctx):
+    # st.cache_data・st.error を呼べるよう、実行中のスクリプトのコンテキストを引き継ぐ
+    if ctx is not None:
+        add_script_run_ctx(threading.current_thread(), ctx)
+    loader, default = _STARTUP_SOURCES[name]
+    t0 = time.perf_counter()
     try:
-        response = supabase.table("menu_master").select("*").execute()
-        menu_dict = {}
-        for item in response.data:
-            # item["recipe"] は既にPythonのリスト/辞書になっている
-            menu_dict[item["name"]] = item["recipe"]
-        return menu_dict
+        value, status = loader(), "ok"
+    except Exception as e:
+        value, status = default(), f"{type(e).__name__}: {e}"
+    return value, {
+        "Source": name,
+        "Seconds": time.perf_counter() - t0,
+        "Status": status,
+    }
+
+
+def load_startup():
+    """
+    設定・食品マスタ・セットメニュー・Daily Log・過去CSV を並列に取得する
+    Returns: {"settings": dict, "food": dict, "menu": dict, "logs": DataFrame, "history": DataFrame or None}
+    """
+    ctx = get_script_run_ctx()
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(_STARTUP_SOURCES)) as pool:
+        futures = {
+            name: pool.submit(_timed_load, name, ctx) for name in _STARTUP_SOURCES
+        }
+        results = {name: f.result() for name, f in futures.items()}
+
+    timings = [timing for _, timing in results.values()]
+    timings.append(
+        {"Source": "total", "Seconds": time.perf_counter() - t0, "Status": "ok"}
+    )
+    with _STARTUP_TIMINGS_LOCK:
+        _STARTUP_TIMINGS[:] = timings
+    return {name: value for name, (value, _) in results.items()}
+
+
+def startup_report():
+    """直近の load_startup() の取得元ごとの所要時間"""
+    with _STARTUP_TIMINGS_LOCK:
+        return pd.DataFrame(_STARTUP_TIMINGS, columns=["Source", "Seconds", "Status"])
+
+
+# --- 11. 変更通知 (Realtime) ---
+# daily_logs・settings・food_master・menu_master の変更を購読し、届いた行をキャッシュへ直接反映する。
+# 購読中は TTL ごとの再取得 (ポーリング) を止め、切断されたら TTL ごとのポーリングに戻る。
+# テーブルが supabase_realtime publication に入っていないと、購読できても通知は届かない。
+# そのため TTL を延ばすのは、今の購読で実際に変更通知が届いたテーブルだけにする
+_REALTIME = {
+    "status": "off",
+    "error": None,
+    "events": 0,
+    "last_event_at": None,
+    "delivering": set(),  # 今の購読で変更通知が届いたテーブル
+}
+_REALTIME_LOCK = threading.Lock()
+_REALTIME_THREAD = None
+
+
+def _realtime_live(table):
+    return _REALTIME["status"] == "live" and table in _REALTIME["delivering"]
+
+
+def _on_change(change):
+    table = change["table"]
+    if table not in change_feed.WATCH_TABLES:
+        return
+    if change["type"] == "DELETE":
+        _apply_deleted(table, change.get("old_record") or {})
+    elif change.get("record"):
+        _apply_written(table, [change["record"]])
+    with _REALTIME_LOCK:
+        _REALTIME["events"] += 1
+        _REALTIME["last_event_at"] = time.time()
+        _REALTIME["delivering"].add(table)
+
+
+def _on_status(status, error):
+    with _REALTIME_LOCK:
+        changed = _REALTIME["status"] != status
+        _REALTIME.update(status=status, error=None if error is None else str(error))
+        if changed:
+            _REALTIME["delivering"] = set()
+    if changed:
+        # 購読の開始・切断をまたぐ間の変更は届かないため、差分同期で取り直す
+        for cache in _SINGLE_FLIGHTS:
+            if cache.table in change_feed.WATCH_TABLES:
+                cache.expire()
+
+
+def _run_feed(feed):
+    try:
+        feed.run(_on_change, _on_status)
+    except Exception as e:
+        _on_status("dropped", e)
+
+
+def _default_feed():
+    # 組み込みエンジンへの書き込みはこのプロセスからのみ (自分の書き込みは _apply_written で反映済み)
+    if STORAGE_BACKEND != "supabase" or os.environ.get("SUPABASE_REALTIME", "1") == "0":
+        return None
+    try:
+        conf = st.secrets["connections"]["supabase"]
+        return change_feed.SupabaseRealtimeFeed(
+            conf["SUPABASE_URL"], conf["SUPABASE_KEY"]
+        )
     except Exception:
-        return {}
+        return None
+
+
+def start_realtime(feed=None):
+    """
+    変更通知の購読を開始する (プロセスで1回だけ。2回目以降は何もしない)
+    feed を省略すると Supabase Realtime を使う。テストでは change_feed.LocalChangeFeed を渡す
+    """
+    global _REALTIME_THREAD
+    with _REALTIME_LOCK:
+        if _REALTIME_THREAD is not None and _REALTIME_THREAD.is_alive():
+            return False
+        feed = feed or _default_feed()
+        if feed is None:
+            return False
+        _REALTIME.update(status="connecting", error=None)
+        _REALTIME_THREAD = threading.Thread(
+            target=_run_feed, args=(feed,), name="supabase-realtime", daemon=True
+        )
+        _REALTIME_THREAD.start()
+        return True
+
+
+def realtime_status():
+    """購読状態 (off / connecting / live / dropped)・受信件数・最終受信時刻・通知が届いたテーブル"""
+    with _REALTIME_LOCK:
+        return dict(_REALTIME, delivering=sorted(_REALTIME["delivering"]))
@@ -0,0 +1,85 @@
+import datetime
+import time
+
+import pytest
+
+pytest.importorskip("supabase")
+
+import change_feed
+import local_engine
+import local_replica
+import supabase_db
+
+
+def _day(days_ago):
+    return (datetime.date.today() - datetime.timedelta(days=days_ago)).isoformat()
+
+
+def _wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def local_backend(tmp_path, monkeypatch):
+    # 組み込みエンジン・ローカル複製とも一時ディレクトリに作る (通信なし)
+    monkeypatch.setattr(supabase_db, "STORAGE_BACKEND", "local")
+    monkeypatch.setattr(local_engine, "ENGINE_PATH", str(tmp_path / "engine.sqlite3"))
+    monkeypatch.setattr(
+        local_replica, "REPLICA_PATH", str(tmp_path / "replica.sqlite3")
+    )
+    supabase_db.init_connection.clear()
+    yield supabase_db.init_connection()
+    supabase_db.init_connection.clear()
+
+
+def test_local_change_feed_patches_replica_and_cache(local_backend, monkeypatch):
+    engine = local_backend
+    engine.upsert("daily_logs", [{"log_date": _day(3), "weight": 70.0}], "log_date")
+
+    feed = change_feed.LocalChangeFeed()
+    assert supabase_db.start_realtime(feed)
+    # 購読開始時の expire() が済んでから取得する
+    _wait_for(lambda: supabase_db.realtime_status()["status"] == "live")
+    assert supabase_db.fetch_raw_data()["y"].tolist() == [70.0]
+
+    # 以降は通知だけで反映されること (テーブルを取り直さない)
+    syncs = []
+    for name in ("_full_sync", "_delta_sync"):
+        sync = getattr(supabase_db, name)
+        monkeypatch.setattr(
+            supabase_db, name, lambda s, sync=sync: syncs.append(s) or sync(s)
+        )
+
+    def publish(type, record=None, old_record=None):
+        feed.publish("daily_logs", type, record=record, old_record=old_record)
+        feed.wait()
+
+    (row,) = engine.upsert(
+        "daily_logs", [{"log_date": _day(1), "weight": 69.5}], "log_date"
+    )
+    publish("INSERT", record=row)
+    (row,) = engine.upsert(
+        "daily_logs", [{"log_date": _day(3), "weight": 70.4}], "log_date"
+    )
+    publish("UPDATE", record=row)
+    with engine.connection() as conn:
+        conn.execute("DELETE FROM daily_logs WHERE log_date = ?", (_day(1),))
+    publish("DELETE", old_record={"log_date": _day(1)})
+    (row,) = engine.upsert(
+        "daily_logs", [{"log_date": _day(0), "weight": 70.1}], "log_date"
+    )
+    publish("INSERT", record=row)
+
+    df = supabase_db.fetch_raw_data()
+    assert df["ds"].dt.strftime("%Y-%m-%d").tolist() == [_day(3), _day(0)]
+    assert df["y"].tolist() == [70.4, 70.1]
+    rows, _ = local_replica.load_table("daily_logs")
+    assert {r["log_date"]: r["weight"] for r in rows} == {_day(3): 70.4, _day(0): 70.1}
+    assert syncs == []
+
+    status = supabase_db.realtime_status()
+    assert status["events"] == 4
+    assert status["delivering"] == ["daily_logs"]
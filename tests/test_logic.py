@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import logic
+
+
+def _logs(days, start="2026-01-01"):
+    return pd.DataFrame(
+        {
+            "ds": pd.date_range(start, periods=days),
+            "y": 70.0 - 0.1 * np.arange(days),
+            "Calories": np.full(days, 2000.0),
+        }
+    )
+
+
+@pytest.mark.parametrize("days", [1, 2, 5, 6, 7, 13, 14, 21])
+def test_run_fast_model_short_history(days):
+    df = _logs(days)
+    target = df["ds"].iloc[-1] + pd.Timedelta(days=10)
+    value, forecast = logic.run_fast_model(df, target)
+    assert np.isfinite(value)
+    assert forecast["ds"].iloc[-1] == target
+    assert len(forecast) == days + 10
+    expected = "linear (short history)" if days < 14 else "holt-winters"
+    assert forecast.attrs["fit_info"]["source"] == expected
+
+
+def _assert_matches_full(df, key):
+    target = df["ds"].max() + pd.Timedelta(days=30)
+    incremental = logic.enrich_data_incremental(df, target, key=key)
+    pd.testing.assert_frame_equal(incremental, logic.enrich_data(df, target))
+
+
+@pytest.mark.parametrize("removed", [1, 3])
+def test_enrich_data_incremental_tail_deletion(removed):
+    df = _logs(40)
+    df.loc[df.index[::5], "y"] += 0.3
+    key = f"tail-deletion-{removed}"
+    _assert_matches_full(df, key)
+    _assert_matches_full(df.iloc[:-removed], key)
+    # 削除後の追記・更新も全件計算と一致する
+    appended = pd.concat([df.iloc[:-removed], _logs(3, start="2026-02-15")])
+    _assert_matches_full(appended.reset_index(drop=True), key)
+
+
+def test_enrich_data_incremental_middle_deletion():
+    df = _logs(40)
+    _assert_matches_full(df, "middle-deletion")
+    _assert_matches_full(df.drop(index=20).reset_index(drop=True), "middle-deletion")
+
+
+def test_run_linear_model_extrapolates_least_squares_line():
+    df = _logs(30)
+    df.loc[df.index[::2], "y"] += 0.2
+    df.loc[df.index[1::2], "y"] -= 0.2
+    target = df["ds"].iloc[0] + pd.Timedelta(days=59)
+    expected = np.polyval(np.polyfit(np.arange(30), df["y"], 1), 59)
+    assert logic.run_linear_model(df, target) == pytest.approx(expected)
+    assert "d" not in df.columns
+    assert logic.run_linear_model(df.iloc[:1], target) == df["y"].iloc[0]
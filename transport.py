@@ -0,0 +1,227 @@
+import os
+import random
+import threading
+import time
+
+import httpx
+import pandas as pd
+
+# --- 通信層 (Supabase への全リクエスト) ---
+# supabase_db の .execute() はすべて execute() を通す。
+#   - 接続プール: Keep-Alive の接続を使い回す httpx.Client を Supabase クライアントに渡す
+#   - タイムアウト: 1回のリクエストごとに CALL_TIMEOUT 秒で打ち切る
+#   - 再試行: 通信エラー・5xx は間隔を倍にしながら RETRIES 回まで送り直す
+#     (読み取りと、キーで冪等な Upsert しか送らないため、送り直しても結果は変わらない)
+#   - サーキットブレーカー: 連続して失敗したら BREAKER_COOLDOWN 秒は送らずに即座に失敗させる
+#     (その後は1件だけ試しに送り、結果が出るまで他の要求は遮断したまま)
+#     (呼び出し側は前回値・ローカル複製で表示を続け、書き込みはジャーナルに残る)
+#   - 計測: クエリ名ごとの所要時間のヒストグラムとエラー数 (report() / histogram())
+
+CALL_TIMEOUT = float(os.environ.get("SUPABASE_TIMEOUT", "10"))
+CONNECT_TIMEOUT = float(os.environ.get("SUPABASE_CONNECT_TIMEOUT", "5"))
+# 接続プールの大きさ (ページの並列取得・先読み・書き込みが同時に使う)
+POOL_SIZE = int(os.environ.get("SUPABASE_POOL_SIZE", "10"))
+# 使われていない Keep-Alive 接続を閉じるまでの秒数
+KEEPALIVE_EXPIRY = 30
+
+RETRIES = int(os.environ.get("SUPABASE_RETRIES", "2"))
+RETRY_BACKOFF = 0.3  # 1回目の再試行までの秒数 (以降は倍。揺らぎを加える)
+RETRY_BACKOFF_MAX = 5
+RETRY_STATUS = {"408", "429", "500", "502", "503", "504"}
+
+# この回数だけ続けて失敗したら遮断し、BREAKER_COOLDOWN 秒後に1回だけ試す
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30
+
+# 所要時間のヒストグラムの区切り (ミリ秒、上端を含む)。最後の区切りを超えた分は "inf"
+BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_LOCK = threading.Lock()
+# クエリ名 -> {"counts", "calls", "errors", "retries", "total_ms", "max_ms", "last_error"}
+_STATS = {}
+# probing: half-open で試しに送った1件の結果待ち
+_BREAKER = {
+    "state": "closed",
+    "failures": 0,
+    "opened_at": 0.0,
+    "rejected": 0,
+    "probing": False,
+}
+
+
+class CircuitOpenError(ConnectionError):
+    """サーキットブレーカーが遮断中のため送らなかった"""
+
+
+def http_client():
+    """Supabase (PostgREST) 用の接続プール付き HTTP クライアント"""
+    return httpx.Client(
+        timeout=httpx.Timeout(CALL_TIMEOUT, connect=CONNECT_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=POOL_SIZE,
+            max_keepalive_connections=POOL_SIZE,
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        ),
+    )
+
+
+def _retryable(error):
+    if isinstance(error, (httpx.TransportError, ConnectionError, TimeoutError)):
+        return not isinstance(error, CircuitOpenError)
+    # postgrest の APIError は HTTP ステータスを code に持つことがある (JSON でない応答)
+    return str(getattr(error, "code", "")) in RETRY_STATUS
+
+
+def is_permanent(error):
+    """
+    送り直しても成功しない誤りか (権限 (RLS)・制約違反・不正な値など、サーバが要求そのものを拒否した)
+    通信の失敗・遮断中・5xx は一時的な誤りとして False
+    """
+    if isinstance(error, (httpx.TransportError, ConnectionError, TimeoutError)):
+        return False
+    if isinstance(error, (ValueError, TypeError)):
+        return True
+    # postgrest の APIError は PostgreSQL のエラーコード (または HTTP ステータス) を code に持つ
+    return getattr(error, "code", None) is not None and not _retryable(error)
+
+
+def _admit():
+    with _LOCK:
+        if _BREAKER["state"] == "open":
+            waited = time.time() - _BREAKER["opened_at"]
+            if waited < BREAKER_COOLDOWN:
+                _BREAKER["rejected"] += 1
+                raise CircuitOpenError(
+                    f"circuit open for {BREAKER_COOLDOWN - waited:.0f}s "
+                    f"after {_BREAKER['failures']} failures"
+                )
+            # 冷却後の最初の1件だけを試しに送る
+            _BREAKER.update(state="half-open", probing=True)
+        elif _BREAKER["state"] == "half-open":
+            # 試しの1件の結果が出るまで、同時に来た要求は送らない
+            if _BREAKER["probing"]:
+                _BREAKER["rejected"] += 1
+                raise CircuitOpenError("circuit half-open: waiting for the probe")
+            _BREAKER["probing"] = True
+
+
+def _record(name, seconds, error=None, retried=False):
+    ms = seconds * 1000
+    with _LOCK:
+        stats = _STATS.setdefault(
+            name,
+            {
+                "counts": [0] * (len(BUCKETS_MS) + 1),
+                "calls": 0,
+                "errors": 0,
+                "retries": 0,
+                "total_ms": 0.0,
+                "max_ms": 0.0,
+                "last_error": None,
+            },
+        )
+        bucket = sum(ms > b for b in BUCKETS_MS)
+        stats["counts"][bucket] += 1
+        stats["calls"] += 1
+        stats["total_ms"] += ms
+        stats["max_ms"] = max(stats["max_ms"], ms)
+        stats["retries"] += int(retried)
+        if error is not None:
+            stats["errors"] += 1
+            stats["last_error"] = f"{type(error).__name__}: {error}"
+
+        # 遮断の判定は通信の失敗だけで行う (4xx などクエリ側の誤りでは遮断しない)
+        # half-open では、応答が返れば (4xx でも) サーバに届いたとみなして閉じる
+        half_open = _BREAKER["state"] == "half-open"
+        if error is None or (half_open and not _retryable(error)):
+            _BREAKER.update(state="closed", failures=0, probing=False)
+        elif _retryable(error):
+            _BREAKER["failures"] += 1
+            if half_open or _BREAKER["failures"] >= BREAKER_THRESHOLD:
+                _BREAKER.update(state="open", opened_at=time.time(), probing=False)
+
+
+def execute(query, name):
+    """
+    query.execute() を計測・再試行・遮断つきで実行する
+    name はヒストグラムの集計単位 (例: "daily_logs.page")
+    """
+    for attempt in range(RETRIES + 1):
+        _admit()
+        t0 = time.perf_counter()
+        try:
+            response = query.execute()
+        except Exception as e:
+            _record(name, time.perf_counter() - t0, e, retried=attempt > 0)
+            if attempt == RETRIES or not _retryable(e):
+                raise
+            delay = min(RETRY_BACKOFF * 2**attempt, RETRY_BACKOFF_MAX)
+            time.sleep(delay * (0.5 + random.random()))
+            continue
+        _record(name, time.perf_counter() - t0, retried=attempt > 0)
+        return response
+
+
+def _quantile(counts, q):
+    # ヒストグラムからの推定値 (該当する区切りの上端、超過分は inf)
+    total = sum(counts)
+    if not total:
+        return None
+    seen = 0
+    for bound, count in zip(BUCKETS_MS + (float("inf"),), counts):
+        seen += count
+        if seen >= q * total:
+            return float(bound)
+
+
+def report():
+    """クエリ名ごとの呼び出し回数・エラー数・所要時間 (平均・P50・P95・最大、ミリ秒)"""
+    with _LOCK:
+        snapshot = {
+            name: dict(s, counts=list(s["counts"])) for name, s in _STATS.items()
+        }
+    rows = [
+        {
+            "Query": name,
+            "Calls": s["calls"],
+            "Errors": s["errors"],
+            "Retries": s["retries"],
+            "Mean ms": s["total_ms"] / s["calls"],
+            "P50 ms": _quantile(s["counts"], 0.5),
+            "P95 ms": _quantile(s["counts"], 0.95),
+            "Max ms": s["max_ms"],
+            "Last error": s["last_error"],
+        }
+        for name, s in sorted(snapshot.items())
+    ]
+    return pd.DataFrame(
+        rows,
+        columns=[
+            "Query",
+            "Calls",
+            "Errors",
+            "Retries",
+            "Mean ms",
+            "P50 ms",
+            "P95 ms",
+            "Max ms",
+            "Last error",
+        ],
+    )
+
+
+def histogram():
+    """ヒストグラムの全区切り (Query, Le ms, Count)。CSV エクスポート用"""
+    with _LOCK:
+        rows = [
+            {"Query": name, "Le ms": bound, "Count": count}
+            for name, s in sorted(_STATS.items())
+            for bound, count in zip(BUCKETS_MS + (float("inf"),), s["counts"])
+        ]
+    return pd.DataFrame(rows, columns=["Query", "Le ms", "Count"])
+
+
+def breaker_status():
+    """サーキットブレーカーの状態 (closed / open / half-open)・連続失敗数・遮断した回数"""
+    with _LOCK:
+        return dict(_BREAKER)